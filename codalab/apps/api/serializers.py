@@ -71,6 +71,7 @@ class LeaderBoardSerial(serializers.ModelSerializer):
     entries =  CompetitionSubmissionSerial(read_only=True, source='submissions')
     class Meta:
         model = webmodels.PhaseLeaderBoard
+        exclude = ('rows_version', 'rows_built_version')
 
 class CompetitionDataSerial(serializers.ModelSerializer):
     image_url = serializers.URLField(source='image.url', read_only=True)
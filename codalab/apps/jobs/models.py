@@ -6,7 +6,7 @@ import logging
 import threading
 import traceback
 
-from codalabtools.azure_extensions import AzureServiceBusQueue
+from codalabtools import create_queue
 from django.conf import settings
 from django.db import (models,
                        transaction)
@@ -18,6 +18,20 @@ logger = logging.getLogger(__name__)
 _lock = threading.Lock()
 _queues = {}
 
+def _getQueueOptions():
+    """
+    Returns the options of the queue backend. The Service Bus settings are the options of the
+    'azure' backend; other backends take theirs from QUEUE_OPTIONS.
+    """
+    if settings.QUEUE_BACKEND == 'azure':
+        return {
+            'namespace': settings.SBS_NAMESPACE,
+            'key': settings.SBS_ACCOUNT_KEY,
+            'issuer': settings.SBS_ISSUER,
+            'pool_size': settings.AZURE_CONNECTION_POOL_SIZE,
+        }
+    return settings.QUEUE_OPTIONS
+
 def getQueue(name=None):
     """
     Returns a Queue given its name.
@@ -29,10 +43,7 @@ def getQueue(name=None):
 
     queue = None
     with _lock:
-        queue = AzureServiceBusQueue(settings.SBS_NAMESPACE,
-                                     settings.SBS_ACCOUNT_KEY,
-                                     settings.SBS_ISSUER,
-                                     name)
+        queue = create_queue(settings.QUEUE_BACKEND, name, **_getQueueOptions())
         _queues[name] = queue
 
     return queue
@@ -0,0 +1,96 @@
+"""
+Sends stored files to the clients which are allowed to download them.
+
+Views check the permissions, then file_response hands the bytes to the storage or to the
+front web server as DOWNLOAD_REDIRECT says, so web workers do not spend minutes sending large
+archives:
+    'sas': redirects to a URL of the blob signed for DOWNLOAD_SAS_DURATION minutes. The URL
+        carries the Content-Disposition header of attachments.
+    'x-accel': tells nginx to send DOWNLOAD_ACCEL_PREFIX/<container>/<blob>?<signature> with
+        X-Accel-Redirect. An internal location proxies it to the storage account, or serves
+        it from LOCAL_BLOB_ROOT.
+    'x-sendfile': tells Apache or lighttpd to send the file's path with X-Sendfile. Only
+        files stored on the local file system have a path.
+    'proxy': streams the file from Django.
+Files which cannot be sent as configured are streamed from Django.
+"""
+import os
+import urllib
+import urlparse
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+
+from codalab.azure_storage import AzureStorage
+
+DOWNLOAD_MODES = ('sas', 'x-accel', 'x-sendfile', 'proxy')
+
+# Size of the chunks in which files are streamed from Django.
+CHUNK_SIZE = 1024 * 1024
+
+
+def _content_disposition(file_name):
+    return 'attachment; filename="{0}"'.format(os.path.basename(file_name))
+
+
+def _signed_url(field_file, content_disposition=None):
+    """
+    Returns a short-lived URL to read a file, or None if its storage cannot sign one. The
+    storage sends the file with the given Content-Disposition header, if any.
+    """
+    storage = field_file.storage
+    if not isinstance(storage, AzureStorage):
+        return None
+    return storage.signed_url(field_file.name, duration=getattr(settings, 'DOWNLOAD_SAS_DURATION', 10),
+                              content_disposition=content_disposition)
+
+
+def _offloaded_response(field_file, content_type, mode, file_name):
+    if mode == 'sas':
+        # The redirect's own headers are lost: the signed URL names the attachment.
+        url = _signed_url(field_file, None if file_name is None else _content_disposition(file_name))
+        return None if url is None else HttpResponseRedirect(url)
+    if mode == 'x-accel':
+        storage = field_file.storage
+        prefix = getattr(settings, 'DOWNLOAD_ACCEL_PREFIX', '/protected').rstrip('/')
+        if isinstance(storage, AzureStorage):
+            # The signature lets nginx read private containers from Azure; a local alias ignores it.
+            query = urlparse.urlparse(_signed_url(field_file)).query
+            location = '%s/%s/%s?%s' % (prefix, storage.azure_container, urllib.quote(field_file.name), query)
+        else:
+            location = '%s/%s' % (prefix, urllib.quote(field_file.name))
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = location
+        return response
+    if mode == 'x-sendfile':
+        try:
+            path = field_file.storage.path(field_file.name)
+        except NotImplementedError:
+            return None
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        return response
+    return None
+
+
+def file_response(field_file, content_type, file_name=None):
+    """
+    Returns a response which sends a stored file as DOWNLOAD_REDIRECT says.
+
+    field_file: The FieldFile to send.
+    content_type: The content type of the file.
+    file_name: If given, the file is sent as an attachment of this name.
+    """
+    mode = getattr(settings, 'DOWNLOAD_REDIRECT', 'proxy')
+    if mode not in DOWNLOAD_MODES:
+        raise ImproperlyConfigured("Unknown DOWNLOAD_REDIRECT: %s" % mode)
+    response = _offloaded_response(field_file, content_type, mode, file_name)
+    if response is None:
+        response = StreamingHttpResponse(FileWrapper(field_file.storage.open(field_file.name), blksize=CHUNK_SIZE),
+                                         content_type=content_type)
+        response['Content-Length'] = field_file.size
+    if file_name is not None and response.status_code == 200:
+        response['Content-Disposition'] = _content_disposition(file_name)
+    return response
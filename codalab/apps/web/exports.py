@@ -0,0 +1,103 @@
+"""
+Streaming exports of competition results.
+
+Exports are produced by generators of rows (for CSV) or records (for JSON Lines) and are
+encoded, and optionally gzipped, one chunk at a time so a download starts as soon as the first
+row is known and never holds the whole file in memory.
+"""
+import csv
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+CSV = 'csv'
+JSON_LINES = 'jsonl'
+EXPORT_FORMATS = {
+    CSV: 'text/csv',
+    JSON_LINES: 'application/x-ndjson',
+}
+
+GZIP = 'gzip'
+
+# Number of bytes buffered before a compressed chunk is emitted.
+GZIP_CHUNK_SIZE = 64 * 1024
+
+
+class _Echo(object):
+    """File-like object whose write returns the value written, so csv.writer returns lines."""
+    def write(self, value):
+        return value
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def csv_lines(rows):
+    """
+    Yields the UTF-8 encoded CSV line of each row.
+    """
+    writer = csv.writer(_Echo())
+    for row in rows:
+        yield writer.writerow([_encode(value) for value in row])
+
+
+def json_lines(records):
+    """
+    Yields one JSON document per record, each terminated by a newline.
+    """
+    for record in records:
+        yield json.dumps(record, cls=DjangoJSONEncoder) + "\n"
+
+
+def gzip_chunks(chunks, level=6):
+    """
+    Compresses a stream of byte strings into a gzip stream as the chunks are produced.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= GZIP_CHUNK_SIZE:
+            data = compressor.compress(''.join(pending))
+            pending, pending_size = [], 0
+            if data:
+                yield data
+    data = compressor.compress(''.join(pending))
+    if data:
+        yield data
+    yield compressor.flush()
+
+
+def export_response(request, filename, rows, records):
+    """
+    Returns a StreamingHttpResponse with the export requested by the 'format' (csv or jsonl)
+    and 'compress' (gzip) query parameters.
+
+    filename: name of the downloaded file, without extension.
+    rows: callable returning the rows of the CSV export.
+    records: callable returning the records of the JSON Lines export.
+    """
+    export_format = request.GET.get('format', CSV)
+    if export_format not in EXPORT_FORMATS:
+        export_format = CSV
+    if export_format == JSON_LINES:
+        stream = json_lines(records())
+    else:
+        stream = csv_lines(rows())
+    filename = "%s.%s" % (filename, export_format)
+    if request.GET.get('compress') == GZIP:
+        stream = gzip_chunks(stream)
+        filename += ".gz"
+        content_type = 'application/gzip'
+    else:
+        content_type = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(stream, status=200, content_type=content_type)
+    response["Content-Disposition"] = "attachment; filename=%s" % _encode(filename)
+    return response
@@ -0,0 +1,108 @@
+import exceptions
+import operator
+import random
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from apps.web import ranking
+
+
+def legacy_rank_values(ids, id_value_pairs, sort_ascending=True, eps=1.0e-12):
+    """ Ranking of a score column as it was done before the ranking engine. """
+    ranks = {}
+    valid_pairs = {k: v for k, v in id_value_pairs.iteritems() if k in ids}
+    if len(valid_pairs) == 0:
+        return {id: 1 for id in ids}
+    sorted_pairs = sorted(valid_pairs.iteritems(), key=operator.itemgetter(1), reverse=not sort_ascending)
+    r = 1
+    k, v = sorted_pairs[0]
+    ranks[k] = r
+    for i in range(1, len(sorted_pairs)):
+        k, vnow = sorted_pairs[i]
+        if abs(vnow - v) > eps:
+            r = r + 1
+            v = vnow
+        ranks[k] = r
+    r = r + 1
+    for id in ids:
+        if id not in ranks:
+            ranks[id] = r
+    return ranks
+
+
+def legacy_rank_submissions(ranks_by_id):
+    def compare_ranks(a, b):
+        limit = 1000000
+        try:
+            ia = int(ranks_by_id[a])
+        except exceptions.ValueError:
+            ia = limit
+        try:
+            ib = int(ranks_by_id[b])
+        except exceptions.ValueError:
+            ib = limit
+        return ia - ib
+    return compare_ranks
+
+
+def legacy_leaderboard(ids, columns):
+    ranks = [legacy_rank_values(ids, pairs, sort_ascending=asc) for (pairs, asc) in columns]
+    averages = {}
+    for id in ids:
+        averages[id] = sum([r[id] for r in ranks]) / float(len(ranks))
+    overall = legacy_rank_values(ids, averages)
+    return sorted(ids, cmp=legacy_rank_submissions(overall))
+
+
+def engine_leaderboard(backend):
+    def leaderboard(ids, columns):
+        ranks = ranking.rank_columns(ids, columns, backend=backend)
+        overall = ranking.rank_values(ids, ranking.average_ranks(ids, ranks, backend=backend), backend=backend)
+        return ranking.order_submissions(ids, overall, backend=backend)
+    return leaderboard
+
+
+class Command(BaseCommand):
+    help = """Benchmarks leaderboard ranking (score columns, Avg-of-ranks column and final ordering)."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--submissions', dest='submissions', type='int', default=10000,
+                    help="Number of leaderboard submissions"),
+        make_option('--columns', dest='columns', type='int', default=50,
+                    help="Number of score columns"),
+        make_option('--skip-legacy', dest='skip_legacy', action='store_true', default=False,
+                    help="Do not time the ranking code which predates the ranking engine"),
+    )
+
+    def _time(self, label, func, ids, columns):
+        start = time.time()
+        order = func(ids, columns)
+        elapsed = time.time() - start
+        self.stdout.write("%-10s %8.3fs" % (label, elapsed))
+        return order, elapsed
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        ids = range(1, options['submissions'] + 1)
+        columns = []
+        for j in range(options['columns']):
+            pairs = {id: round(rng.random(), 4) for id in ids if rng.random() > 0.05}
+            columns.append((pairs, j % 2 == 0))
+        self.stdout.write("Ranking %d submissions x %d columns" % (len(ids), len(columns)))
+
+        python_order, python_time = self._time("python", engine_leaderboard(ranking.PYTHON), ids, columns)
+        if ranking.numpy is not None:
+            numpy_order, numpy_time = self._time("numpy", engine_leaderboard(ranking.NUMPY), ids, columns)
+            assert numpy_order == python_order, "NumPy and Python rankings differ"
+        else:
+            self.stdout.write("numpy      not installed")
+            numpy_time = None
+        if not options['skip_legacy']:
+            legacy_order, legacy_time = self._time("legacy", legacy_leaderboard, ids, columns)
+            assert legacy_order == python_order, "Legacy and engine rankings differ"
+            self.stdout.write("Speedup over legacy: python %.1fx" % (legacy_time / python_time))
+            if numpy_time:
+                self.stdout.write("Speedup over legacy: numpy %.1fx" % (legacy_time / numpy_time))
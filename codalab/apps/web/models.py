@@ -1,21 +1,25 @@
+import copy
 import csv
 import datetime
+import decimal
 import django.dispatch
 import exceptions
+import hashlib
 import io
 import json
 import logging
-import operator
 import os
 import random
 import string
 import StringIO
 import tempfile
+import threading
 import time
 import uuid
 import yaml
 import zipfile
 
+from contextlib import contextmanager
 from os.path import abspath, basename, dirname, join, normpath, split
 
 from django.conf import settings
@@ -29,8 +33,8 @@ from django.core.urlresolvers import reverse, reverse_lazy
 from django.db import IntegrityError
 from django.db import models
 from django.db import transaction
-from django.db.models import Max
-from django.db.models.signals import post_save
+from django.db.models import Count, F, Max
+from django.db.models.signals import m2m_changed, post_init, post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from django.utils.dateparse import parse_datetime
 from django.utils.text import slugify
@@ -44,9 +48,12 @@ from django_extensions.db.fields import UUIDField
 from django.utils.functional import cached_property
 
 from apps.forums.models import Forum
-from apps.coopetitions.models import DownloadRecord
+from apps.web import exports
+from apps.web import ranking
+from apps.coopetitions.models import Dislike, DownloadRecord, Like
 
 from apps.teams.models import Team, get_user_team
+from codalabtools import zipstream
 
 
 User = settings.AUTH_USER_MODEL
@@ -189,6 +196,7 @@ class Competition(models.Model):
     enable_teams = models.BooleanField(default=True)
     require_team_approval = models.BooleanField(default=True)
     anonymous_leaderboard = models.BooleanField(default=False)
+    max_concurrent_runs = models.PositiveIntegerField(null=True, blank=True)
 
     teams = models.ManyToManyField(Team, related_name='competition_teams', blank=True, null=True)
 
@@ -301,7 +309,8 @@ class Competition(models.Model):
                 )
                 new_submission.save(ignore_submission_limits=True)
 
-                evaluate_submission(new_submission.pk, current_phase.is_scoring_only)
+                evaluate_submission(new_submission.pk, current_phase.is_scoring_only,
+                                    priority=ScheduledRun.MIGRATION)
         except PhaseLeaderBoard.DoesNotExist:
             pass
 
@@ -442,7 +451,8 @@ class Competition(models.Model):
                 submission.is_migrated = True
                 submission.save()
 
-                evaluate_submission(new_submission.pk, current_phase.is_scoring_only)
+                evaluate_submission(new_submission.pk, current_phase.is_scoring_only,
+                                    priority=ScheduledRun.MIGRATION)
         except PhaseLeaderBoard.DoesNotExist:
             pass
 
@@ -456,20 +466,48 @@ class Competition(models.Model):
         self.last_phase_migration = current_phase.phasenumber
         self.save()
 
+    def get_coopetition_downloads_csv(self):
+        """
+        Returns the list of the downloads of the submissions of this competition, as a CSV for
+        the coopetition bundle. It is cached until a submission is downloaded again.
+        """
+        key = coopetition_downloads_cache_key(self.pk)
+        content = cache.get(key)
+        if content is None:
+            downloads_csv = StringIO.StringIO()
+            writer = csv.writer(downloads_csv)
+            writer.writerow((
+                "submission_pk",
+                "submission_owner",
+                "downloaded_by",
+                "time_of_download",
+            ))
+            downloads = DownloadRecord.objects.filter(submission__phase__competition=self) \
+                                              .select_related('submission__participant__user', 'user')
+            for download in downloads:
+                writer.writerow((
+                    download.submission.pk,
+                    download.submission.participant.user.username,
+                    download.user.username,
+                    str(download.timestamp),
+                ))
+            content = downloads_csv.getvalue().encode('utf-8')
+            cache.set(key, content, settings.LEADERBOARD_CACHE_TIMEOUT)
+        return content
+
     def get_results_csv(self, phase_pk, include_scores_not_on_leaderboard=False):
         phase = self.phases.get(pk=phase_pk)
         if phase.is_blind:
             return 'Not allowed, phase is blind.'
+        return ''.join(exports.csv_lines(self.iter_results_rows(phase, include_scores_not_on_leaderboard)))
 
+    def iter_results_rows(self, phase, include_scores_not_on_leaderboard=False):
+        """
+        Yields the rows of the results CSV of a phase, one result group after the other.
+        """
         groups = phase.scores(include_scores_not_on_leaderboard=include_scores_not_on_leaderboard)
 
-        csvfile = StringIO.StringIO()
-        csvwriter = csv.writer(csvfile)
-
         for group in groups:
-            #csvwriter.writerow([group['label']])
-            #csvwriter.writerow([])
-
             headers = ["User"]
             sub_headers = [""]
             # This ordering dict will contain {<header key>: <order of the column>}
@@ -484,16 +522,15 @@ class Competition(models.Model):
                         sub_headers.append(sub['label'])
                 else:
                     headers.append(header['label'])
-            csvwriter.writerow(['submission_pk',] + headers)
+            yield ['submission_pk',] + headers
             if sub_headers != ['']:
-                csvwriter.writerow(sub_headers)
+                yield sub_headers
 
-            try:
-                if len(group['scores']) <= 0:
-                    csvwriter.writerow(["No data available"])
-                else:
-                    for pk, scores in group['scores']:
-                        #print pk, scores
+            if len(group['scores']) <= 0:
+                yield ["No data available"]
+            else:
+                for pk, scores in group['scores']:
+                    try:
                         row = [scores['username']] + (['']*(len(ordering) + 1))
                         for v in scores['values']:
                             if 'rnk' in v:
@@ -501,15 +538,116 @@ class Competition(models.Model):
                                 row[ordering[v['name']] + 1] = "%s (%s)" % (v['val'], v['rnk'])
                             else:
                                 row[ordering[v['name']] + 1] = "%s (%s)" % (v['val'], v['hidden_rnk'])
-                        csvwriter.writerow([scores['id'],] + row)
-            except:
-                csvwriter.writerow(["Exception parsing scores!"])
-                logger.error("Error parsing scores for competition PK=%s" % self.pk)
+                    except:
+                        yield ["Exception parsing scores!"]
+                        logger.error("Error parsing scores for competition PK=%s" % self.pk)
+                        break
+                    yield [scores['id'],] + row
+
+            yield []
+            yield []
 
-            csvwriter.writerow([])
-            csvwriter.writerow([])
+    def iter_results_records(self, phase, include_scores_not_on_leaderboard=False):
+        """
+        Yields one record per leaderboard row of a phase for JSON exports of the results.
+        """
+        groups = phase.scores(include_scores_not_on_leaderboard=include_scores_not_on_leaderboard)
+        for group in groups:
+            for rank, scores in group['scores']:
+                yield {
+                    'group': group['label'],
+                    'submission_pk': scores['id'],
+                    'username': scores['username'],
+                    'team_name': scores['team_name'],
+                    'rank': rank,
+                    'scores': [{'name': v['name'],
+                                'value': v['val'],
+                                'rank': v['rnk'] if 'rnk' in v else v['hidden_rnk']} for v in scores['values']],
+                }
+
+    def _results_submission_details(self, phase, groups):
+        """
+        Returns {submission id: (description, submitted_at, filename, is_on_leaderboard)} for the
+        submissions in the given leaderboard groups. Only the exported columns are read, through
+        an iterator, so submissions are not kept in memory as model instances.
+        """
+        leader_board_entries = set(PhaseLeaderBoardEntry.objects.filter(board__phase=phase).values_list('result__id', flat=True))
+        submission_ids = set(scores['id'] for group in groups for (pk, scores) in group['scores'])
+        details = {}
+        qs = CompetitionSubmission.objects.filter(pk__in=submission_ids).values_list('pk', 'description', 'submitted_at', 'readable_filename', 'file')
+        for (pk, description, submitted_at, readable_filename, file_name) in qs.iterator():
+            # Exports do not save submissions missing a readable filename, see get_filename.
+            filename = readable_filename or split(file_name)[1]
+            details[pk] = (description, submitted_at, filename, pk in leader_board_entries)
+        return details
+
+    def iter_complete_results_rows(self, phase):
+        """
+        Yields the rows of the complete results CSV of a phase: every finished submission with
+        its scores, description, date, filename and whether it is on the leaderboard.
+        """
+        groups = phase.scores(include_scores_not_on_leaderboard=True)
+        details = self._results_submission_details(phase, groups)
 
-        return csvfile.getvalue()
+        for group in groups:
+            yield [group['label']]
+            yield []
+
+            headers = ["User"]
+            sub_headers = [""]
+            for header in group['headers']:
+                subs = header['subs']
+                if subs:
+                    for sub in subs:
+                        headers.append(header['label'])
+                        sub_headers.append(sub['label'])
+                else:
+                    headers.append(header['label'])
+            headers.append('Description')
+            headers.append('Date')
+            headers.append('Filename')
+            headers.append('Is on leaderboard?')
+            yield headers
+            yield sub_headers
+
+            if len(group['scores']) <= 0:
+                yield ["No data available"]
+            else:
+                for pk, scores in group['scores']:
+                    row = [scores['username']]
+                    for v in scores['values']:
+                        if 'rnk' in v:
+                            row.append("%s (%s)" % (v['val'], v['rnk']))
+                        else:
+                            row.append("%s (%s)" % (v['val'], v['hidden_rnk']))
+                    row.extend(details[scores['id']])
+                    yield [unicode(r) for r in row]
+
+            yield []
+            yield []
+
+    def iter_complete_results_records(self, phase):
+        """
+        Yields one record per finished submission of a phase for JSON exports of the complete results.
+        """
+        groups = phase.scores(include_scores_not_on_leaderboard=True)
+        details = self._results_submission_details(phase, groups)
+        for group in groups:
+            for rank, scores in group['scores']:
+                description, submitted_at, filename, is_on_leaderboard = details[scores['id']]
+                yield {
+                    'group': group['label'],
+                    'submission_pk': scores['id'],
+                    'username': scores['username'],
+                    'rank': rank,
+                    'scores': [{'name': v['name'],
+                                'value': v['val'],
+                                'rank': v['rnk'] if 'rnk' in v else v['hidden_rnk']} for v in scores['values']],
+                    'description': description,
+                    'submitted_at': submitted_at,
+                    'filename': filename,
+                    'is_on_leaderboard': is_on_leaderboard,
+                }
 
     def get_score_headers(self):
         qs = self.submissionscoredef_set.filter(computed=False)
@@ -649,6 +787,149 @@ def submission_prediction_runfile_name(instance, filename="run.txt"):
 def submission_prediction_output_filename(instance, filename="output.zip"):
     return os.path.join(submission_root(instance), "pred", "run", filename)
 
+def _leaderboard_version(phase_pk, name):
+    """
+    Returns the current version of a cached part of the leaderboard of a phase: 'board', 'all'
+    or 'layout'. Invalidating the part drops its version, so the next read starts a new one.
+    """
+    key = "phase_%s_leaderboard_%s_version" % (phase_pk, name)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, settings.LEADERBOARD_CACHE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+def leaderboard_cache_key(phase_pk, include_scores_not_on_leaderboard=False):
+    """
+    Returns the cache key under which the ranked leaderboard of a phase is materialized. The
+    key changes when the leaderboard is invalidated, so a leaderboard ranked from rows read
+    before the change cannot be stored under the new key.
+    """
+    name = "all" if include_scores_not_on_leaderboard else "board"
+    return "phase_%s_leaderboard_%s_%s" % (phase_pk, name, _leaderboard_version(phase_pk, name))
+
+def leaderboard_layout_cache_key(phase_pk):
+    """
+    Returns the cache key under which the layout of the leaderboard of a phase is cached (see
+    CompetitionPhase.leaderboard_layout).
+    """
+    return "phase_%s_leaderboard_layout_%s" % (phase_pk, _leaderboard_version(phase_pk, 'layout'))
+
+def invalidate_ranked_leaderboards(phase_pk, changes):
+    """
+    Drops the ranked leaderboards of a phase and the coopetition files which depend on the
+    given changes of its leaderboard rows (see LeaderboardRows.CHANGES).
+    """
+    keys = []
+    if 'board' in changes:
+        keys.append("phase_%s_leaderboard_board_version" % phase_pk)
+    if 'all' in changes:
+        # The coopetition scores are the results of all the finished submissions.
+        keys.append("phase_%s_leaderboard_all_version" % phase_pk)
+        keys.append(coopetition_cache_key(phase_pk, 'scores'))
+    if 'finished' in changes:
+        keys.append(coopetition_cache_key(phase_pk, 'submissions'))
+    if keys:
+        cache.delete_many(keys)
+
+# Seconds after which the leaderboard lock of a phase expires.
+LEADERBOARD_LOCK_TIMEOUT = 30
+# Seconds for which the leaderboard lock of a phase is waited for when another process holds it.
+LEADERBOARD_LOCK_WAIT = 10
+
+@contextmanager
+def leaderboard_lock(phase_pk):
+    """
+    Holds the leaderboard lock of a phase while its stored leaderboard rows are written, so
+    concurrent writers do not store stale rows. Yields whether the lock was acquired: it is
+    not if another process held it for LEADERBOARD_LOCK_WAIT seconds, and the caller must not
+    write the rows then.
+    """
+    key = "phase_%s_leaderboard_lock" % phase_pk
+    deadline = time.time() + LEADERBOARD_LOCK_WAIT
+    acquired = cache.add(key, True, LEADERBOARD_LOCK_TIMEOUT)
+    while not acquired and time.time() < deadline:
+        time.sleep(0.05)
+        acquired = cache.add(key, True, LEADERBOARD_LOCK_TIMEOUT)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(key)
+
+def coopetition_cache_key(phase_pk, name):
+    """
+    Returns the cache key under which a file of the coopetition bundle of a phase is cached:
+    name is 'submissions' or 'scores'.
+    """
+    return "phase_%s_coopetition_%s" % (phase_pk, name)
+
+def coopetition_downloads_cache_key(competition_pk):
+    """
+    Returns the cache key under which the downloads file of the coopetition bundle of a
+    competition is cached.
+    """
+    return "competition_%s_coopetition_downloads" % competition_pk
+
+def invalidate_coopetition_files(phase_pks, names=('submissions', 'scores')):
+    """
+    Drops the given cached coopetition files of the given phases (see coopetition_cache_key).
+    """
+    keys = []
+    for phase_pk in phase_pks:
+        for name in names:
+            keys.append(coopetition_cache_key(phase_pk, name))
+    if keys:
+        cache.delete_many(keys)
+
+def invalidate_leaderboards(phase_pks):
+    """
+    Drops the materialized leaderboards and leaderboard layouts of the given phases, along
+    with the coopetition files derived from their submissions and results. The stored
+    leaderboard rows hold all the scores of the submissions, so they are kept.
+    """
+    for phase_pk in phase_pks:
+        cache.delete("phase_%s_leaderboard_layout_version" % phase_pk)
+        invalidate_ranked_leaderboards(phase_pk, LeaderboardRows.CHANGES)
+
+def update_leaderboard_rows(phase_pk, submission_pks):
+    """
+    Updates the stored leaderboard rows of a phase after the given submissions were added to
+    or removed from its leaderboard, finished, or got new scores. Only the rows of these
+    submissions are read again. The ranked leaderboards and coopetition files which depend
+    on the changed rows are dropped; all of them are if the rows were not stored.
+    """
+    with leaderboard_lock(phase_pk) as locked:
+        if not PhaseLeaderBoard.objects.filter(phase__pk=phase_pk, rows_built_version=F('rows_version')).exists():
+            changes = LeaderboardRows.CHANGES
+        elif not locked:
+            # The rows are stored again from the submissions on the next read.
+            PhaseLeaderBoard.objects.filter(phase__pk=phase_pk).update(rows_version=F('rows_version') + 1)
+            changes = LeaderboardRows.CHANGES
+        else:
+            changes = LeaderboardRows.update_stored(phase_pk, submission_pks)
+    invalidate_ranked_leaderboards(phase_pk, changes)
+
+def score_defs_cache_key(competition_pk):
+    """
+    Returns the cache key under which the score definitions of a competition are cached.
+    """
+    return "competition_%s_score_defs" % competition_pk
+
+def get_score_defs(competition_pk):
+    """
+    Returns a dictionary mapping the keys of the score definitions of a competition to their
+    (pk, computed) pair. It is cached until a score definition of the competition changes.
+    """
+    key = score_defs_cache_key(competition_pk)
+    score_defs = cache.get(key)
+    if score_defs is None:
+        score_defs = dict((key, (pk, computed)) for key, pk, computed in
+                          SubmissionScoreDef.objects.filter(competition__pk=competition_pk)
+                                                    .values_list('key', 'pk', 'computed'))
+        cache.set(key, score_defs, settings.LEADERBOARD_CACHE_TIMEOUT)
+    return score_defs
+
 class _LeaderboardManagementMode(object):
     """
     Provides a set of constants which define when results become visible to participants
@@ -758,43 +1039,12 @@ class CompetitionPhase(models.Model):
             computes a ranking based on the value. The ranking is provided
             as a set of (id, rank) pairs for all id in ids.
         """
-        ranks = {}
-        # Only keep pairs for which the key is in the list of ids
-        valid_pairs = {k: v for k, v in id_value_pairs.iteritems() if k in ids}
-        if len(valid_pairs) == 0:
-            return {id: 1 for id in ids}
-        # Sort and compute ranks
-        sorted_pairs = sorted(valid_pairs.iteritems(), key = operator.itemgetter(1), reverse=not sort_ascending)
-        r = 1
-        k, v = sorted_pairs[0]
-        ranks[k] = r
-        for i in range(1, len(sorted_pairs)):
-            k, vnow = sorted_pairs[i]
-            # Increment the rank only when values are different
-            if abs(vnow - v) > eps:
-                r = r + 1
-                v = vnow
-            ranks[k] = r
-        # Fill in ranks for ids which were not seen in the input
-        r = r + 1
-        for id in ids:
-            if id not in ranks:
-                ranks[id] = r
-        return ranks
+        return ranking.rank_values(ids, id_value_pairs, sort_ascending=sort_ascending, eps=eps)
 
     @staticmethod
     def rank_submissions(ranks_by_id):
         def compare_ranks(a, b):
-            limit = 1000000
-            try:
-                ia = int(ranks_by_id[a])
-            except exceptions.ValueError:
-                ia = limit
-            try:
-                ib = int(ranks_by_id[b])
-            except exceptions.ValueError:
-                ib = limit
-            return ia - ib
+            return ranking.rank_key(ranks_by_id[a]) - ranking.rank_key(ranks_by_id[b])
         return compare_ranks
 
     @staticmethod
@@ -808,57 +1058,146 @@ class CompetitionPhase(models.Model):
         return ("{:." + str(p) + "f}").format(v)
 
     def scores(self, include_scores_not_on_leaderboard=False, **kwargs):
+        """
+        Returns the ranked leaderboard groups for this phase.
+
+        Unfiltered leaderboards are ranked from the leaderboard rows stored for the phase (see
+        PhaseLeaderBoardRow) and materialized in the cache (see leaderboard_cache_key). A change
+        to a submission only updates the stored row of that submission, so when the ranked
+        leaderboard is not cached (or too large to be) it is ranked again from the stored rows.
+        """
         score_filters = kwargs.pop('score_filters',{})
+        if kwargs:
+            return self._compute_scores(include_scores_not_on_leaderboard, **kwargs)
+
+        key = leaderboard_cache_key(self.pk, include_scores_not_on_leaderboard)
+        results = cache.get(key)
+        if results is None:
+            results = LeaderboardRows.stored(self).ranked(include_scores_not_on_leaderboard)
+            cache.set(key, results, settings.LEADERBOARD_CACHE_TIMEOUT)
+        return results
 
-        # Get the list of submissions in this leaderboard
-        submissions = []
-        result_location = []
-        lb, created = PhaseLeaderBoard.objects.get_or_create(phase=self)
-        if not created:
-            if include_scores_not_on_leaderboard:
-                qs = CompetitionSubmission.objects.filter(
-                    phase=self,
-                    status__codename=CompetitionSubmissionStatus.FINISHED
-                )
-                for submission in qs:
-                    result_location.append(submission.file.name)
-                    submissions.append((submission.pk, submission.participant.user, submission.team))
-            else:
-                qs = PhaseLeaderBoardEntry.objects.filter(board=lb)
-                for entry in qs:
-                    result_location.append(entry.result.file.name)
+    def refresh_leaderboard(self):
+        """
+        Ranks the materialized leaderboards of this phase again from its stored leaderboard
+        rows, so the next reads hit the cache.
+        """
+        # The keys are read first: if the rows change meanwhile, the results are stored under stale keys.
+        keys = [leaderboard_cache_key(self.pk, include_scores_not_on_leaderboard)
+                for include_scores_not_on_leaderboard in (False, True)]
+        rows = LeaderboardRows.stored(self)
+        for key, include_scores_not_on_leaderboard in zip(keys, (False, True)):
+            cache.set(key, rows.ranked(include_scores_not_on_leaderboard), settings.LEADERBOARD_CACHE_TIMEOUT)
+
+    def get_coopetition_submissions_csv(self):
+        """
+        Returns the list of the finished submissions of this phase with their like and dislike
+        counts, as a CSV for the coopetition bundle. It is cached until a submission of the
+        phase is created, finishes or stops being finished, or until a finished submission is
+        made public, downloaded, liked or disliked.
+        """
+        key = coopetition_cache_key(self.pk, 'submissions')
+        content = cache.get(key)
+        if content is None:
+            field_names = (
+                "participant__user__username",
+                "pk",
+                "when_made_public",
+                "when_unmade_public",
+                "started_at",
+                "completed_at",
+                "download_count",
+                "submission_number",
+            )
+            annotated_submissions = self.submissions.filter(status__codename=CompetitionSubmissionStatus.FINISHED).values(
+                *field_names
+            ).annotate(like_count=Count("likes"), dislike_count=Count("dislikes"))
+
+            # Add this after fetching annotated count from db
+            field_names += ("like_count", "dislike_count")
+
+            submissions_csv = StringIO.StringIO()
+            writer = csv.DictWriter(submissions_csv, field_names)
+            writer.writeheader()
+            for row in annotated_submissions:
+                writer.writerow(row)
+            content = submissions_csv.getvalue().encode('utf-8')
+            cache.set(key, content, settings.LEADERBOARD_CACHE_TIMEOUT)
+        return content
+
+    def get_coopetition_scores_csv(self):
+        """
+        Returns the results of this phase, including the scores not on the leaderboard, as a
+        CSV for the coopetition bundle. It is cached until the ranked leaderboard of all the
+        finished submissions changes.
+        """
+        key = coopetition_cache_key(self.pk, 'scores')
+        content = cache.get(key)
+        if content is None:
+            content = self.competition.get_results_csv(self.pk, include_scores_not_on_leaderboard=True)
+            cache.set(key, content, settings.LEADERBOARD_CACHE_TIMEOUT)
+        return content
+
+    def invalidate_leaderboard(self):
+        """
+        Drops the materialized leaderboards of this phase.
+        """
+        invalidate_leaderboards([self.pk])
 
-                for entry in qs:
-                    submissions.append((entry.result.id, entry.result.participant.user, entry.result.team))
+    def leaderboard_submissions(self, include_scores_not_on_leaderboard=False):
+        """
+        Returns the submissions shown on the leaderboard of this phase, with their participant,
+        user and team loaded by the same query. When include_scores_not_on_leaderboard is True
+        all the finished submissions of the phase are returned.
+        """
+        lb, created = PhaseLeaderBoard.objects.get_or_create(phase=self)
+        if created:
+            return []
+        if include_scores_not_on_leaderboard:
+            qs = CompetitionSubmission.objects.filter(
+                phase=self,
+                status__codename=CompetitionSubmissionStatus.FINISHED
+            ).select_related('participant__user', 'team')
+            return list(qs)
+        qs = PhaseLeaderBoardEntry.objects.filter(board=lb).select_related('result__participant__user', 'result__team')
+        return [entry.result for entry in qs]
+
+    def leaderboard_score_sets(self, result_groups, **kwargs):
+        """
+        Returns a dict mapping the id of each result group to the list of score sets in the
+        group, in tree order. The score sets of all the groups are read with a single query.
+        """
+        score_sets = {g.pk: [] for g in result_groups}
+        groups_by_scoredef = {}
+        for (scoredef_id, group_id) in SubmissionScoreDefGroup.objects.filter(
+                group__in=result_groups).values_list('scoredef_id', 'group_id'):
+            groups_by_scoredef.setdefault(scoredef_id, []).append(group_id)
+        if len(groups_by_scoredef) > 0:
+            qs = SubmissionScoreSet.objects.order_by('tree_id', 'lft').filter(
+                scoredef_id__in=groups_by_scoredef.keys(),
+                **kwargs
+            ).select_related('scoredef', 'parent')
+            for x in qs:
+                for group_id in groups_by_scoredef[x.scoredef_id]:
+                    score_sets[group_id].append(x)
+        return score_sets
+
+    def leaderboard_layout(self, **kwargs):
+        """
+        Returns the layout of the leaderboard of this phase: its result groups with their
+        headers and score definitions ('groups'), the score definitions whose values are read
+        from the database ('scoredefs', by id) and the score definitions each computed score
+        definition is computed from ('computed_deps', by id).
+        """
+        result_groups = list(SubmissionResultGroup.objects.filter(phases__in=[self]).order_by('ordering'))
+        score_sets = self.leaderboard_score_sets(result_groups, **kwargs)
 
-        results = []
-        for count, g in enumerate(SubmissionResultGroup.objects.filter(phases__in=[self]).order_by('ordering')):
-            label = g.label
+        groups = []
+        for g in result_groups:
             headers = []
-            scores = {}
-
-            # add the location of the results on the blob storage to the scores
-            for (pk, user, team) in submissions:
-                if self.competition.enable_teams:
-                    team_name=''
-                    if team is not None:
-                        team_name=team.name
-                else:
-                    team_name=user.team_name
-                scores[pk] = {
-                    'username': user.username,
-                    'user_pk': user.pk,
-                    'team_name': team_name,
-                    'id': pk,
-                    'values': [],
-                    'resultLocation': result_location[count]
-                }
-
             scoreDefs = []
             columnKeys = {} # maps a column key to its index in headers list
-            for x in SubmissionScoreSet.objects.order_by('tree_id','lft').filter(scoredef__isnull=False,
-                                                                        scoredef__groups__in=[g],
-                                                                        **kwargs).select_related('scoredef', 'parent'):
+            for x in score_sets[g.pk]:
                 if x.parent is not None:
                     columnKey = x.parent.key
                     columnLabel = x.parent.label
@@ -893,46 +1232,243 @@ class CompetitionPhase(models.Model):
                 if (selection_key is None) or (scoreDefs[i].selection_default > selection_order):
                     selection_key, selection_order = scoreDefs[i].key, scoreDefs[i].selection_default
 
-            results.append({ 'label': label, 'headers': headers, 'total_span' : column_span, 'selection_key': selection_key,
-                             'scores': scores, 'scoredefs': scoreDefs })
-
-        if len(submissions) > 0:
-            # Figure out which submission scores we need to read from the database.
-            submission_ids = [id for (id,name) in submissions]
-            # not_computed_scoredefs: map (scoredef.id, scoredef) to keep track of non-computed scoredefs
-            not_computed_scoredefs = {}
-            computed_scoredef_ids = []
-            # computed_deps: maps id of a computed scoredef to a list of ids for scoredefs which are
-            #                input to the computation
-            computed_deps = {}
-            for result in results:
-                for sdef in result['scoredefs']:
-                    if sdef.computed is True:
-                        computed_scoredef_ids.append(sdef.id)
-                    else:
-                        not_computed_scoredefs[sdef.id] = sdef
-                if len(computed_scoredef_ids) > 0:
-                    computed_ids = SubmissionComputedScore.objects.filter(scoredef_id__in=computed_scoredef_ids).values_list('id')
-                    fields = SubmissionComputedScoreField.objects.filter(computed_id__in=computed_ids).select_related('scoredef', 'computed')
-                    for field in fields:
-                        if not field.scoredef.computed:
-                            not_computed_scoredefs[field.scoredef.id] = field.scoredef
-                        if field.computed.scoredef_id not in computed_deps:
-                            computed_deps[field.computed.scoredef_id] = []
-                        computed_deps[field.computed.scoredef_id].append(field.scoredef)
-            # Now read the submission scores
+            groups.append({ 'label': g.label, 'headers': headers, 'total_span' : column_span, 'selection_key': selection_key,
+                            'scoredefs': scoreDefs })
+
+        # not_computed_scoredefs: map (scoredef.id, scoredef) to keep track of non-computed scoredefs
+        not_computed_scoredefs = {}
+        computed_scoredef_ids = []
+        # computed_deps: maps id of a computed scoredef to a list of ids for scoredefs which are
+        #                input to the computation
+        computed_deps = {}
+        for group in groups:
+            for sdef in group['scoredefs']:
+                if sdef.computed is True:
+                    computed_scoredef_ids.append(sdef.id)
+                else:
+                    not_computed_scoredefs[sdef.id] = sdef
+            if len(computed_scoredef_ids) > 0:
+                computed_ids = SubmissionComputedScore.objects.filter(scoredef_id__in=computed_scoredef_ids).values_list('id')
+                fields = SubmissionComputedScoreField.objects.filter(computed_id__in=computed_ids).select_related('scoredef', 'computed')
+                for field in fields:
+                    if not field.scoredef.computed:
+                        not_computed_scoredefs[field.scoredef.id] = field.scoredef
+                    if field.computed.scoredef_id not in computed_deps:
+                        computed_deps[field.computed.scoredef_id] = []
+                    computed_deps[field.computed.scoredef_id].append(field.scoredef)
+        return {'groups': groups, 'scoredefs': not_computed_scoredefs, 'computed_deps': computed_deps}
+
+    def _compute_scores(self, include_scores_not_on_leaderboard=False, **kwargs):
+        return LeaderboardRows.read(self, **kwargs).ranked(include_scores_not_on_leaderboard)
+
+
+def _dump_leaderboard_scores(values):
+    return json.dumps(dict((str(sdef_id), str(value)) for (sdef_id, value) in values.iteritems()), sort_keys=True)
+
+def _load_leaderboard_scores(scores):
+    return dict((int(sdef_id), decimal.Decimal(value)) for (sdef_id, value) in json.loads(scores).iteritems())
+
+def _read_leaderboard_rows(phase_pk, submission_pks=None):
+    """
+    Reads the rows of the submissions of a phase which are on its leaderboard or finished, or
+    of the given ones only. Returns a list of (submission, pk of its leaderboard entry or None,
+    whether it is finished, {score definition pk: value}) tuples.
+    """
+    entries = PhaseLeaderBoardEntry.objects.filter(board__phase__pk=phase_pk)
+    finished = CompetitionSubmission.objects.filter(phase__pk=phase_pk,
+                                                    status__codename=CompetitionSubmissionStatus.FINISHED)
+    scores = SubmissionScore.objects.filter(result__phase__pk=phase_pk)
+    if submission_pks is not None:
+        entries = entries.filter(result__pk__in=submission_pks)
+        finished = finished.filter(pk__in=submission_pks)
+        scores = scores.filter(result__pk__in=submission_pks)
+    submissions = {}
+    entry_pks = {}
+    for entry in entries.select_related('result__participant__user', 'result__team'):
+        entry_pks[entry.result_id] = entry.pk
+        submissions[entry.result_id] = entry.result
+    finished_pks = set()
+    for submission in finished.select_related('participant__user', 'team'):
+        finished_pks.add(submission.pk)
+        submissions[submission.pk] = submission
+    values = {}
+    if len(submissions) > 0:
+        for (result_id, scoredef_id, value) in scores.values_list('result_id', 'scoredef_id', 'value'):
+            if result_id in submissions:
+                values.setdefault(result_id, {})[scoredef_id] = value
+    return [(submission, entry_pks.get(pk), pk in finished_pks, values.get(pk, {}))
+            for (pk, submission) in submissions.iteritems()]
+
+
+class LeaderboardRows(object):
+    """
+    The rows both leaderboards of a phase are ranked from: the layout of the leaderboard, and
+    the submissions on the leaderboard or finished with their user, team, result location and
+    raw scores. The rows of unfiltered leaderboards are stored in PhaseLeaderBoardRow, and
+    update_leaderboard_rows reads the rows of the submissions which changed again instead of
+    the whole phase.
+    """
+    # The changes of the rows of a submission: the rows of the leaderboard, the rows of all
+    # the finished submissions, and which submissions are finished.
+    CHANGES = frozenset(['board', 'all', 'finished'])
+
+    def __init__(self, layout, enable_teams):
+        self.layout = layout
+        self.enable_teams = enable_teams
+        # submission pk -> (username, user pk, team name, result location)
+        self.rows = {}
+        # submission pk -> pk of its leaderboard entry
+        self.entries = {}
+        self.finished = set()
+        # score definition pk -> {submission pk: value}
+        self.values = {}
+
+    @classmethod
+    def read(cls, phase, **kwargs):
+        """
+        Reads the rows of a phase from its submissions, leaderboard entries and scores. The
+        keyword arguments filter the score sets of the layout.
+        """
+        rows = cls(phase.leaderboard_layout(**kwargs), phase.competition.enable_teams)
+        PhaseLeaderBoard.objects.get_or_create(phase=phase)
+        rows._add_all(_read_leaderboard_rows(phase.pk))
+        return rows
+
+    @classmethod
+    def stored(cls, phase):
+        """
+        Reads the rows of a phase from its PhaseLeaderBoardRows, which are stored first if
+        they are not up to date. The layout is cached (see leaderboard_layout_cache_key).
+        """
+        layout_key = leaderboard_layout_cache_key(phase.pk)
+        layout = cache.get(layout_key)
+        if layout is None:
+            layout = phase.leaderboard_layout()
+            cache.set(layout_key, layout, settings.LEADERBOARD_CACHE_TIMEOUT)
+        rows = cls(layout, phase.competition.enable_teams)
+
+        lb, _ = PhaseLeaderBoard.objects.get_or_create(phase=phase)
+        if lb.rows_built_version != lb.rows_version:
+            with leaderboard_lock(phase.pk) as locked:
+                version = PhaseLeaderBoard.objects.filter(pk=lb.pk).values_list('rows_version', flat=True)[0]
+                read_rows = _read_leaderboard_rows(phase.pk)
+                if locked:
+                    PhaseLeaderBoardRow.objects.filter(phase=phase).delete()
+                    PhaseLeaderBoardRow.objects.bulk_create([
+                        PhaseLeaderBoardRow(phase=phase, submission=submission, entry_pk=entry_pk,
+                                            is_finished=is_finished, scores=_dump_leaderboard_scores(values))
+                        for (submission, entry_pk, is_finished, values) in read_rows])
+                    # The rows are stale again if they changed while the lock was held by nobody.
+                    PhaseLeaderBoard.objects.filter(pk=lb.pk).update(rows_built_version=version)
+            rows._add_all(read_rows)
+            return rows
+
+        qs = PhaseLeaderBoardRow.objects.filter(phase=phase).select_related('submission__participant__user',
+                                                                            'submission__team')
+        rows._add_all((row.submission, row.entry_pk, row.is_finished, _load_leaderboard_scores(row.scores))
+                      for row in qs)
+        return rows
+
+    @classmethod
+    def update_stored(cls, phase_pk, submission_pks):
+        """
+        Reads the rows of the given submissions of a phase again and stores them. The caller
+        holds the leaderboard lock of the phase. Returns the set of CHANGES which happened.
+        """
+        submission_pks = set(submission_pks)
+        stored = dict((row.submission_id, row)
+                      for row in PhaseLeaderBoardRow.objects.filter(submission__pk__in=submission_pks))
+        read_rows = dict((submission.pk, (entry_pk, is_finished, values))
+                         for (submission, entry_pk, is_finished, values)
+                         in _read_leaderboard_rows(phase_pk, submission_pks))
+        changes = set()
+        for pk in submission_pks:
+            row = stored.get(pk)
+            before = cls._stored_state(row)
+            if pk in read_rows:
+                if row is None:
+                    row = PhaseLeaderBoardRow(phase_id=phase_pk, submission_id=pk)
+                (entry_pk, is_finished, values) = read_rows[pk]
+                row.entry_pk, row.is_finished, row.scores = entry_pk, is_finished, _dump_leaderboard_scores(values)
+                after = cls._stored_state(row)
+                if after != before:
+                    row.save()
+            else:
+                after = cls._stored_state(None)
+                if row is not None:
+                    row.delete()
+            changes.update(change for change in cls.CHANGES if before[change] != after[change])
+        return changes
+
+    @staticmethod
+    def _stored_state(row):
+        if row is None:
+            return {'board': None, 'all': None, 'finished': False}
+        return {
+            'board': (row.entry_pk, row.scores) if row.entry_pk is not None else None,
+            'all': row.scores if row.is_finished else None,
+            'finished': row.is_finished,
+        }
+
+    def _add_all(self, rows):
+        for (submission, entry_pk, is_finished, values) in rows:
+            if entry_pk is not None:
+                self.entries[submission.pk] = entry_pk
+            if is_finished:
+                self.finished.add(submission.pk)
+            self.rows[submission.pk] = self._row(submission)
+            for (sdef_id, value) in values.iteritems():
+                if sdef_id in self.layout['scoredefs']:
+                    self.values.setdefault(sdef_id, {})[submission.pk] = value
+
+    def _row(self, submission):
+        user, team = submission.participant.user, submission.team
+        if self.enable_teams:
+            team_name = team.name if team is not None else ''
+        else:
+            team_name = user.team_name
+        return (user.username, user.pk, team_name, submission.file.name)
+
+    def ranked(self, include_scores_not_on_leaderboard=False):
+        """
+        Returns the ranked leaderboard groups, as CompetitionPhase.scores does.
+        """
+        if include_scores_not_on_leaderboard:
+            submission_ids = sorted(self.finished)
+        else:
+            submission_ids = sorted(self.entries, key=self.entries.get)
+
+        results = []
+        for group in self.layout['groups']:
+            scores = {}
+            # add the location of the results on the blob storage to the scores
+            for pk in submission_ids:
+                (username, user_pk, team_name, result_location) = self.rows[pk]
+                scores[pk] = {
+                    'username': username,
+                    'user_pk': user_pk,
+                    'team_name': team_name,
+                    'id': pk,
+                    'values': [],
+                    'resultLocation': result_location
+                }
+            results.append(dict(group, headers=copy.deepcopy(group['headers']), scoredefs=list(group['scoredefs']),
+                                scores=scores))
+
+        if len(submission_ids) > 0:
+            not_computed_scoredefs = self.layout['scoredefs']
+            computed_deps = self.layout['computed_deps']
+            # Keep the scores of the submissions on this leaderboard
             values = {}
-            scoredef_ids = [sdef_id for (sdef_id, sdef) in not_computed_scoredefs.iteritems()]
-            for s in SubmissionScore.objects.filter(scoredef_id__in=scoredef_ids, result_id__in=submission_ids):
-                if s.scoredef_id not in values:
-                    values[s.scoredef_id] = {}
-                values[s.scoredef_id][s.result_id] = s.value
-
-            # rank values per scoredef.key (not computed)
-            ranks = {}
-            for (sdef_id, v) in values.iteritems():
-                sdef = not_computed_scoredefs[sdef_id]
-                ranks[sdef_id] = self.rank_values(submission_ids, v, sort_ascending=sdef.sorting=='asc')
+            for (sdef_id, column) in self.values.iteritems():
+                known = dict((pk, column[pk]) for pk in submission_ids if pk in column)
+                if known:
+                    values[sdef_id] = known
+
+            # rank values per scoredef.key (not computed) as a single submissions x scoredefs matrix
+            ranked_scoredef_ids = values.keys()
+            columns = [(values[sdef_id], not_computed_scoredefs[sdef_id].sorting == 'asc') for sdef_id in ranked_scoredef_ids]
+            ranks = dict(zip(ranked_scoredef_ids, ranking.rank_columns(submission_ids, columns)))
 
             # compute values for computed scoredefs
             for result in results:
@@ -942,11 +1478,9 @@ class CompetitionPhase(models.Model):
                         if (operation.name == 'Avg'):
                             cnt = len(computed_deps[sdef.id])
                             if (cnt > 0):
-                                computed_values = {}
-                                for id in submission_ids:
-                                    computed_values[id] = sum([ranks[d.id][id] for d in computed_deps[sdef.id]]) / float(cnt)
+                                computed_values = ranking.average_ranks(submission_ids, [ranks[d.id] for d in computed_deps[sdef.id]])
                                 values[sdef.id] = computed_values
-                                ranks[sdef.id] = self.rank_values(submission_ids, computed_values, sort_ascending=sdef.sorting=='asc')
+                                ranks[sdef.id] = ranking.rank_values(submission_ids, computed_values, sort_ascending=sdef.sorting=='asc')
 
             #format values
             for result in results:
@@ -971,7 +1505,7 @@ class CompetitionPhase(models.Model):
                             scores[id]['values'].append({'val': v, 'hidden_rnk': r, 'name' : sdef.key})
                     if (sdef.key == result['selection_key']):
                         overall_ranks = ranks[sdef.id]
-                ranked_submissions = sorted(submission_ids, cmp=CompetitionPhase.rank_submissions(overall_ranks))
+                ranked_submissions = ranking.order_submissions(submission_ids, overall_ranks)
                 final_scores = [(overall_ranks[id], scores[id]) for id in ranked_submissions]
                 result['scores'] = final_scores
                 del result['scoredefs']
@@ -1737,6 +2271,9 @@ class SubmissionScore(models.Model):
 class PhaseLeaderBoard(models.Model):
     phase = models.OneToOneField(CompetitionPhase,related_name='board')
     is_open = models.BooleanField(default=True)
+    # The stored leaderboard rows of the phase are up to date when both versions are equal.
+    rows_version = models.IntegerField(default=0)
+    rows_built_version = models.IntegerField(null=True, blank=True)
 
     def submissions(self):
         return CompetitionSubmission.objects.filter(leaderboard_entry_result__board=self)
@@ -1762,9 +2299,26 @@ class PhaseLeaderBoardEntry(models.Model):
         unique_together = (('board', 'result'),)
 
 
+class PhaseLeaderBoardRow(models.Model):
+    """
+    The stored leaderboard row of a submission which is on the leaderboard of its phase or
+    finished. The leaderboards of the phase are ranked from these rows (see LeaderboardRows).
+    """
+    phase = models.ForeignKey(CompetitionPhase, related_name='leaderboard_rows')
+    submission = models.OneToOneField(CompetitionSubmission, related_name='leaderboard_row')
+    # The pk of the leaderboard entry of the submission, which orders the leaderboard.
+    entry_pk = models.IntegerField(null=True, blank=True)
+    is_finished = models.BooleanField(default=False)
+    # The scores of the submission, as a JSON object mapping score definition pks to values.
+    scores = models.TextField(default='{}')
+
+
 def dataset_data_file(dataset, filename="data.zip"):
     return os.path.join("datasets", str(dataset.pk), str(uuid.uuid4()), filename)
 
+def dataset_composite_archive_file(dataset, filename="archive.zip"):
+    return os.path.join("datasets", str(dataset.pk), "archives", str(uuid.uuid4()), filename)
+
 
 class OrganizerDataSet(models.Model):
     TYPES = (
@@ -1786,6 +2340,14 @@ class OrganizerDataSet(models.Model):
     sub_data_files = models.ManyToManyField('OrganizerDataSet', null=True, blank=True, verbose_name="Bundle of data files")
     uploaded_by = models.ForeignKey(settings.AUTH_USER_MODEL)
     key = UUIDField(version=4)
+    # Prebuilt zip of the sub_data_files and the hash of the manifest it was built from
+    composite_archive = models.FileField(
+        upload_to=dataset_composite_archive_file,
+        storage=BundleStorage,
+        blank=True,
+        null=True,
+    )
+    composite_archive_hash = models.CharField(max_length=40, null=True, blank=True)
 
     def save(self, **kwargs):
         if self.key is None or self.key == '':
@@ -1795,6 +2357,116 @@ class OrganizerDataSet(models.Model):
     def __unicode__(self):
         return "%s uploaded by %s" % (self.name, self.uploaded_by)
 
+    def get_composite_members(self):
+        """
+        Returns a list of (name in archive, data file) pairs for the sub_data_files of this dataset.
+        """
+        members = []
+        for sub_dataset in self.sub_data_files.all().order_by('pk'):
+            file_dir, file_name = os.path.split(sub_dataset.data_file.name)
+            members.append((file_name, sub_dataset.data_file))
+        return members
+
+    def get_composite_manifest_hash(self, members=None):
+        """
+        Returns a hash identifying the content of the composite archive: the names and blobs of
+        its members. Data files are stored under unique names, so a new upload changes the hash.
+        """
+        if members is None:
+            members = self.get_composite_members()
+        manifest = "\n".join("%s:%s" % (file_name, data_file.name) for (file_name, data_file) in members)
+        return hashlib.sha1(manifest.encode('utf-8')).hexdigest()
+
+    def has_current_composite_archive(self):
+        """
+        Returns True if the prebuilt composite archive matches the current sub_data_files.
+        """
+        return (bool(self.composite_archive.name) and
+                self.composite_archive_hash == self.get_composite_manifest_hash())
+
+    def get_composite_archive_stream(self, members=None):
+        """
+        Returns a ZipStream of the sub_data_files of this dataset.
+        """
+        if members is None:
+            members = self.get_composite_members()
+        zip_stream = zipstream.ZipStream()
+        for file_name, data_file in members:
+            zip_stream.add(file_name, stored_file_reader(data_file), size=data_file.size)
+        return zip_stream
+
+    def build_composite_archive(self):
+        """
+        Builds the zip of the sub_data_files and stores it as the composite archive, unless the
+        stored archive already matches the current members.
+        """
+        members = self.get_composite_members()
+        manifest_hash = self.get_composite_manifest_hash(members)
+        if self.composite_archive.name and self.composite_archive_hash == manifest_hash:
+            return False
+        old_archive_name = self.composite_archive.name
+        with tempfile.TemporaryFile() as archive_file:
+            for data in self.get_composite_archive_stream(members):
+                archive_file.write(data)
+            archive_file.seek(0)
+            name = self.composite_archive.storage.save(dataset_composite_archive_file(self), File(archive_file))
+        # Update the columns directly so member and M2M signals are not triggered again.
+        OrganizerDataSet.objects.filter(pk=self.pk).update(composite_archive=name, composite_archive_hash=manifest_hash)
+        self.composite_archive.name = name
+        self.composite_archive_hash = manifest_hash
+        if old_archive_name:
+            try:
+                self.composite_archive.storage.delete(old_archive_name)
+            except Exception:
+                logger.exception("Failed to delete stale composite archive %s (dataset_id=%s)", old_archive_name, self.pk)
+        return True
+
+
+def stored_file_reader(field_file):
+    """
+    Returns a callable reading a stored file in chunks, so zip members backed by blobs are only
+    opened when a ZipStream reaches them.
+    """
+    name, storage = field_file.name, field_file.storage
+    return lambda: zipstream.file_chunks(storage.open(name))
+
+
+def invalidate_dataset_archives(dataset_pks, rebuild=True):
+    """
+    Marks the composite archives of the given datasets as stale and, if rebuild is True, starts
+    building them again in the background.
+    """
+    dataset_pks = list(dataset_pks)
+    if len(dataset_pks) == 0:
+        return
+    OrganizerDataSet.objects.filter(pk__in=dataset_pks).update(composite_archive_hash=None)
+    if rebuild:
+        from tasks import build_dataset_archive
+        for dataset_pk in dataset_pks:
+            build_dataset_archive(dataset_pk)
+
+def _invalidate_composite_archives(sender, instance, action, reverse, pk_set, **kwargs):
+    """Invalidates composite archives whose sub_data_files changed."""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # instance was added to or removed from the composites in pk_set
+        dataset_pks = pk_set or []
+    else:
+        dataset_pks = [instance.pk]
+    invalidate_dataset_archives(dataset_pks, rebuild=action != 'post_clear')
+
+def _invalidate_member_composite_archives(sender, instance, created, **kwargs):
+    """Invalidates the composite archives containing a dataset whose data file changed."""
+    if created:
+        return
+    stale = [composite.pk for composite in OrganizerDataSet.objects.filter(sub_data_files__pk=instance.pk)
+             if composite.composite_archive_hash != composite.get_composite_manifest_hash()]
+    invalidate_dataset_archives(stale)
+
+m2m_changed.connect(_invalidate_composite_archives, sender=OrganizerDataSet.sub_data_files.through)
+post_save.connect(_invalidate_member_composite_archives, sender=OrganizerDataSet)
+
 
 class CompetitionSubmissionMetadata(models.Model):
     submission = models.ForeignKey(CompetitionSubmission, related_name="metadatas")
@@ -1838,6 +2510,62 @@ class CompetitionSubmissionMetadata(models.Model):
         }
 
 
+class ScheduledRunManager(models.Manager):
+    """
+    Adds the sets of runs the compute scheduler works with to the default Django Manager.
+    """
+    def queued(self):
+        """Runs waiting in the ready-list."""
+        return self.filter(dispatched_at__isnull=True, completed_at__isnull=True)
+
+    def in_flight(self):
+        """Runs sent to the compute workers which have neither completed nor expired."""
+        return self.filter(dispatched_at__isnull=False, completed_at__isnull=True, expires_at__gt=now())
+
+
+class ScheduledRun(models.Model):
+    """
+    A run of a submission in the ready-list of the compute scheduler. See apps.web.scheduling.
+    """
+    # Priority classes, from the most urgent to the least urgent.
+    INTERACTIVE = 0
+    RERUN = 1
+    MIGRATION = 2
+    PRIORITY_CHOICES = (
+        (INTERACTIVE, 'Interactive'),
+        (RERUN, 'Re-run'),
+        (MIGRATION, 'Migration'),
+    )
+
+    job = models.ForeignKey('jobs.Job', related_name='scheduled_runs')
+    submission = models.ForeignKey(CompetitionSubmission, related_name='scheduled_runs')
+    competition = models.ForeignKey(Competition, related_name='scheduled_runs')
+    participant = models.ForeignKey(CompetitionParticipant, related_name='scheduled_runs')
+    priority = models.PositiveSmallIntegerField(choices=PRIORITY_CHOICES, default=INTERACTIVE)
+    # JSON-encoded message sent to the compute queue.
+    message = models.TextField()
+    queued_at = models.DateTimeField(auto_now_add=True)
+    dispatched_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = ScheduledRunManager()
+
+    def __unicode__(self):
+        return "ScheduledRun(job=%s, priority=%s)" % (self.job_id, self.priority)
+
+
+class SchedulerLock(models.Model):
+    """
+    The row which the site workers lock to dispatch scheduled runs one at a time. See
+    apps.web.scheduling.
+    """
+    name = models.CharField(max_length=32, unique=True)
+
+    def __unicode__(self):
+        return "SchedulerLock(%s)" % self.name
+
+
 def add_submission_to_leaderboard(submission):
     """
     Adds the given submission to its leaderboard. It is the caller responsiblity to make
@@ -1853,4 +2581,124 @@ def add_submission_to_leaderboard(submission):
     for entry in entries:
         entry.delete()
     lbe, created = PhaseLeaderBoardEntry.objects.get_or_create(board=lb, result=submission)
+    submission.phase.refresh_leaderboard()
     return lbe, created
+
+
+# Leaderboard invalidation
+
+def _invalidate_phase_leaderboards(sender, instance, **kwargs):
+    """Invalidates the leaderboards of the phase of a result group which changed."""
+    invalidate_leaderboards([instance.phase_id])
+
+# The fields of a submission listed in the coopetition files besides its status. completed_at
+# is left out: it is set again by every save of a finished submission, and only matters when
+# the submission finishes.
+COOPETITION_SUBMISSION_FIELDS = ('participant_id', 'when_made_public', 'when_unmade_public', 'started_at',
+                                 'download_count', 'submission_number')
+
+def _submission_cached_state(submission):
+    """
+    Returns the fields of a submission its leaderboard rows are made of, and the fields listed
+    in the coopetition files. They are read from the instance dict so deferred fields are not
+    loaded.
+    """
+    file_name = submission.__dict__.get('file')
+    leaderboard_state = (submission.__dict__.get('status_id'),
+                         (submission.__dict__.get('team_id'), getattr(file_name, 'name', file_name)))
+    coopetition_state = tuple(submission.__dict__.get(name) for name in COOPETITION_SUBMISSION_FIELDS)
+    return leaderboard_state, coopetition_state
+
+def _remember_submission_cached_state(sender, instance, **kwargs):
+    instance._cached_state = _submission_cached_state(instance)
+
+def _update_submission_leaderboard(sender, instance, created, **kwargs):
+    """
+    Updates the leaderboard rows of a submission whose status changed, drops the ranked
+    leaderboards if its team or file changed, and drops the coopetition submissions file if a
+    finished submission listed in it changed. Other saves, such as the files saved while a
+    submission is scored, leave the cached files alone.
+    """
+    leaderboard_state, coopetition_state = _submission_cached_state(instance)
+    previous_leaderboard_state, previous_coopetition_state = getattr(instance, '_cached_state', (None, None))
+    instance._cached_state = (leaderboard_state, coopetition_state)
+    if created:
+        # New submissions are not finished yet, but they are counted in the coopetition files.
+        invalidate_coopetition_files([instance.phase_id], ['submissions'])
+        return
+    (status_id, shown_state) = leaderboard_state
+    (previous_status_id, previous_shown_state) = previous_leaderboard_state or (None, None)
+    if status_id != previous_status_id:
+        update_leaderboard_rows(instance.phase_id, [instance.pk])
+    if shown_state != previous_shown_state:
+        # The names and result locations are read with the stored rows, not stored in them.
+        invalidate_ranked_leaderboards(instance.phase_id, ['board', 'all'])
+    if coopetition_state != previous_coopetition_state and \
+            instance.status.codename == CompetitionSubmissionStatus.FINISHED:
+        invalidate_coopetition_files([instance.phase_id], ['submissions'])
+
+# The submissions being deleted by this thread. Their scores and leaderboard entries are
+# deleted first, and must not store the rows of the submissions again.
+_deleted_submissions = threading.local()
+
+def _deleted_submission_pks():
+    if not hasattr(_deleted_submissions, 'pks'):
+        _deleted_submissions.pks = set()
+    return _deleted_submissions.pks
+
+def _remember_deleted_submission(sender, instance, **kwargs):
+    _deleted_submission_pks().add(instance.pk)
+
+def _remove_submission_from_leaderboard(sender, instance, **kwargs):
+    """Drops the ranked leaderboards of the phase of a submission which was deleted with its stored row."""
+    _deleted_submission_pks().discard(instance.pk)
+    invalidate_ranked_leaderboards(instance.phase_id, LeaderboardRows.CHANGES)
+
+def _update_entry_leaderboard(sender, instance, **kwargs):
+    """Updates the leaderboard rows of a submission added to or removed from its leaderboard."""
+    if instance.result_id in _deleted_submission_pks():
+        return
+    for phase_pk in PhaseLeaderBoard.objects.filter(pk=instance.board_id).values_list('phase_id', flat=True):
+        update_leaderboard_rows(phase_pk, [instance.result_id])
+
+def _update_score_leaderboard(sender, instance, **kwargs):
+    """Updates the leaderboard rows of a submission whose scores changed."""
+    if instance.result_id in _deleted_submission_pks():
+        return
+    for phase_pk in CompetitionSubmission.objects.filter(pk=instance.result_id).values_list('phase_id', flat=True):
+        update_leaderboard_rows(phase_pk, [instance.result_id])
+
+def _invalidate_reaction_coopetition_files(sender, instance, **kwargs):
+    """Invalidates the coopetition submissions file of the phase holding a submission which was liked or disliked."""
+    invalidate_coopetition_files(CompetitionSubmission.objects.filter(pk=instance.submission_id).values_list('phase_id', flat=True),
+                                 ['submissions'])
+
+def _invalidate_coopetition_downloads(sender, instance, **kwargs):
+    """Invalidates the coopetition downloads file of the competition holding a submission which was downloaded."""
+    competition_pks = CompetitionSubmission.objects.filter(pk=instance.submission_id) \
+                                                   .values_list('phase__competition_id', flat=True)
+    cache.delete_many([coopetition_downloads_cache_key(pk) for pk in competition_pks])
+
+def _invalidate_score_defs(sender, instance, **kwargs):
+    """Invalidates the cached score definitions of a competition whose score definitions changed."""
+    cache.delete(score_defs_cache_key(instance.competition_id))
+
+def _invalidate_competition_leaderboards(sender, instance, **kwargs):
+    """Invalidates all the leaderboards of a competition whose leaderboard definition changed."""
+    competition_id = instance.pk if sender is Competition else instance.competition_id
+    invalidate_leaderboards(CompetitionPhase.objects.filter(competition__pk=competition_id).values_list('pk', flat=True))
+
+post_init.connect(_remember_submission_cached_state, sender=CompetitionSubmission)
+post_save.connect(_update_submission_leaderboard, sender=CompetitionSubmission)
+pre_delete.connect(_remember_deleted_submission, sender=CompetitionSubmission)
+post_delete.connect(_remove_submission_from_leaderboard, sender=CompetitionSubmission)
+for signal in (post_save, post_delete):
+    signal.connect(_invalidate_phase_leaderboards, sender=SubmissionResultGroupPhase)
+    signal.connect(_update_entry_leaderboard, sender=PhaseLeaderBoardEntry)
+    signal.connect(_update_score_leaderboard, sender=SubmissionScore)
+    signal.connect(_invalidate_score_defs, sender=SubmissionScoreDef)
+    signal.connect(_invalidate_reaction_coopetition_files, sender=Like)
+    signal.connect(_invalidate_reaction_coopetition_files, sender=Dislike)
+    signal.connect(_invalidate_coopetition_downloads, sender=DownloadRecord)
+    for leaderboard_definition in (Competition, SubmissionResultGroup, SubmissionScoreDef, SubmissionScoreSet):
+        signal.connect(_invalidate_competition_leaderboards, sender=leaderboard_definition)
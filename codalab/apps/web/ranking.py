@@ -0,0 +1,179 @@
+"""
+Ranking engine used to build phase leaderboards.
+
+Scores of a leaderboard are ranked as a submissions x scoredefs matrix. When NumPy is available
+the sorting, tie detection, averaging and final ordering are done with array operations;
+otherwise an equivalent pure-Python implementation is used. Callers can pick a backend with
+the `backend` argument. Both backends produce identical output: values are compared as floats and two values share a rank when they are within `eps`
+of the first value of their group.
+"""
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_EPS = 1.0e-12
+
+# Backends of the ranking functions.
+NUMPY = 'numpy'
+PYTHON = 'python'
+
+# Rank given to a submission whose rank cannot be interpreted as an integer when ordering.
+UNRANKED = 1000000
+
+
+def _use_numpy(backend):
+    """
+    Tells whether the given backend is NumPy. None selects NumPy when it is installed and
+    Python otherwise.
+    """
+    if backend is None:
+        return numpy is not None
+    if backend == NUMPY:
+        if numpy is None:
+            raise ValueError("The NumPy ranking backend requires NumPy.")
+        return True
+    if backend == PYTHON:
+        return False
+    raise ValueError("Unknown ranking backend: %s" % backend)
+
+
+def rank_values(ids, id_value_pairs, sort_ascending=True, eps=DEFAULT_EPS, backend=None):
+    """
+    Given a set of identifiers (ids) and a set of (id, value)-pairs computes a ranking based
+    on the value. The ranking is provided as a dict of (id, rank) pairs for all id in ids.
+    """
+    return rank_columns(ids, [(id_value_pairs, sort_ascending)], eps=eps, backend=backend)[0]
+
+
+def rank_columns(ids, columns, eps=DEFAULT_EPS, backend=None):
+    """
+    Ranks several score columns for the same submissions.
+
+    ids: list of submission identifiers.
+    columns: list of (id_value_pairs, sort_ascending) tuples, one per score column.
+    backend: NUMPY, PYTHON or None for NumPy when it is installed.
+    Returns a list of {id: rank} dicts in the order of the columns.
+    """
+    if not _use_numpy(backend):
+        return [_rank_values_python(ids, pairs, ascending, eps) for (pairs, ascending) in columns]
+    return _rank_columns_numpy(ids, columns, eps)
+
+
+def average_ranks(ids, rank_dicts, backend=None):
+    """
+    Returns a dict mapping each id to the average of its ranks in the given rankings.
+    """
+    cnt = len(rank_dicts)
+    if not _use_numpy(backend):
+        return {id: sum([ranks[id] for ranks in rank_dicts]) / float(cnt) for id in ids}
+    matrix = numpy.array([[ranks[id] for id in ids] for ranks in rank_dicts], dtype=numpy.int64)
+    averages = (matrix.sum(axis=0) / float(cnt)).tolist()
+    return dict(zip(ids, averages))
+
+
+def order_submissions(ids, ranks_by_id, backend=None):
+    """
+    Returns the ids sorted by their rank. Submissions with the same rank keep their relative
+    order and ranks which are not integers are placed last.
+    """
+    keys = [rank_key(ranks_by_id[id]) for id in ids]
+    if not _use_numpy(backend):
+        return [id for (key, id) in sorted(zip(keys, ids), key=operator.itemgetter(0))]
+    order = numpy.argsort(numpy.array(keys, dtype=numpy.int64), kind='mergesort')
+    return [ids[i] for i in order.tolist()]
+
+
+def rank_key(rank):
+    """
+    Returns the integer used to order a submission with the given rank.
+    """
+    try:
+        return int(rank)
+    except ValueError:
+        return UNRANKED
+
+
+def _rank_values_python(ids, id_value_pairs, sort_ascending, eps):
+    ranks = {}
+    # Only keep pairs for which the key is in the list of ids
+    id_set = set(ids)
+    valid_pairs = [(k, float(v)) for k, v in id_value_pairs.iteritems() if k in id_set]
+    if len(valid_pairs) == 0:
+        return {id: 1 for id in ids}
+    # Sort and compute ranks
+    sorted_pairs = sorted(valid_pairs, key=operator.itemgetter(1), reverse=not sort_ascending)
+    r = 1
+    k, v = sorted_pairs[0]
+    ranks[k] = r
+    for i in range(1, len(sorted_pairs)):
+        k, vnow = sorted_pairs[i]
+        # Increment the rank only when values are different
+        if abs(vnow - v) > eps:
+            r = r + 1
+            v = vnow
+        ranks[k] = r
+    # Fill in ranks for ids which were not seen in the input
+    r = r + 1
+    for id in ids:
+        if id not in ranks:
+            ranks[id] = r
+    return ranks
+
+
+def _rank_columns_numpy(ids, columns, eps):
+    n, m = len(ids), len(columns)
+    if n == 0 or m == 0:
+        return [{} for _ in columns]
+    index = {id: i for i, id in enumerate(ids)}
+
+    # Build the value matrix; missing values are NaN, which argsort places last.
+    matrix = numpy.empty((n, m), dtype=numpy.float64)
+    matrix.fill(numpy.nan)
+    for j, (pairs, ascending) in enumerate(columns):
+        sign = 1.0 if ascending else -1.0
+        for k, v in pairs.iteritems():
+            i = index.get(k)
+            if i is not None:
+                matrix[i, j] = sign * float(v)
+    present = ~numpy.isnan(matrix)
+    counts = present.sum(axis=0)
+
+    cols = numpy.arange(m)
+    order = numpy.argsort(matrix, axis=0, kind='mergesort')
+    sorted_values = matrix[order, cols]
+
+    # A new rank starts where a value is more than eps away from the first value of its group.
+    # Consecutive differences give the group boundaries unless a run of close values spans
+    # more than eps, in which case the column is ranked with the sequential rule.
+    starts = numpy.ones((n, m), dtype=bool)
+    rows = numpy.arange(n)[:, numpy.newaxis]
+    with numpy.errstate(invalid='ignore'):
+        starts[1:] = numpy.abs(numpy.diff(sorted_values, axis=0)) > eps
+        group_first = numpy.maximum.accumulate(numpy.where(starts, rows, 0), axis=0)
+        overflow = numpy.abs(sorted_values - sorted_values[group_first, cols]) > eps
+    for j in numpy.nonzero(overflow.any(axis=0))[0].tolist():
+        starts[:, j] = _sequential_starts(sorted_values[:counts[j], j], eps, n)
+
+    sorted_ranks = numpy.cumsum(starts, axis=0)
+    # Missing values share the rank after the last present value.
+    missing_rank = numpy.where(counts > 0, sorted_ranks[numpy.maximum(counts - 1, 0), cols] + 1, 1)
+    sorted_ranks = numpy.where(rows < counts, sorted_ranks, missing_rank)
+
+    ranks = numpy.empty((n, m), dtype=numpy.int64)
+    ranks[order, cols] = sorted_ranks
+    return [dict(zip(ids, ranks[:, j].tolist())) for j in range(m)]
+
+
+def _sequential_starts(sorted_values, eps, n):
+    starts = numpy.zeros(n, dtype=bool)
+    starts[0] = True
+    values = sorted_values.tolist()
+    v = values[0] if values else None
+    for i in range(1, len(values)):
+        if abs(values[i] - v) > eps:
+            starts[i] = True
+            v = values[i]
+    return starts
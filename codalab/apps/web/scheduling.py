@@ -0,0 +1,176 @@
+"""
+Schedules the runs of submissions on the compute workers.
+
+Runs are not sent to the compute queue as soon as they are requested: they wait in a ready-list
+(ScheduledRun) and are sent to the queue only while fewer than COMPUTE_MAX_IN_FLIGHT runs are in
+flight. The compute queue stays short, so the order in which runs start is decided here rather
+than by the queue. The next run is chosen by priority class first (interactive submissions, then
+re-runs, then migrations), then by fair share (the competition, then the participant, with the
+fewest runs in flight), then by age. A competition never has more runs in flight than its cap:
+Competition.max_concurrent_runs or, by default, COMPUTE_COMPETITION_MAX_IN_FLIGHT.
+
+A run leaves the in-flight set when its compute worker reports that it completed, or once it has
+been in flight for longer than its time limit plus COMPUTE_RUN_GRACE_PERIOD, which covers workers
+that died without reporting. Runs are dispatched when one is scheduled or completes and, so that
+expired runs make room during quiet periods, every COMPUTE_DISPATCH_INTERVAL seconds by the site
+worker. Site workers claim runs one at a time, holding the lock of the SchedulerLock row, so that
+concurrent dispatches never send more runs than the caps allow; the claimed runs are sent once the
+claims are committed and the lock is released.
+"""
+import datetime
+import json
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils.timezone import now
+
+from apps.jobs.models import Job, getQueue
+from apps.web.models import CompetitionSubmissionStatus, ScheduledRun, SchedulerLock
+
+logger = logging.getLogger(__name__)
+
+# Name of the SchedulerLock row held while runs are dispatched.
+DISPATCH_LOCK = 'dispatch'
+
+
+def schedule_run(submission, job_id, body):
+    """
+    Adds a run to the ready-list and dispatches the runs which can start.
+
+    submission: The CompetitionSubmission object the run evaluates.
+    job_id: The ID of the evaluation job; its 'priority' task argument is the priority class of
+        the run.
+    body: The JSON-encoded message to send to the compute queue.
+    """
+    priority = Job.objects.get(pk=job_id).get_task_args().get('priority', ScheduledRun.INTERACTIVE)
+    ScheduledRun.objects.create(job_id=job_id,
+                                submission=submission,
+                                competition_id=submission.phase.competition_id,
+                                participant_id=submission.participant_id,
+                                priority=priority,
+                                message=body)
+    dispatch_runs()
+
+
+def complete_runs(job_id):
+    """
+    Removes the runs of a job from the in-flight set once its compute worker reported a final status.
+    """
+    ScheduledRun.objects.filter(job__pk=job_id, dispatched_at__isnull=False, completed_at__isnull=True) \
+                        .update(completed_at=now())
+
+
+def _claim(run_id, message):
+    """Marks a queued run as dispatched. Returns False if another site worker dispatched it first."""
+    execution_time_limit = json.loads(message)['task_args']['execution_time_limit']
+    dispatched_at = now()
+    expires_at = dispatched_at + datetime.timedelta(seconds=execution_time_limit + settings.COMPUTE_RUN_GRACE_PERIOD)
+    return ScheduledRun.objects.filter(pk=run_id, dispatched_at__isnull=True) \
+                               .update(dispatched_at=dispatched_at, expires_at=expires_at) == 1
+
+
+def _lock_dispatch():
+    """Waits until no other site worker dispatches runs, until the end of the transaction."""
+    if not list(SchedulerLock.objects.select_for_update().filter(name=DISPATCH_LOCK)):
+        # Databases created without the migrations lack the row.
+        SchedulerLock.objects.get_or_create(name=DISPATCH_LOCK)
+        list(SchedulerLock.objects.select_for_update().filter(name=DISPATCH_LOCK))
+
+
+def dispatch_runs():
+    """
+    Sends the next runs of the ready-list to the compute queue while there is room in flight.
+
+    The runs are claimed in a transaction of their own and sent after it is committed, so other
+    site workers do not wait for the lock while messages are sent. A claimed run whose message is
+    lost expires like the runs of dead workers. Nothing is dispatched from inside a transaction,
+    which the claims would commit: the next dispatch sends the runs.
+
+    Returns the number of runs sent.
+    """
+    if transaction.is_managed():
+        logger.debug("Not dispatching scheduled runs inside a transaction.")
+        return 0
+    with transaction.commit_on_success():
+        _lock_dispatch()
+        claimed = _claim_runs()
+    sent = 0
+    for run_id, message in claimed:
+        try:
+            getQueue(settings.SBS_COMPUTE_QUEUE).send_message(message)
+        except Exception:
+            logger.exception("Failed to dispatch scheduled run (run_id=%s); it stays in the ready-list.", run_id)
+            unsent = [unsent_id for (unsent_id, unsent_message) in claimed[sent:]]
+            ScheduledRun.objects.filter(pk__in=unsent).update(dispatched_at=None, expires_at=None)
+            break
+        sent += 1
+    if sent > 0:
+        logger.info("Dispatched %d scheduled run(s).", sent)
+    return sent
+
+
+def dispatch_runs_periodically(stopped, interval=None):
+    """
+    Dispatches runs every COMPUTE_DISPATCH_INTERVAL seconds until the stopped Event is set.
+    """
+    if interval is None:
+        interval = settings.COMPUTE_DISPATCH_INTERVAL
+    while not stopped.wait(interval):
+        try:
+            dispatch_runs()
+        except Exception:
+            logger.exception("Failed to dispatch scheduled runs.")
+
+
+def _claim_runs():
+    """
+    Claims the next runs of the ready-list while there is room in flight. The caller holds the
+    dispatch lock. Returns the (run ID, message) pairs of the claimed runs, in dispatch order.
+    """
+    # Runs of submissions which failed or were cancelled while they waited never start.
+    ScheduledRun.objects.queued() \
+                        .filter(submission__status__codename__in=(CompetitionSubmissionStatus.FAILED,
+                                                                  CompetitionSubmissionStatus.CANCELLED)) \
+                        .update(completed_at=now())
+
+    in_flight = ScheduledRun.objects.in_flight()
+    room = None
+    if settings.COMPUTE_MAX_IN_FLIGHT is not None:
+        room = settings.COMPUTE_MAX_IN_FLIGHT - in_flight.count()
+        if room <= 0:
+            return []
+    competition_runs = dict((row['competition'], row['count'])
+                            for row in in_flight.values('competition').annotate(count=Count('pk')))
+    participant_runs = dict((row['participant'], row['count'])
+                            for row in in_flight.values('participant').annotate(count=Count('pk')))
+    candidates = list(ScheduledRun.objects.queued()
+                                          .order_by('priority', 'queued_at', 'pk')
+                                          .values_list('pk', 'priority', 'competition_id', 'participant_id',
+                                                       'competition__max_concurrent_runs', 'message'))
+    claimed = []
+    while len(candidates) > 0 and (room is None or len(claimed) < room):
+        best, best_key = None, None
+        for candidate in candidates:
+            run_id, priority, competition_id, participant_id, cap, message = candidate
+            if best is not None and priority > best[1]:
+                # Candidates are sorted by priority: only runs of the most urgent class compete.
+                break
+            if cap is None:
+                cap = settings.COMPUTE_COMPETITION_MAX_IN_FLIGHT
+            if cap is not None and competition_runs.get(competition_id, 0) >= cap:
+                continue
+            key = (competition_runs.get(competition_id, 0), participant_runs.get(participant_id, 0))
+            if best is None or key < best_key:
+                best, best_key = candidate, key
+        if best is None:
+            break
+        candidates.remove(best)
+        run_id, priority, competition_id, participant_id, cap, message = best
+        if not _claim(run_id, message):
+            continue
+        competition_runs[competition_id] = competition_runs.get(competition_id, 0) + 1
+        participant_runs[participant_id] = participant_runs.get(participant_id, 0) + 1
+        claimed.append((run_id, message))
+    return claimed
@@ -1,8 +1,7 @@
 """
 Defines background tasks needed by the web site.
 """
-import csv
-import io
+import datetime
 import json
 import logging
 import StringIO
@@ -14,16 +13,17 @@ from django.conf import settings
 from django.contrib.sites.models import get_current_site
 from django.core.files.base import ContentFile
 from django.core.mail import get_connection, EmailMultiAlternatives, send_mail
-from django.db import transaction
-from django.db.models import Count
+from django.db import IntegrityError, transaction
 from django.template import Context
 from django.template.loader import render_to_string
+from django.utils import timezone
 from django.contrib.sites.models import Site
 from apps.jobs.models import (Job,
                               run_job_task,
-                              JobTaskResult,
-                              getQueue)
+                              JobTaskResult)
 from apps.web.models import (add_submission_to_leaderboard,
+                             get_score_defs,
+                             update_leaderboard_rows,
                              Competition,
                              CompetitionSubmission,
                              CompetitionDefBundle,
@@ -40,9 +40,11 @@ from apps.web.models import (add_submission_to_leaderboard,
                              predict_submission_stdout_filename,
                              predict_submission_stderr_filename,
                              SubmissionScore,
-                             SubmissionScoreDef,
-                             CompetitionSubmissionMetadata)
-from apps.coopetitions.models import DownloadRecord
+                             CompetitionSubmissionMetadata,
+                             OrganizerDataSet,
+                             ScheduledRun)
+from apps.web.scheduling import complete_runs, dispatch_runs, schedule_run
+from codalabtools import parse_scores
 
 logger = logging.getLogger(__name__)
 
@@ -175,7 +177,7 @@ def predict(submission, job_id):
     # Store workflow state
     submission.execution_key = json.dumps({'predict' : job_id})
     submission.save()
-    # Submit the request to the computation service
+    # Submit the request to the computation service through the scheduler
     body = json.dumps({
         "id" : job_id,
         "task_type": "run",
@@ -188,7 +190,7 @@ def predict(submission, job_id):
         }
     })
 
-    getQueue(settings.SBS_COMPUTE_QUEUE).send_message(body)
+    schedule_run(submission, job_id, body)
     # Update the submission object
     _set_submission_status(submission.id, CompetitionSubmissionStatus.SUBMITTED)
 
@@ -239,57 +241,20 @@ def score(submission, job_id):
     coopetition_zip_buffer = StringIO.StringIO()
     coopetition_zip_file = zipfile.ZipFile(coopetition_zip_buffer, "w")
 
-    for phase in submission.phase.competition.phases.all():
-        coopetition_field_names = (
-            "participant__user__username",
-            "pk",
-            "when_made_public",
-            "when_unmade_public",
-            "started_at",
-            "completed_at",
-            "download_count",
-            "submission_number",
-        )
-        annotated_submissions = phase.submissions.filter(status__codename=CompetitionSubmissionStatus.FINISHED).values(
-            *coopetition_field_names
-        ).annotate(like_count=Count("likes"), dislike_count=Count("dislikes"))
-
-        # Add this after fetching annotated count from db
-        coopetition_field_names += ("like_count", "dislike_count")
-
-        coopetition_csv = StringIO.StringIO()
-        writer = csv.DictWriter(coopetition_csv, coopetition_field_names)
-        writer.writeheader()
-        for row in annotated_submissions:
-            writer.writerow(row)
-
-        coopetition_zip_file.writestr('coopetition_phase_%s.txt' % phase.phasenumber, coopetition_csv.getvalue().encode('utf-8'))
+    # The files of each phase are cached until its submissions, results, likes or downloads change.
+    competition = submission.phase.competition
+    phases = list(competition.phases.all())
+    for phase in phases:
+        coopetition_zip_file.writestr('coopetition_phase_%s.txt' % phase.phasenumber,
+                                      phase.get_coopetition_submissions_csv())
 
     # Scores metadata
-    for phase in submission.phase.competition.phases.all():
-        coopetition_zip_file.writestr(
-            'coopetition_scores_phase_%s.txt' % phase.phasenumber,
-            phase.competition.get_results_csv(phase.pk, include_scores_not_on_leaderboard=True).encode('utf-8')
-        )
+    for phase in phases:
+        coopetition_zip_file.writestr('coopetition_scores_phase_%s.txt' % phase.phasenumber,
+                                      phase.get_coopetition_scores_csv())
 
     # Download metadata
-    coopetition_downloads_csv = StringIO.StringIO()
-    writer = csv.writer(coopetition_downloads_csv)
-    writer.writerow((
-        "submission_pk",
-        "submission_owner",
-        "downloaded_by",
-        "time_of_download",
-    ))
-    for download in DownloadRecord.objects.filter(submission__phase__competition=submission.phase.competition):
-        writer.writerow((
-            download.submission.pk,
-            download.submission.participant.user.username,
-            download.user.username,
-            str(download.timestamp),
-        ))
-
-    coopetition_zip_file.writestr('coopetition_downloads.txt', coopetition_downloads_csv.getvalue().encode('utf-8'))
+    coopetition_zip_file.writestr('coopetition_downloads.txt', competition.get_coopetition_downloads_csv())
 
     # Current user
     coopetition_zip_file.writestr('current_user.txt', submission.participant.user.username.encode('utf-8'))
@@ -355,7 +320,7 @@ def score(submission, job_id):
     state['score'] = job_id
     submission.execution_key = json.dumps(state)
     submission.save()
-    # Submit the request to the computation service
+    # Submit the request to the computation service through the scheduler
     body = json.dumps({
         "id" : job_id,
         "task_type": "run",
@@ -367,10 +332,33 @@ def score(submission, job_id):
             "predict": False,
         }
     })
-    getQueue(settings.SBS_COMPUTE_QUEUE).send_message(body)
+    schedule_run(submission, job_id, body)
     if has_generated_predictions == False:
         _set_submission_status(submission.id, CompetitionSubmissionStatus.SUBMITTED)
 
+def _save_scores(submission, scores):
+    """
+    Saves the scores of a submission with one query. Scores whose key is not a score definition
+    of the competition are ignored.
+
+    submission: The CompetitionSubmission object.
+    scores: The (key, value) pairs of the scores.
+    """
+    score_defs = get_score_defs(submission.phase.competition_id)
+    values = {}
+    for key, value in scores:
+        if key not in score_defs:
+            logger.warning("Score %s does not exist (submission_id=%s)", key, submission.id)
+            continue
+        scoredef_id, computed = score_defs[key]
+        if computed and value:
+            raise IntegrityError("Score is computed. Cannot assign a value")
+        values[scoredef_id] = value
+    SubmissionScore.objects.bulk_create([SubmissionScore(result=submission, scoredef_id=pk, value=score_value)
+                                         for pk, score_value in values.items()])
+    # bulk_create sends no post_save signal.
+    update_leaderboard_rows(submission.phase_id, [submission.pk])
+
 class SubmissionUpdateException(Exception):
     """Defines an exception that occurs during the update of a CompetitionSubmission object."""
     def __init__(self, submission, inner_exception):
@@ -387,13 +375,15 @@ def update_submission_task(job_id, args):
         args['status']: The evaluation status, which is one of 'running', 'finished' or 'failed'.
     """
 
-    def update_submission(submission, status, job_id, traceback=None, metadata=None):
+    def update_submission(submission, status, job_id, traceback=None, metadata=None, scores=None):
         """
         Updates the status of a submission.
 
         submission: The CompetitionSubmission object to update.
         status: The new status string: 'running', 'finished' or 'failed'.
         job_id: The job ID used to track the progress of the evaluation.
+        scores: The (key, value) pairs of the scores.txt file of a scoring run, if the compute
+            worker sent them. They are read from output.zip otherwise.
         """
         state = {}
         if len(submission.execution_key) > 0:
@@ -424,28 +414,22 @@ def update_submission_task(job_id, args):
                 submission.private_output_file.name = pathname2url(submission_private_output_filename(submission))
                 submission.detailed_results_file.name = pathname2url(submission_detailed_results_filename(submission))
                 submission.save()
-                logger.debug("Retrieving output.zip and 'scores.txt' file (submission_id=%s)", submission.id)
-                logger.debug("Output.zip location=%s" % submission.output_file.file.name)
-                ozip = ZipFile(io.BytesIO(submission.output_file.read()))
-                scores = None
-                try:
-                    scores = open(ozip.extract('scores.txt'), 'r').read()
-                except Exception:
-                    logger.error("Scores.txt not found, unable to process submission: %s (submission_id=%s)", status, submission.id)
-                    _set_submission_status(submission.id, CompetitionSubmissionStatus.FAILED)
-                    return Job.FAILED
+                if scores is None:
+                    # The worker did not send the scores: read them from output.zip. The storage
+                    # reads its central directory and scores.txt by range, not the whole archive.
+                    logger.debug("Retrieving output.zip and 'scores.txt' file (submission_id=%s)", submission.id)
+                    logger.debug("Output.zip location=%s" % submission.output_file.file.name)
+                    ozip = ZipFile(submission.output_file)
+                    try:
+                        scores_text = ozip.read('scores.txt')
+                    except Exception:
+                        logger.error("Scores.txt not found, unable to process submission: %s (submission_id=%s)", status, submission.id)
+                        _set_submission_status(submission.id, CompetitionSubmissionStatus.FAILED)
+                        return Job.FAILED
+                    scores = parse_scores(scores_text)
 
                 logger.debug("Processing scores... (submission_id=%s)", submission.id)
-                for line in scores.split("\n"):
-                    if len(line) > 0:
-                        label, value = line.split(":")
-                        logger.debug("Attempting to submit score %s:%s" % (label, value))
-                        try:
-                            scoredef = SubmissionScoreDef.objects.get(competition=submission.phase.competition,
-                                                                      key=label.strip())
-                            SubmissionScore.objects.create(result=submission, scoredef=scoredef, value=float(value))
-                        except SubmissionScoreDef.DoesNotExist:
-                            logger.warning("Score %s does not exist (submission_id=%s)", label, submission.id)
+                _save_scores(submission, scores)
                 logger.debug("Done processing scores... (submission_id=%s)", submission.id)
                 _set_submission_status(submission.id, CompetitionSubmissionStatus.FINISHED)
                 # Automatically submit to the leaderboard?
@@ -526,6 +510,7 @@ def update_submission_task(job_id, args):
         try:
             traceback = None
             metadata = None
+            scores = None
             if 'extra' in args:
                 if 'traceback' in args['extra']:
                     traceback = args['extra']['traceback']
@@ -533,14 +518,109 @@ def update_submission_task(job_id, args):
                 if 'metadata' in args['extra']:
                     metadata = args['extra']['metadata']
 
-            result = update_submission(submission, status, job.id, traceback, metadata)
+                scores = args['extra'].get('scores')
+
+            result = update_submission(submission, status, job.id, traceback, metadata, scores)
         except Exception as e:
             logger.exception("Failed to update submission (job_id=%s, submission_id=%s, status=%s)",
                              job.id, submission_id, status)
             raise SubmissionUpdateException(submission, e)
         return JobTaskResult(status=result)
 
+    if args['status'] != 'running':
+        # The run is over: make room for the next runs of the ready-list.
+        complete_runs(job_id)
     run_job_task(job_id, update_it, handle_update_exception)
+    if args['status'] != 'running':
+        dispatch_runs()
+
+def _start_submissions(updates):
+    """
+    Applies 'running' updates to the submissions of several jobs with a few bulk queries:
+    the submissions which are not in a final state are marked as running, their metadata is
+    saved and the pending jobs are marked as running.
+
+    updates: A list of (job ID, task arguments of the 'run_update' message) pairs.
+    """
+    jobs = Job.objects.in_bulk([job_id for job_id, task_args in updates])
+    submission_ids = {}
+    metadatas = {}
+    for job_id, task_args in updates:
+        job = jobs.get(job_id)
+        if job is None or job.task_type != 'evaluate_submission':
+            logger.warning("Skipping update of job with incorrect task_type (job_id=%s)", job_id)
+            continue
+        submission_ids[job_id] = job.get_task_args()['submission_id']
+        metadata = task_args.get('extra', {}).get('metadata')
+        if metadata:
+            metadatas[job_id] = metadata
+    if len(submission_ids) == 0:
+        return
+
+    running = CompetitionSubmissionStatus.objects.get(codename=CompetitionSubmissionStatus.RUNNING)
+    final_status_ids = list(CompetitionSubmissionStatus.objects.filter(codename__in=_FINAL_STATES)
+                                                               .values_list('pk', flat=True))
+    with transaction.commit_on_success():
+        submissions = {}
+        for pk, execution_key, phase_id in CompetitionSubmission.objects.filter(pk__in=submission_ids.values()) \
+                                                                      .values_list('pk', 'execution_key', 'phase_id'):
+            submissions[pk] = (execution_key, phase_id)
+        existing_metadatas = {}
+        for sub_metadata in CompetitionSubmissionMetadata.objects.filter(submission__in=submissions.keys()):
+            existing_metadatas[(sub_metadata.submission_id, sub_metadata.is_predict)] = sub_metadata
+        new_metadatas = []
+        for job_id, metadata in metadatas.items():
+            submission_id = submission_ids[job_id]
+            if submission_id not in submissions:
+                continue
+            execution_key = submissions[submission_id][0]
+            is_predict = len(execution_key) == 0 or 'score' not in json.loads(execution_key)
+            sub_metadata = existing_metadatas.get((submission_id, is_predict))
+            if sub_metadata is None:
+                sub_metadata = CompetitionSubmissionMetadata(submission_id=submission_id,
+                                                             is_predict=is_predict,
+                                                             is_scoring=not is_predict)
+                sub_metadata.__dict__.update(metadata)
+                new_metadatas.append(sub_metadata)
+            else:
+                sub_metadata.__dict__.update(metadata)
+                sub_metadata.save()
+        CompetitionSubmissionMetadata.objects.bulk_create(new_metadatas)
+        CompetitionSubmission.objects.filter(pk__in=submissions.keys()) \
+                                     .exclude(status__in=final_status_ids) \
+                                     .update(status=running, started_at=datetime.datetime.utcnow())
+        Job.objects.filter(pk__in=submission_ids.keys(), status=Job.PENDING) \
+                   .update(status=Job.RUNNING, updated=timezone.now())
+    # Of the status, the leaderboard rows and the coopetition files only depend on whether a
+    # submission is finished, and the submissions marked as running were not: nothing changed.
+    logger.info("Marked %d submission(s) as running (job_ids=%s).", len(submissions), submission_ids.keys())
+
+def update_submission_batch_task(batch_id, args):
+    """
+    A task to apply a batch of submission status updates sent together by a compute worker.
+
+    Updates to 'running', which are most of the updates while many submissions start, are
+    applied to the whole batch at once. Final updates are applied one at a time as
+    update_submission_task does.
+
+    batch_id: The ID of the job of the first update of the batch.
+    args: A dictionary with the arguments for the task. Expected items are:
+        args['updates']: The list of the 'run_update' messages of the batch, each holding an
+            'id' (the job ID) and 'task_args' (see update_submission_task).
+    """
+    updates = [(update['id'], update['task_args']) for update in args['updates']]
+    running = [(job_id, task_args) for job_id, task_args in updates if task_args['status'] == 'running']
+    if len(running) > 0:
+        try:
+            _start_submissions(running)
+        except Exception:
+            logger.exception("Failed to apply running updates in bulk (batch_id=%s); applying them one at a time.",
+                             batch_id)
+            for job_id, task_args in running:
+                update_submission_task(job_id, task_args)
+    for job_id, task_args in updates:
+        if task_args['status'] != 'running':
+            update_submission_task(job_id, task_args)
 
 
 def evaluate_submission_task(job_id, args):
@@ -579,16 +659,18 @@ def evaluate_submission_task(job_id, args):
 
     submit_it()
 
-def evaluate_submission(submission_id, is_scoring_only):
+def evaluate_submission(submission_id, is_scoring_only, priority=ScheduledRun.INTERACTIVE):
     """
     Starts the process of evaluating a user's submission to a competition.
 
     submission_id: The ID of the CompetitionSubmission object.
     is_scoring_only: True to skip the prediction step.
+    priority: The priority class of the runs of the evaluation: ScheduledRun.INTERACTIVE,
+        ScheduledRun.RERUN or ScheduledRun.MIGRATION.
 
     Returns a Job object which can be used to track the progress of the operation.
     """
-    task_args = {'submission_id': submission_id, 'predict': (not is_scoring_only)}
+    task_args = {'submission_id': submission_id, 'predict': (not is_scoring_only), 'priority': priority}
     return Job.objects.create_and_dispatch_job('evaluate_submission', task_args)
 
 
@@ -632,3 +714,35 @@ def send_mass_email(competition, body=None, subject=None, from_email=None, to_em
         "to_emails": to_emails
     }
     return Job.objects.create_and_dispatch_job('send_mass_email', task_args)
+
+
+# Organizer datasets
+
+def build_dataset_archive_task(job_id, args):
+    """
+    A task to build the composite archive of an organizer dataset made of several data files.
+
+    job_id: The ID of the job.
+    args: A dictionary with the arguments for the task. Expected items are:
+        args['dataset_id']: The ID of the OrganizerDataSet.
+    """
+    def build_it(job):
+        """Builds the archive unless it already matches the dataset's files."""
+        dataset = OrganizerDataSet.objects.get(pk=args['dataset_id'])
+        if dataset.build_composite_archive():
+            logger.info("Built composite archive (dataset_id=%s, job_id=%s)", dataset.pk, job.id)
+        else:
+            logger.info("Composite archive is up to date (dataset_id=%s, job_id=%s)", dataset.pk, job.id)
+        return JobTaskResult(status=Job.FINISHED)
+
+    run_job_task(job_id, build_it)
+
+def build_dataset_archive(dataset_id):
+    """
+    Starts building the composite archive of an organizer dataset in the background.
+
+    dataset_id: The ID of the OrganizerDataSet.
+
+    Returns a Job object which can be used to track the progress of the operation.
+    """
+    return Job.objects.create_and_dispatch_job('build_dataset_archive', {'dataset_id': dataset_id})
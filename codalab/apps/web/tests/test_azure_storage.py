@@ -0,0 +1,244 @@
+import base64
+import hashlib
+import io
+import os
+import threading
+import time
+import zipfile
+
+from collections import namedtuple
+
+import azure
+import mock
+
+from azure.http import HTTPError, HTTPRequest
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.servers.basehttp import FileWrapper
+from django.test import TestCase
+
+from codalab.azure_storage import AzureBlockBlobFile, AzureStorage, NAMING_CONDITIONAL, NAMING_LIST
+
+
+Blob = namedtuple('Blob', ['name'])
+
+
+class MemoryBlobService(object):
+    """Serves blobs from memory like BlobService, with a latency per request, and counts requests."""
+    def __init__(self, blobs, latency=0, failures=0):
+        self.blobs = blobs
+        self.latency = latency
+        self.failures = failures
+        self.ranges = []
+        self.requests = 0
+        self.blocks = {}
+        self.block_lists = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def _request(self):
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency)
+
+    def with_filter(self, request_filter):
+        return FilteredMemoryBlobService(self, request_filter)
+
+    def get_blob_properties(self, container, blob_name):
+        if blob_name not in self.blobs:
+            raise azure.WindowsAzureMissingResourceError("The specified blob does not exist.")
+        return {'content-length': str(len(self.blobs[blob_name]))}
+
+    def list_blobs(self, container, prefix=None):
+        self._request()
+        return [Blob(blob_name) for blob_name in self.blobs if blob_name.startswith(prefix or '')]
+
+    def put_blob(self, container, blob_name, blob, x_ms_blob_type, content_md5=None, x_ms_blob_content_type=None):
+        self._request()
+        self.blobs[blob_name] = blob
+
+    def put_block(self, container, blob_name, block, block_id, content_md5=None):
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise azure.WindowsAzureError("Server busy")
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        assert content_md5 == base64.b64encode(hashlib.md5(block).digest())
+        with self.lock:
+            self.blocks[(blob_name, block_id)] = block
+            self.in_flight -= 1
+
+    def put_block_list(self, container, blob_name, block_ids, x_ms_blob_content_type=None,
+                       x_ms_blob_content_md5=None):
+        self._request()
+        self.block_lists.append(blob_name)
+        self.blobs[blob_name] = ''.join(self.blocks[(blob_name, block_id)] for block_id in block_ids)
+
+    def get_blob(self, container, blob_name, x_ms_range=None):
+        start, end = [int(value) for value in x_ms_range[len('bytes='):].split('-')]
+        with self.lock:
+            self.ranges.append((start, end))
+        time.sleep(self.latency)
+        return self.blobs[blob_name][start:end + 1]
+
+
+class FilteredMemoryBlobService(object):
+    """Sends the commits of a MemoryBlobService through a request filter, like BlobService.with_filter."""
+    def __init__(self, service, request_filter):
+        self.service = service
+        self.request_filter = request_filter
+
+    def _commit(self, blob_name, commit):
+        request = HTTPRequest()
+        request.method = 'PUT'
+        request.host = 'account.blob.core.windows.net'
+        request.path = '/container/' + blob_name
+        request.headers = [('x-ms-date', 'Sat, 17 Oct 2026 00:00:00 GMT'), ('Authorization', 'SharedKey account:')]
+
+        def next_filter(request):
+            if ('If-None-Match', '*') in request.headers and blob_name in self.service.blobs:
+                self.service._request()
+                raise HTTPError(409, 'The specified blob already exists.', [], '')
+            return commit()
+        return self.request_filter(request, next_filter)
+
+    def put_blob(self, container, blob_name, *args, **kwargs):
+        return self._commit(blob_name, lambda: self.service.put_blob(container, blob_name, *args, **kwargs))
+
+    def put_block_list(self, container, blob_name, *args, **kwargs):
+        return self._commit(blob_name, lambda: self.service.put_block_list(container, blob_name, *args, **kwargs))
+
+
+class AzureBlockBlobFileReadTests(TestCase):
+    def setUp(self):
+        self.content = os.urandom(1024 * 1024 + 123)
+
+    def _open(self, service, **kwargs):
+        return AzureBlockBlobFile(service, 'container', 'blob', 'rb', **kwargs)
+
+    def test_sequential_reads_use_one_request_per_block(self):
+        service = MemoryBlobService({'blob': self.content})
+        blob_file = self._open(service, block_size=64 * 1024, read_ahead=2, tail_size=1024)
+        data = ''.join(FileWrapper(blob_file, blksize=10000))
+        self.assertEqual(data, self.content)
+        # Every byte is read once: 16 blocks before the tail, then the tail.
+        self.assertEqual(sum(end + 1 - start for start, end in service.ranges), len(self.content))
+        self.assertEqual(blob_file.request_count, 17)
+
+    def test_read_ahead_overlaps_requests(self):
+        def read_time(read_ahead):
+            service = MemoryBlobService({'blob': self.content}, latency=0.05)
+            blob_file = self._open(service, block_size=128 * 1024, read_ahead=read_ahead, tail_size=1024)
+            start = time.time()
+            while len(blob_file.read(128 * 1024)) > 0:
+                time.sleep(0.03)
+            return time.time() - start
+
+        self.assertLess(read_time(2), 0.8 * read_time(0))
+
+    def test_zip_archives_are_read_from_the_tail(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zip_file:
+            zip_file.writestr('large.bin', self.content)
+            zip_file.writestr('scores.txt', 'accuracy: 0.5\n')
+        service = MemoryBlobService({'blob': archive.getvalue()})
+        blob_file = self._open(service)
+        zip_file = zipfile.ZipFile(blob_file)
+        self.assertEqual(zip_file.read('scores.txt'), 'accuracy: 0.5\n')
+        # The central directory and the last member are both in the tail.
+        self.assertEqual(blob_file.request_count, 1)
+        self.assertEqual(zip_file.read('large.bin'), self.content)
+
+    def test_seek(self):
+        service = MemoryBlobService({'blob': self.content})
+        blob_file = self._open(service, block_size=64 * 1024)
+        self.assertEqual(blob_file.seek(-10, 2), len(self.content) - 10)
+        self.assertEqual(blob_file.read(), self.content[-10:])
+        blob_file.seek(100)
+        self.assertEqual(blob_file.read(5), self.content[100:105])
+        blob_file.seek(5, 1)
+        self.assertEqual(blob_file.read(5), self.content[110:115])
+        blob_file.seek(len(self.content) + 10)
+        self.assertEqual(blob_file.read(5), '')
+
+
+class AzureBlockBlobFileWriteTests(TestCase):
+    def setUp(self):
+        self.content = os.urandom(10 * 1024 + 123)
+
+    def _storage(self, service, naming=NAMING_CONDITIONAL):
+        storage = AzureStorage(account_name='account', account_key=base64.b64encode('key'), azure_container='container',
+                               write_block_size=1024, upload_threads=4, naming=naming)
+        storage._connection = service
+        return storage
+
+    def test_save_uploads_blocks_concurrently_and_commits_once(self):
+        service = MemoryBlobService({}, latency=0.01)
+        self._storage(service).save('datasets/data.zip', ContentFile(self.content))
+        self.assertEqual(service.blobs['datasets/data.zip'], self.content)
+        self.assertEqual(len(service.blocks), 11)
+        self.assertEqual(service.block_lists, ['datasets/data.zip'])
+        self.assertGreater(service.max_in_flight, 1)
+
+    def test_small_writes_are_gathered_into_blocks(self):
+        service = MemoryBlobService({})
+        blob_file = self._storage(service).open('data.bin', 'wb')
+        for offset in range(0, len(self.content), 100):
+            blob_file.write(self.content[offset:offset + 100])
+        self.assertNotIn('data.bin', service.blobs)
+        blob_file.close()
+        self.assertEqual(service.blobs['data.bin'], self.content)
+        self.assertEqual(len(service.blocks), 11)
+
+    def test_failed_blocks_are_retried(self):
+        service = MemoryBlobService({}, failures=2)
+        with mock.patch('codalabtools.uploader.RETRY_DELAY', 0):
+            self._storage(service).save('data.bin', ContentFile(self.content))
+        self.assertEqual(service.blobs['data.bin'], self.content)
+        self.assertEqual(service.block_lists, ['data.bin'])
+
+    def test_existing_blobs_are_not_overwritten(self):
+        service = MemoryBlobService({'data.bin': 'data'})
+        with self.assertRaises(Exception):
+            AzureBlockBlobFile(service, 'container', 'data.bin', 'wb')
+
+    def test_conditional_saves_do_not_list_blobs(self):
+        def save_time(naming):
+            service = MemoryBlobService({}, latency=0.02)
+            storage = self._storage(service, naming)
+            start = time.time()
+            for i in range(5):
+                storage.save('submissions/%d/history.txt' % i, ContentFile('history'))
+            return service.requests, time.time() - start
+
+        conditional_requests, conditional_time = save_time(NAMING_CONDITIONAL)
+        list_requests, list_time = save_time(NAMING_LIST)
+        self.assertEqual(conditional_requests, 5)
+        self.assertEqual(list_requests, 10)
+        self.assertLess(conditional_time, list_time)
+
+    def test_conditional_saves_do_not_overwrite_blobs(self):
+        service = MemoryBlobService({'runs/history.txt': 'old', 'runs/data.zip': 'old'})
+        storage = self._storage(service)
+        name = storage.save('runs/history.txt', ContentFile('new'))
+        self.assertRegexpMatches(name, r'^runs/history_[0-9a-f]{7}\.txt$')
+        self.assertEqual(service.blobs['runs/history.txt'], 'old')
+        self.assertEqual(service.blobs[name], 'new')
+        # Large files are committed conditionally too.
+        name = storage.save('runs/data.zip', ContentFile(self.content))
+        self.assertNotEqual(name, 'runs/data.zip')
+        self.assertEqual(service.blobs['runs/data.zip'], 'old')
+        self.assertEqual(service.blobs[name], self.content)
+
+    def test_blocks_larger_than_the_service_limit_are_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            AzureStorage(account_name='account', account_key=base64.b64encode('key'), azure_container='container',
+                         write_block_size=8 * 1024 * 1024)
+
+    def test_listed_names_get_a_numeric_suffix(self):
+        service = MemoryBlobService({'runs/history.txt': 'old'})
+        name = self._storage(service, NAMING_LIST).save('runs/history.txt', ContentFile('new'))
+        self.assertEqual(name, 'runs/history_1.txt')
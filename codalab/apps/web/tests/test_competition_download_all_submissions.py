@@ -1,10 +1,19 @@
 import datetime
+import StringIO
+import zipfile
 
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 
-from apps.web.models import Competition, CompetitionPhase
+from apps.web.models import (Competition,
+                             CompetitionParticipant,
+                             CompetitionPhase,
+                             CompetitionSubmission,
+                             ParticipantStatus,
+                             PhaseLeaderBoard,
+                             PhaseLeaderBoardEntry)
 
 User = get_user_model()
 
@@ -42,3 +51,28 @@ class CompetitionDownloadAllSubmissions(TestCase):
         self.client.login(username="organizer", password="pass")
         resp = self.client.get(reverse("competitions:download_leaderboard_results", kwargs={"competition_pk": self.competition.pk, "phase_pk": self.phase.pk}))
         self.assertEquals(resp.status_code, 200)
+
+    def test_competition_download_all_submissions_streams_a_zip_of_leaderboard_entries(self):
+        participant = CompetitionParticipant.objects.create(
+            user=self.non_admin_user,
+            competition=self.competition,
+            status=ParticipantStatus.objects.get_or_create(name='approved', codename=ParticipantStatus.APPROVED)[0]
+        )
+        submission = CompetitionSubmission.objects.create(
+            participant=participant,
+            phase=self.phase,
+            file=SimpleUploadedFile(name="submission.zip", content="submission content"),
+            output_file=SimpleUploadedFile(name="output.zip", content="output content"),
+        )
+        PhaseLeaderBoardEntry.objects.create(board=PhaseLeaderBoard.objects.create(phase=self.phase), result=submission)
+
+        self.client.login(username="organizer", password="pass")
+        resp = self.client.get(reverse("competitions:download_leaderboard_results", kwargs={"competition_pk": self.competition.pk, "phase_pk": self.phase.pk}))
+        self.assertEquals(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        zip_file = zipfile.ZipFile(StringIO.StringIO(''.join(resp.streaming_content)))
+        self.assertIsNone(zip_file.testzip())
+        self.assertEquals(zip_file.read("non_admin - 1 submission.zip"), "submission content")
+        self.assertEquals(zip_file.read("non_admin - 1 output.zip"), "output content")
+        # Stored files are added with their sizes, so they do not need Zip64 headers.
+        self.assertEquals(zip_file.getinfo("non_admin - 1 submission.zip").extract_version, 20)
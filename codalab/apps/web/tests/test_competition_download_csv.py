@@ -1,4 +1,7 @@
+import gzip
+import json
 import mock
+import StringIO
 import datetime
 
 from django.conf import settings
@@ -94,3 +97,44 @@ class CompetitionDownloadCSVTests(TestCase):
         '''Unicode set in setUp method'''
         resp = self.client.get(self.url)
         self.assertEquals(resp.status_code, 200)
+
+    def _finish_submission(self):
+        # New submissions are saved as submitting, only finished ones are in complete results.
+        CompetitionSubmission.objects.filter(pk=self.submission_1.pk).update(
+            status=CompetitionSubmissionStatus.objects.get(codename="finished")
+        )
+
+    def test_download_competition_csv_is_streamed(self):
+        self._finish_submission()
+        resp = self.client.get(self.url)
+        self.assertTrue(resp.streaming)
+        self.assertEquals(resp["Content-Type"], "text/csv")
+        content = ''.join(resp.streaming_content)
+        self.assertIn("Is on leaderboard?", content)
+        self.assertIn(u"Some description with unicode \u2020".encode("utf-8"), content)
+
+    def test_download_competition_results_as_json_lines(self):
+        self._finish_submission()
+        resp = self.client.get(self.url, {"format": "jsonl"})
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp["Content-Type"], "application/x-ndjson")
+        records = [json.loads(line) for line in ''.join(resp.streaming_content).splitlines()]
+        self.assertEquals(len(records), 1)
+        self.assertEquals(records[0]["submission_pk"], self.submission_1.pk)
+        self.assertEquals(records[0]["username"], u"testuser\u2020")
+        self.assertTrue(records[0]["is_on_leaderboard"])
+
+    def test_download_competition_results_gzipped(self):
+        resp = self.client.get(self.url, {"compress": "gzip"})
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp["Content-Type"], "application/gzip")
+        self.assertIn("competition_results.csv.gz", resp["Content-Disposition"])
+        compressed = ''.join(resp.streaming_content)
+        content = gzip.GzipFile(fileobj=StringIO.StringIO(compressed)).read()
+        self.assertIn("Is on leaderboard?", content)
+
+    def test_results_csv_matches_streamed_leaderboard_download(self):
+        url = reverse("competitions:competition_results_download", kwargs={"id": self.competition.pk,
+                                                                           "phase": self.phase_1.pk})
+        resp = self.client.get(url)
+        self.assertEquals(''.join(resp.streaming_content), self.competition.get_results_csv(self.phase_1.pk))
@@ -0,0 +1,136 @@
+import csv
+import datetime
+import shutil
+import tempfile
+
+import mock
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.base import ContentFile
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.contrib.auth import get_user_model
+
+from apps.coopetitions.models import DownloadRecord, Like
+from apps.web.models import (BundleStorage,
+                             coopetition_cache_key,
+                             coopetition_downloads_cache_key,
+                             Competition,
+                             CompetitionParticipant,
+                             CompetitionPhase,
+                             CompetitionSubmission,
+                             CompetitionSubmissionStatus,
+                             ParticipantStatus)
+from apps.web.tasks import score
+
+
+User = get_user_model()
+
+
+class CoopetitionFilesTests(TestCase):
+    def setUp(self):
+        super(CoopetitionFilesTests, self).setUp()
+        self.cache = LocMemCache('coopetition', {})
+        self.cache_patch = mock.patch('apps.web.models.cache', self.cache)
+        self.cache_patch.start()
+
+        self.user = User.objects.create(email='test@user.com', username='testuser')
+        self.other_user = User.objects.create(email='other@user.com', username='other')
+        self.competition = Competition.objects.create(creator=self.user, modified_by=self.user)
+        approved = ParticipantStatus.objects.get_or_create(name='approved', codename=ParticipantStatus.APPROVED)[0]
+        self.participant = CompetitionParticipant.objects.create(user=self.user,
+                                                                 competition=self.competition,
+                                                                 status=approved)
+        self.phase = CompetitionPhase.objects.create(
+            competition=self.competition,
+            phasenumber=1,
+            start_date=datetime.datetime.now() - datetime.timedelta(days=30),
+        )
+        self.finished = CompetitionSubmissionStatus.objects.create(name="finished", codename="finished")
+        self.submission = self._create_submission()
+
+    def tearDown(self):
+        self.cache_patch.stop()
+        super(CoopetitionFilesTests, self).tearDown()
+
+    def _create_submission(self):
+        submission = CompetitionSubmission.objects.create(
+            participant=self.participant,
+            phase=self.phase,
+            status=self.finished,
+            submitted_at=datetime.datetime.now() - datetime.timedelta(days=29),
+        )
+        # New submissions are saved as submitted.
+        CompetitionSubmission.objects.filter(pk=submission.pk).update(status=self.finished)
+        return submission
+
+    def _rows(self):
+        return self.phase.get_coopetition_submissions_csv().strip().split('\r\n')
+
+    def test_submissions_file_is_cached(self):
+        self.assertEqual(len(self._rows()), 2)
+        self.assertIsNotNone(self.cache.get(coopetition_cache_key(self.phase.pk, 'submissions')))
+        with self.assertNumQueries(0):
+            self.phase.get_coopetition_submissions_csv()
+
+    def test_new_submissions_invalidate_the_submissions_file(self):
+        self._rows()
+        self._create_submission()
+        self.assertIsNone(self.cache.get(coopetition_cache_key(self.phase.pk, 'submissions')))
+        self.assertEqual(len(self._rows()), 3)
+
+    def test_likes_invalidate_the_submissions_file(self):
+        self._rows()
+        Like.objects.create(submission=self.submission, user=self.other_user)
+        self.assertIsNone(self.cache.get(coopetition_cache_key(self.phase.pk, 'submissions')))
+        self.assertTrue(self._rows()[1].endswith(',1,0'))
+
+    def test_making_submissions_public_invalidates_the_submissions_file(self):
+        self._rows()
+        submission = CompetitionSubmission.objects.get(pk=self.submission.pk)
+        submission.is_public = True
+        submission.save()
+        self.assertIsNone(self.cache.get(coopetition_cache_key(self.phase.pk, 'submissions')))
+        self.assertNotEqual(self._rows()[1].split(',')[2], '')
+
+    def test_downloads_invalidate_the_downloads_file(self):
+        self.assertEqual(len(self.competition.get_coopetition_downloads_csv().strip().split('\r\n')), 1)
+        DownloadRecord.objects.create(submission=self.submission, user=self.other_user)
+        self.assertIsNone(self.cache.get(coopetition_downloads_cache_key(self.competition.pk)))
+        rows = self.competition.get_coopetition_downloads_csv().strip().split('\r\n')
+        self.assertEqual(rows[1].split(',')[:3], [str(self.submission.pk), 'testuser', 'other'])
+
+    def test_scoring_files_keep_the_submissions_file(self):
+        self._rows()
+        storage_patch = mock.patch.object(BundleStorage, 'location', tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, storage_patch.new)
+        with storage_patch:
+            submission = CompetitionSubmission.objects.get(pk=self.submission.pk)
+            submission.history_file.save('history.txt', ContentFile('history'))
+        self.assertIsNotNone(self.cache.get(coopetition_cache_key(self.phase.pk, 'submissions')))
+
+    @override_settings(BUNDLE_AZURE_CONTAINER='bundles', SBS_RESPONSE_QUEUE='response')
+    def test_scoring_again_in_the_phase_reuses_the_files(self):
+        CompetitionSubmissionStatus.objects.create(name="submitted", codename="submitted")
+        self.phase.scoring_program.name = 'program.zip'
+        self.phase.reference_data.name = 'reference.zip'
+        self.phase.save()
+        submission = CompetitionSubmission.objects.create(
+            participant=self.participant,
+            phase=self.phase,
+            submitted_at=datetime.datetime.now(),
+        )
+        submission.file.name = 'submission.zip'
+        submission.save()
+
+        storage_patch = mock.patch.object(BundleStorage, 'location', tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, storage_patch.new)
+        with storage_patch, mock.patch('apps.web.tasks.schedule_run'):
+            score(submission, 1)
+            with mock.patch('apps.web.models.csv.DictWriter', wraps=csv.DictWriter) as writer, \
+                    mock.patch.object(Competition, 'iter_results_rows', autospec=True,
+                                      side_effect=Competition.iter_results_rows) as results:
+                score(CompetitionSubmission.objects.get(pk=submission.pk), 2)
+        self.assertFalse(writer.called)
+        # Only the scores file of the submission is computed again.
+        self.assertEqual([args[2] for (args, kwargs) in results.call_args_list], [False])
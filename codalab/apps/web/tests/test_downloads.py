@@ -0,0 +1,121 @@
+import base64
+import datetime
+import hashlib
+import hmac
+import shutil
+import tempfile
+import urlparse
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.db.models.fields.files import FieldFile, FileField
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from apps.web.models import (Competition,
+                             CompetitionParticipant,
+                             CompetitionPhase,
+                             CompetitionSubmission,
+                             CompetitionSubmissionStatus,
+                             ParticipantStatus)
+from apps.web.downloads import file_response
+from codalab.azure_storage import AzureStorage, make_blob_sas_url
+
+User = get_user_model()
+
+
+class DownloadRedirectTests(TestCase):
+    def setUp(self):
+        self.organizer = User.objects.create_user(username="organizer", password="pass")
+        self.competition = Competition.objects.create(creator=self.organizer, modified_by=self.organizer, published=True)
+        participant = CompetitionParticipant.objects.create(
+            user=self.organizer,
+            competition=self.competition,
+            status=ParticipantStatus.objects.get_or_create(name='approved', codename=ParticipantStatus.APPROVED)[0]
+        )
+        phase = CompetitionPhase.objects.create(
+            competition=self.competition,
+            phasenumber=1,
+            start_date=datetime.datetime.now() - datetime.timedelta(days=30),
+        )
+        self.submission = CompetitionSubmission.objects.create(
+            participant=participant,
+            phase=phase,
+            status=CompetitionSubmissionStatus.objects.create(name="finished", codename="finished"),
+            submitted_at=datetime.datetime.now() - datetime.timedelta(days=29),
+            output_file=SimpleUploadedFile(name="output.zip", content="zip contents")
+        )
+        self.url = reverse("my_competition_output", kwargs={"submission_id": self.submission.pk,
+                                                            "filetype": "output.zip"})
+        self.client.login(username="organizer", password="pass")
+
+    def test_proxy_streams_archives(self):
+        with self.settings(DOWNLOAD_REDIRECT='proxy'):
+            resp = self.client.get(self.url)
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(''.join(resp.streaming_content), "zip contents")
+        self.assertEquals(resp['Content-Length'], str(len("zip contents")))
+        self.assertTrue(resp['Content-Disposition'].startswith('attachment; filename='))
+
+    def test_x_sendfile_names_local_files(self):
+        with self.settings(DOWNLOAD_REDIRECT='x-sendfile'):
+            resp = self.client.get(self.url)
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp['X-Sendfile'], self.submission.output_file.path)
+        self.assertEquals(resp.content, '')
+
+    def test_ranges_are_still_served_by_django(self):
+        with self.settings(DOWNLOAD_REDIRECT='x-sendfile'):
+            resp = self.client.get(self.url, HTTP_RANGE="bytes=0-2")
+        self.assertEquals(resp.status_code, 206)
+        self.assertEquals(resp.content, "zip")
+
+
+class BlobDownloadRedirectTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.settings_override = override_settings(LOCAL_BLOB_ROOT=self.root, LOCAL_BLOB_KEY='secret')
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        storage = AzureStorage(account_name='account', account_key='key', azure_container='bundles')
+        name = storage.save('runs/1/output.zip', ContentFile('zip contents'))
+        self.file = FieldFile(None, FileField(storage=storage), name)
+
+    def test_sas_redirects_to_a_signed_url(self):
+        with self.settings(DOWNLOAD_REDIRECT='sas'):
+            resp = file_response(self.file, 'application/zip', 'output.zip')
+        self.assertEquals(resp.status_code, 302)
+        self.assertTrue(resp['Location'].startswith('/blobs/bundles/runs/1/output.zip?'))
+        self.assertEquals(''.join(self.client.get(resp['Location']).streaming_content), 'zip contents')
+
+    def test_sas_redirects_keep_the_file_name(self):
+        with self.settings(DOWNLOAD_REDIRECT='sas'):
+            resp = file_response(self.file, 'application/zip', 'organizer-1-output.zip')
+        self.assertEquals(resp.status_code, 302)
+        blob_resp = self.client.get(resp['Location'])
+        self.assertEquals(blob_resp['Content-Disposition'], 'attachment; filename="organizer-1-output.zip"')
+        # The header is part of the signature.
+        tampered = resp['Location'].replace('organizer-1-output.zip', 'other.zip')
+        self.assertEquals(self.client.get(tampered).status_code, 403)
+
+    def test_azure_sas_overrides_the_content_disposition(self):
+        key = base64.b64encode('key')
+        with self.settings(LOCAL_BLOB_ROOT=None):
+            url = make_blob_sas_url('account', key, 'bundles', 'runs/1/output.zip', permission='r',
+                                    content_disposition='attachment; filename="output.zip"')
+        self.assertTrue(url.startswith('https://account.blob.core.windows.net/bundles/runs/1/output.zip?'))
+        params = dict(urlparse.parse_qsl(urlparse.urlparse(url).query))
+        self.assertEquals(params['sv'], '2013-08-15')
+        self.assertEquals(params['rscd'], 'attachment; filename="output.zip"')
+        string_to_sign = '\n'.join(['r', params['st'], params['se'], '/account/bundles/runs/1/output.zip', '',
+                                    '2013-08-15', '', 'attachment; filename="output.zip"', '', '', ''])
+        self.assertEquals(params['sig'], base64.b64encode(hmac.new('key', string_to_sign, hashlib.sha256).digest()))
+
+    def test_x_accel_names_the_blob_with_its_signature(self):
+        with self.settings(DOWNLOAD_REDIRECT='x-accel', DOWNLOAD_ACCEL_PREFIX='/protected/'):
+            resp = file_response(self.file, 'application/zip', 'output.zip')
+        self.assertTrue(resp['X-Accel-Redirect'].startswith('/protected/bundles/runs/1/output.zip?sp=r&se='))
+        self.assertEquals(resp['Content-Disposition'], 'attachment; filename="output.zip"')
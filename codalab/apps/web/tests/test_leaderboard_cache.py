@@ -0,0 +1,189 @@
+import datetime
+import json
+
+import mock
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+
+from apps.web.models import (add_submission_to_leaderboard,
+                             leaderboard_cache_key,
+                             leaderboard_lock,
+                             update_leaderboard_rows,
+                             Competition,
+                             CompetitionParticipant,
+                             CompetitionPhase,
+                             CompetitionSubmission,
+                             CompetitionSubmissionStatus,
+                             ParticipantStatus,
+                             PhaseLeaderBoard,
+                             PhaseLeaderBoardEntry,
+                             PhaseLeaderBoardRow,
+                             SubmissionResultGroup,
+                             SubmissionResultGroupPhase,
+                             SubmissionScore,
+                             SubmissionScoreDef,
+                             SubmissionScoreDefGroup,
+                             SubmissionScoreSet,)
+
+
+User = get_user_model()
+
+
+class LeaderboardCacheTests(TestCase):
+    def setUp(self):
+        super(LeaderboardCacheTests, self).setUp()
+        self.cache = LocMemCache('leaderboards', {})
+        self.cache_patch = mock.patch('apps.web.models.cache', self.cache)
+        self.cache_patch.start()
+
+        self.user = User.objects.create(email='test@user.com', username='testuser')
+        self.other_user = User.objects.create(email='other@user.com', username='other')
+        self.competition = Competition.objects.create(creator=self.user, modified_by=self.user)
+        approved = ParticipantStatus.objects.get_or_create(name='approved', codename=ParticipantStatus.APPROVED)[0]
+        self.participant_1 = CompetitionParticipant.objects.create(user=self.user,
+                                                                   competition=self.competition,
+                                                                   status=approved)
+        self.participant_2 = CompetitionParticipant.objects.create(user=self.other_user,
+                                                                   competition=self.competition,
+                                                                   status=approved)
+        self.phase_1 = CompetitionPhase.objects.create(
+            competition=self.competition,
+            phasenumber=1,
+            start_date=datetime.datetime.now() - datetime.timedelta(days=30),
+        )
+        self.finished = CompetitionSubmissionStatus.objects.create(name="finished", codename="finished")
+
+        result_group = SubmissionResultGroup.objects.create(competition=self.competition,
+                                                            key="Key",
+                                                            label="Test",
+                                                            ordering=1)
+        SubmissionResultGroupPhase.objects.create(phase=self.phase_1, group=result_group)
+        self.score_def = SubmissionScoreDef.objects.create(competition=self.competition, key="Key", label="Test")
+        SubmissionScoreDefGroup.objects.create(scoredef=self.score_def, group=result_group)
+        SubmissionScoreSet.objects.create(competition=self.competition,
+                                          key="Key",
+                                          label="Test",
+                                          scoredef=self.score_def)
+
+        self.submission_1 = self._create_scored_submission(self.participant_1, 0.5)
+        self.leader_board = PhaseLeaderBoard.objects.create(phase=self.phase_1)
+        PhaseLeaderBoardEntry.objects.create(board=self.leader_board, result=self.submission_1)
+
+    def tearDown(self):
+        self.cache_patch.stop()
+        super(LeaderboardCacheTests, self).tearDown()
+
+    def _create_scored_submission(self, participant, value):
+        submission = CompetitionSubmission.objects.create(
+            participant=participant,
+            phase=self.phase_1,
+            status=self.finished,
+            submitted_at=datetime.datetime.now() - datetime.timedelta(days=29),
+        )
+        SubmissionScore.objects.create(result=submission, scoredef=self.score_def, value=value)
+        return submission
+
+    def _stored_scores(self):
+        scores = json.loads(PhaseLeaderBoardRow.objects.get(submission=self.submission_1).scores)
+        return dict((key, float(value)) for (key, value) in scores.items())
+
+    def _leaderboard_users(self):
+        return [values['username'] for (pk, values) in self.phase_1.scores()[0]['scores']]
+
+    def test_scores_are_materialized_after_the_first_read(self):
+        self.assertIsNone(self.cache.get(leaderboard_cache_key(self.phase_1.pk)))
+        results = self.phase_1.scores()
+        self.assertEquals(self.cache.get(leaderboard_cache_key(self.phase_1.pk)), results)
+        with self.assertNumQueries(0):
+            self.assertEquals(self.phase_1.scores(), results)
+
+    def test_adding_a_submission_to_the_leaderboard_refreshes_it(self):
+        self.phase_1.scores()
+        submission_2 = self._create_scored_submission(self.participant_2, 0.9)
+        add_submission_to_leaderboard(submission_2)
+        self.assertIsNotNone(self.cache.get(leaderboard_cache_key(self.phase_1.pk)))
+        with self.assertNumQueries(0):
+            self.assertEquals(sorted(self._leaderboard_users()), ['other', 'testuser'])
+
+    def test_score_changes_invalidate_the_leaderboard(self):
+        self.phase_1.scores()
+        score = SubmissionScore.objects.get(result=self.submission_1)
+        score.value = 0.7
+        score.save()
+        self.assertIsNone(self.cache.get(leaderboard_cache_key(self.phase_1.pk)))
+
+    def test_removing_a_leaderboard_entry_invalidates_the_leaderboard(self):
+        self.phase_1.scores()
+        PhaseLeaderBoardEntry.objects.filter(board=self.leader_board).delete()
+        self.assertIsNone(self.cache.get(leaderboard_cache_key(self.phase_1.pk)))
+        self.assertEquals(self._leaderboard_users(), [])
+
+    def test_updated_rows_rank_like_a_full_computation(self):
+        self.phase_1.scores()
+        submission_2 = self._create_scored_submission(self.participant_2, 0.9)
+        add_submission_to_leaderboard(submission_2)
+        score = SubmissionScore.objects.get(result=self.submission_1)
+        score.value = 0.95
+        score.save()
+        for include_scores_not_on_leaderboard in (False, True):
+            self.assertEquals(self.phase_1.scores(include_scores_not_on_leaderboard),
+                              self.phase_1._compute_scores(include_scores_not_on_leaderboard))
+        self.assertEquals(self._leaderboard_users(), ['other', 'testuser'])
+
+    def test_adding_a_submission_does_not_read_the_whole_phase(self):
+        self.phase_1.scores()
+        submission_2 = self._create_scored_submission(self.participant_2, 0.9)
+        with mock.patch.object(CompetitionPhase, 'leaderboard_layout') as layout:
+            add_submission_to_leaderboard(submission_2)
+        self.assertFalse(layout.called)
+        self.assertEquals(sorted(self._leaderboard_users()), ['other', 'testuser'])
+
+    def test_other_submission_changes_keep_the_leaderboard(self):
+        results = self.phase_1.scores()
+        self.submission_1.description = "Updated"
+        self.submission_1.save()
+        self.assertEquals(self.cache.get(leaderboard_cache_key(self.phase_1.pk)), results)
+
+    def test_unfinished_submissions_leave_the_full_leaderboard(self):
+        self.phase_1.scores(True)
+        self.submission_1.status = CompetitionSubmissionStatus.objects.create(name="running", codename="running")
+        self.submission_1.save()
+        self.assertFalse(self.phase_1.scores(True)[0]['scores'])
+        self.assertEquals(self._leaderboard_users(), ['testuser'])
+
+    def test_score_changes_update_the_stored_row(self):
+        self.phase_1.scores()
+        self.assertEquals(self._stored_scores(), {str(self.score_def.pk): 0.5})
+        score = SubmissionScore.objects.get(result=self.submission_1)
+        score.value = 0.7
+        score.save()
+        self.assertEquals(self._stored_scores(), {str(self.score_def.pk): 0.7})
+
+    def test_leaderboards_not_kept_by_the_cache_are_ranked_from_the_stored_rows(self):
+        self.phase_1.scores()
+        with mock.patch.object(self.cache, 'set'):
+            with mock.patch('apps.web.models._read_leaderboard_rows') as read_rows:
+                results = self.phase_1.scores(True)
+        self.assertFalse(read_rows.called)
+        self.assertEquals(results, self.phase_1._compute_scores(True))
+
+    def test_updates_without_the_lock_leave_it_and_mark_the_rows_stale(self):
+        self.phase_1.scores()
+        with mock.patch('apps.web.models.LEADERBOARD_LOCK_WAIT', 0):
+            with leaderboard_lock(self.phase_1.pk) as locked:
+                self.assertTrue(locked)
+                with leaderboard_lock(self.phase_1.pk) as other_locked:
+                    self.assertFalse(other_locked)
+                self.assertIsNotNone(self.cache.get("phase_%s_leaderboard_lock" % self.phase_1.pk))
+                update_leaderboard_rows(self.phase_1.pk, [self.submission_1.pk])
+        board = PhaseLeaderBoard.objects.get(pk=self.leader_board.pk)
+        self.assertNotEqual(board.rows_built_version, board.rows_version)
+        self.assertEquals(self._leaderboard_users(), ['testuser'])
+
+    def test_deleting_a_submission_removes_its_stored_row(self):
+        self.phase_1.scores()
+        self.submission_1.delete()
+        self.assertFalse(PhaseLeaderBoardRow.objects.exists())
+        self.assertEquals(self._leaderboard_users(), [])
@@ -0,0 +1,135 @@
+import datetime
+
+import mock
+
+from django.core.cache.backends.dummy import DummyCache
+from django.core.urlresolvers import reverse
+from django.core.signals import request_started
+from django.db import connection, reset_queries
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+
+from apps.teams.models import Team
+from apps.web.models import (Competition,
+                             CompetitionParticipant,
+                             CompetitionPhase,
+                             CompetitionSubmission,
+                             CompetitionSubmissionStatus,
+                             ParticipantStatus,
+                             PhaseLeaderBoard,
+                             PhaseLeaderBoardEntry,
+                             SubmissionResultGroup,
+                             SubmissionResultGroupPhase,
+                             SubmissionScore,
+                             SubmissionScoreDef,
+                             SubmissionScoreDefGroup,
+                             SubmissionScoreSet,)
+
+
+User = get_user_model()
+
+
+class LeaderboardQueryCountTests(TestCase):
+    """
+    Rendering a leaderboard must issue the same number of queries however many submissions
+    are on the board.
+    """
+    def setUp(self):
+        super(LeaderboardQueryCountTests, self).setUp()
+        # Leaderboards are materialized in the cache; make sure every request computes them.
+        self.cache_patch = mock.patch('apps.web.models.cache', DummyCache('dummy', {}))
+        self.cache_patch.start()
+
+        self.creator = User.objects.create(email='creator@user.com', username='creator')
+        self.competition = Competition.objects.create(creator=self.creator, modified_by=self.creator, published=True)
+        self.phase = CompetitionPhase.objects.create(
+            competition=self.competition,
+            phasenumber=1,
+            start_date=datetime.datetime.now() - datetime.timedelta(days=30),
+        )
+        self.approved = ParticipantStatus.objects.get_or_create(name='approved', codename=ParticipantStatus.APPROVED)[0]
+        self.finished = CompetitionSubmissionStatus.objects.create(name="finished", codename="finished")
+        self.leader_board = PhaseLeaderBoard.objects.create(phase=self.phase)
+
+        self.score_defs = []
+        for index, key in enumerate(["first", "second"]):
+            result_group = SubmissionResultGroup.objects.create(competition=self.competition,
+                                                                key=key,
+                                                                label=key,
+                                                                ordering=index)
+            SubmissionResultGroupPhase.objects.create(phase=self.phase, group=result_group)
+            score_def = SubmissionScoreDef.objects.create(competition=self.competition, key=key, label=key)
+            SubmissionScoreDefGroup.objects.create(scoredef=score_def, group=result_group)
+            SubmissionScoreSet.objects.create(competition=self.competition, key=key, label=key, scoredef=score_def)
+            self.score_defs.append(score_def)
+        self.participant_count = 0
+        # Store the leaderboard rows of the phase; they are updated as submissions are added.
+        self.phase.scores()
+
+    def tearDown(self):
+        self.cache_patch.stop()
+        super(LeaderboardQueryCountTests, self).tearDown()
+
+    def _add_submissions(self, count):
+        for _ in range(count):
+            self.participant_count += 1
+            user = User.objects.create(email='user%d@user.com' % self.participant_count,
+                                       username='user%d' % self.participant_count)
+            participant = CompetitionParticipant.objects.create(user=user,
+                                                                competition=self.competition,
+                                                                status=self.approved)
+            team = Team.objects.create(name='team%d' % self.participant_count,
+                                       competition=self.competition,
+                                       creator=user)
+            submission = CompetitionSubmission.objects.create(
+                participant=participant,
+                phase=self.phase,
+                team=team,
+                status=self.finished,
+                submitted_at=datetime.datetime.now() - datetime.timedelta(days=29),
+            )
+            # New submissions are saved as submitting; finish them so they are in complete results.
+            CompetitionSubmission.objects.filter(pk=submission.pk).update(status=self.finished)
+            for score_def in self.score_defs:
+                SubmissionScore.objects.create(result=submission, scoredef=score_def, value=self.participant_count)
+            PhaseLeaderBoardEntry.objects.create(board=self.leader_board, result=submission)
+
+    def _count_queries(self, url):
+        # Queries are normally reset when a request starts; keep them to count the request's own.
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        request_started.disconnect(reset_queries)
+        start = len(connection.queries)
+        try:
+            resp = self.client.get(url)
+            if resp.streaming:
+                ''.join(resp.streaming_content)
+        finally:
+            request_started.connect(reset_queries)
+            connection.use_debug_cursor = use_debug_cursor
+        self.assertEqual(resp.status_code, 200)
+        return len(connection.queries) - start
+
+    def _assert_constant_queries(self, url):
+        self._add_submissions(2)
+        small_board = self._count_queries(url)
+        self._add_submissions(8)
+        large_board = self._count_queries(url)
+        self.assertEqual(small_board, large_board)
+
+    def test_results_page_queries_do_not_grow_with_the_board(self):
+        self._assert_constant_queries(reverse("competitions:competition_results_page",
+                                              kwargs={"id": self.competition.pk, "phase": self.phase.pk}))
+
+    def test_results_download_queries_do_not_grow_with_the_board(self):
+        self._assert_constant_queries(reverse("competitions:competition_results_download",
+                                              kwargs={"id": self.competition.pk, "phase": self.phase.pk}))
+
+    def test_complete_results_download_queries_do_not_grow_with_the_board(self):
+        self._assert_constant_queries(reverse("competitions:competition_results_complete_download",
+                                              kwargs={"id": self.competition.pk, "phase": self.phase.pk}))
+
+    def test_api_leaderboard_queries_do_not_grow_with_the_board(self):
+        self._assert_constant_queries(reverse("api_phase_leaderboarddata",
+                                              kwargs={"competition_id": self.competition.pk,
+                                                      "phase_id": self.phase.phasenumber}))
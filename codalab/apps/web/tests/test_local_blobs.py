@@ -0,0 +1,81 @@
+import base64
+import os
+import shutil
+import tempfile
+import urlparse
+
+from django.core.files.base import ContentFile
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from codalab.azure_storage import AzureStorage, get_local_blob_service, make_blob_sas_url
+
+
+class LocalBlobTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.settings_override = override_settings(LOCAL_BLOB_ROOT=self.root, LOCAL_BLOB_KEY='secret',
+                                                   LOCAL_BLOB_PUBLIC_CONTAINERS=['public'])
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def _storage(self, container='bundles'):
+        return AzureStorage(account_name='account', account_key='key', azure_container=container)
+
+    def test_storage_saves_and_reads_files(self):
+        storage = self._storage()
+        name = storage.save('submissions/1/output.zip', ContentFile('output'))
+        self.assertEqual(name, 'submissions/1/output.zip')
+        self.assertEqual(storage.path(name), os.path.join(self.root, 'bundles', 'submissions', '1', 'output.zip'))
+        self.assertEqual(storage.open(name).read(), 'output')
+        self.assertEqual(storage.size(name), '6')
+        # The name is taken: the next file gets another one.
+        self.assertNotEqual(storage.save('submissions/1/output.zip', ContentFile('other')), name)
+        storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+    def test_public_files_are_served_without_signature(self):
+        storage = self._storage('public')
+        name = storage.save('logos/logo.png', ContentFile('png'))
+        response = self.client.get(storage.url(name))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join(response.streaming_content), 'png')
+        self.assertEqual(self.client.get(self._storage().url(name)).status_code, 403)
+
+    def test_signed_urls_upload_blocks_and_read_ranges(self):
+        upload_url = make_blob_sas_url('account', 'key', 'bundles', 'competition/upload/1/a.zip', permission='w')
+        path = urlparse.urlparse(upload_url).path
+        block_ids = [base64.b64encode('%06d' % i) for i in range(2)]
+        for block_id, block in zip(block_ids, ['0123456789', 'abcdef']):
+            response = self.client.put(upload_url + '&comp=block&blockid=' + block_id, block,
+                                       content_type='application/octet-stream')
+            self.assertEqual(response.status_code, 201)
+        block_list = '<?xml version="1.0" encoding="utf-8"?><BlockList>%s</BlockList>' % ''.join(
+            '<Latest>%s</Latest>' % block_id for block_id in block_ids)
+        response = self.client.put(upload_url + '&comp=blocklist', block_list, content_type='application/xml',
+                                   HTTP_X_MS_BLOB_CONTENT_TYPE='application/zip')
+        self.assertEqual(response.status_code, 201)
+        # The upload URL does not give read access.
+        self.assertEqual(self.client.get(upload_url).status_code, 403)
+
+        read_url = make_blob_sas_url('account', 'key', 'bundles', 'competition/upload/1/a.zip', permission='r')
+        self.assertEqual(urlparse.urlparse(read_url).path, path)
+        response = self.client.get(read_url, HTTP_RANGE='bytes=8-11')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(''.join(response.streaming_content), '89ab')
+        self.assertEqual(response['Content-Range'], 'bytes 8-11/16')
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        response = self.client.get(read_url)
+        self.assertEqual(''.join(response.streaming_content), '0123456789abcdef')
+        self.assertEqual(self.client.get(read_url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_service_is_shared_until_the_settings_change(self):
+        service = get_local_blob_service()
+        self.assertIs(get_local_blob_service(), service)
+        other_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_root)
+        with self.settings(LOCAL_BLOB_ROOT=other_root):
+            self.assertIsNot(get_local_blob_service(), service)
+        with self.settings(LOCAL_BLOB_ROOT=None):
+            self.assertIsNone(get_local_blob_service())
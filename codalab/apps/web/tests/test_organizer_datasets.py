@@ -1,5 +1,8 @@
 import mock
 import datetime
+import zipfile
+
+from StringIO import StringIO
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
@@ -150,3 +153,76 @@ class OrganizerDataSetMultiDelete(OrganizerDataSetCreateTestsCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(models.OrganizerDataSet.objects.filter(pk=self.dataset.pk).count(), 1)
         self.assertEqual(models.OrganizerDataSet.objects.filter(pk=second_dataset.pk).count(), 1)
+
+
+class OrganizerDataSetCompositeArchiveTests(OrganizerDataSetTestCase):
+
+    def setUp(self):
+        super(OrganizerDataSetCompositeArchiveTests, self).setUp()
+        self.build_patch = mock.patch('apps.web.tasks.build_dataset_archive')
+        self.build_dataset_archive = self.build_patch.start()
+        self.second_dataset = models.OrganizerDataSet.objects.create(
+            name="Second",
+            type="None",
+            data_file=SimpleUploadedFile("other.txt", "contents of other file"),
+            uploaded_by=self.user
+        )
+        self.composite = models.OrganizerDataSet.objects.create(
+            name="Composite",
+            type="None",
+            uploaded_by=self.user
+        )
+        self.composite.sub_data_files.add(self.dataset, self.second_dataset)
+        self.build_dataset_archive.reset_mock()
+
+    def tearDown(self):
+        self.build_patch.stop()
+        super(OrganizerDataSetCompositeArchiveTests, self).tearDown()
+
+    def _reload(self, dataset):
+        return models.OrganizerDataSet.objects.get(pk=dataset.pk)
+
+    def _download(self):
+        resp = self.client.get(reverse("datasets_download", kwargs={"dataset_key": self.composite.key}))
+        self.assertEquals(resp.status_code, 200)
+        archive = zipfile.ZipFile(StringIO(''.join(resp.streaming_content)))
+        return resp, {name: archive.read(name) for name in archive.namelist()}
+
+    def test_build_composite_archive_stores_zip_of_sub_data_files(self):
+        self.assertTrue(self.composite.build_composite_archive())
+        composite = self._reload(self.composite)
+        self.assertTrue(composite.has_current_composite_archive())
+        archive = zipfile.ZipFile(composite.composite_archive)
+        self.assertEquals(archive.read("something.txt"), "contents of file")
+        self.assertEquals(archive.read("other.txt"), "contents of other file")
+
+    def test_build_composite_archive_skips_current_archive(self):
+        self.composite.build_composite_archive()
+        self.assertFalse(self._reload(self.composite).build_composite_archive())
+
+    def test_download_streams_prebuilt_archive(self):
+        self.composite.build_composite_archive()
+        with mock.patch.object(models.OrganizerDataSet, 'get_composite_archive_stream') as stream:
+            resp, members = self._download()
+        self.assertFalse(stream.called)
+        self.assertFalse(self.build_dataset_archive.called)
+        self.assertEquals(int(resp["Content-Length"]), self._reload(self.composite).composite_archive.size)
+        self.assertEquals(members, {"something.txt": "contents of file", "other.txt": "contents of other file"})
+
+    def test_download_of_stale_archive_zips_on_the_fly_and_starts_build(self):
+        resp, members = self._download()
+        self.build_dataset_archive.assert_called_once_with(self.composite.pk)
+        self.assertEquals(members, {"something.txt": "contents of file", "other.txt": "contents of other file"})
+
+    def test_changing_sub_data_files_invalidates_archive(self):
+        self.composite.build_composite_archive()
+        self.composite.sub_data_files.remove(self.second_dataset)
+        self.assertIsNone(self._reload(self.composite).composite_archive_hash)
+        self.build_dataset_archive.assert_called_once_with(self.composite.pk)
+
+    def test_replacing_member_data_file_invalidates_archive(self):
+        self.composite.build_composite_archive()
+        self.dataset.data_file = SimpleUploadedFile("something.txt", "new contents of file")
+        self.dataset.save()
+        self.assertFalse(self._reload(self.composite).has_current_composite_archive())
+        self.build_dataset_archive.assert_called_once_with(self.composite.pk)
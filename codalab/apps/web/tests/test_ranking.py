@@ -0,0 +1,73 @@
+import random
+import unittest
+
+import mock
+
+from django.test import TestCase
+
+from apps.web import ranking
+
+
+def _python_backend():
+    return mock.patch('apps.web.ranking.numpy', None)
+
+
+class RankingEngineTests(TestCase):
+    def setUp(self):
+        super(RankingEngineTests, self).setUp()
+        rng = random.Random(1234)
+        self.ids = range(1, 301)
+        self.columns = []
+        for j in range(12):
+            # Mix exact ties, near ties within eps, runs of close values spanning more than eps
+            # and missing scores.
+            choices = [0.5, 0.25, 1.0, 1.0 + 1.0e-13, 1.0 + 2.0e-13]
+            pairs = {}
+            for id in self.ids:
+                if rng.random() < 0.1:
+                    continue
+                if rng.random() < 0.5:
+                    pairs[id] = rng.choice(choices)
+                else:
+                    pairs[id] = rng.random() * 10
+            self.columns.append((pairs, j % 2 == 0))
+
+    def test_order_submissions_places_unranked_last_and_is_stable(self):
+        ranks = {"a": 2, "b": 1, "c": "-", "d": 1}
+        with _python_backend():
+            self.assertEqual(ranking.order_submissions(["a", "b", "c", "d"], ranks), ["b", "d", "a", "c"])
+        if ranking.numpy is not None:
+            self.assertEqual(ranking.order_submissions(["a", "b", "c", "d"], ranks), ["b", "d", "a", "c"])
+
+    def test_python_backend_uses_the_first_value_of_a_group_for_ties(self):
+        ids = ["a", "b", "c"]
+        with _python_backend():
+            ranks = ranking.rank_values(ids, {"a": 1.0, "b": 1.006, "c": 1.012}, eps=0.01)
+        self.assertEqual(ranks, {"a": 1, "b": 1, "c": 2})
+
+    @unittest.skipIf(ranking.numpy is None, "NumPy is not installed")
+    def test_numpy_backend_matches_python_backend(self):
+        with _python_backend():
+            expected = ranking.rank_columns(self.ids, self.columns)
+        self.assertEqual(ranking.rank_columns(self.ids, self.columns), expected)
+        self.assertEqual(ranking.rank_columns(self.ids, self.columns, eps=0.01),
+                         [ranking._rank_values_python(self.ids, pairs, asc, 0.01) for (pairs, asc) in self.columns])
+
+        with _python_backend():
+            expected_averages = ranking.average_ranks(self.ids, expected)
+            expected_order = ranking.order_submissions(self.ids, expected[0])
+        self.assertEqual(ranking.average_ranks(self.ids, expected), expected_averages)
+        self.assertEqual(ranking.order_submissions(self.ids, expected[0]), expected_order)
+
+    @unittest.skipIf(ranking.numpy is None, "NumPy is not installed")
+    def test_numpy_backend_handles_empty_columns(self):
+        ranks = ranking.rank_columns(["a", "b"], [({}, True), ({"b": 3.0}, False)])
+        self.assertEqual(ranks, [{"a": 1, "b": 1}, {"a": 2, "b": 1}])
+
+    def test_backend_can_be_chosen_explicitly(self):
+        with _python_backend():
+            expected = ranking.rank_columns(self.ids, self.columns)
+        self.assertEqual(ranking.rank_columns(self.ids, self.columns, backend=ranking.PYTHON), expected)
+        with _python_backend():
+            self.assertRaises(ValueError, ranking.rank_columns, self.ids, self.columns, backend=ranking.NUMPY)
+        self.assertRaises(ValueError, ranking.rank_columns, self.ids, self.columns, backend='fortran')
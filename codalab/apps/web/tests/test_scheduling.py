@@ -0,0 +1,172 @@
+import datetime
+import json
+import threading
+
+import mock
+
+from django.db import transaction
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from django.contrib.auth import get_user_model
+
+from apps.jobs.models import Job
+from apps.web.models import (Competition,
+                             CompetitionParticipant,
+                             CompetitionPhase,
+                             CompetitionSubmission,
+                             CompetitionSubmissionStatus,
+                             ParticipantStatus,
+                             ScheduledRun)
+from apps.web.scheduling import complete_runs, dispatch_runs, dispatch_runs_periodically, schedule_run
+
+User = get_user_model()
+
+
+@override_settings(COMPUTE_MAX_IN_FLIGHT=2, COMPUTE_COMPETITION_MAX_IN_FLIGHT=None, SBS_COMPUTE_QUEUE="compute")
+class ComputeSchedulingTests(TransactionTestCase):
+    def setUp(self):
+        self.organizer = User.objects.create_user(username="organizer", password="pass")
+        self.approved = ParticipantStatus.objects.get_or_create(name='approved', codename=ParticipantStatus.APPROVED)[0]
+        self.submitted = CompetitionSubmissionStatus.objects.get_or_create(name="submitted", codename="submitted")[0]
+        CompetitionSubmissionStatus.objects.get_or_create(name="cancelled", codename="cancelled")
+        self.user_count = 0
+        self.queue = mock.MagicMock()
+        self.queue_patch = mock.patch('apps.web.scheduling.getQueue', return_value=self.queue)
+        self.queue_patch.start()
+
+    def tearDown(self):
+        self.queue_patch.stop()
+
+    def _competition(self):
+        competition = Competition.objects.create(creator=self.organizer, modified_by=self.organizer, published=True)
+        phase = CompetitionPhase.objects.create(
+            competition=competition,
+            phasenumber=1,
+            start_date=datetime.datetime.now() - datetime.timedelta(days=30),
+        )
+        return competition, phase
+
+    def _participant(self, competition):
+        self.user_count += 1
+        user = User.objects.create_user(username="participant%d" % self.user_count, password="pass")
+        return CompetitionParticipant.objects.create(user=user, competition=competition, status=self.approved)
+
+    def _schedule(self, participant, phase, priority=ScheduledRun.INTERACTIVE):
+        submission = CompetitionSubmission.objects.create(participant=participant, phase=phase, status=self.submitted)
+        job = Job.objects.create_job('evaluate_submission', {'submission_id': submission.pk, 'priority': priority})
+        body = json.dumps({'id': job.pk, 'task_type': 'run', 'task_args': {'execution_time_limit': 300}})
+        schedule_run(submission, job.pk, body)
+        return job.pk
+
+    def _dispatched(self):
+        return [json.loads(call[0][0])['id'] for call in self.queue.send_message.call_args_list]
+
+    def test_runs_wait_for_room_in_flight(self):
+        competition, phase = self._competition()
+        participant = self._participant(competition)
+        jobs = [self._schedule(participant, phase) for _ in range(3)]
+        self.assertEqual(self._dispatched(), jobs[:2])
+
+        complete_runs(jobs[0])
+        dispatch_runs()
+        self.assertEqual(self._dispatched(), jobs)
+
+    def test_interactive_runs_go_before_migrations(self):
+        competition, phase = self._competition()
+        participant = self._participant(competition)
+        running = [self._schedule(participant, phase) for _ in range(2)]
+        migration = self._schedule(participant, phase, ScheduledRun.MIGRATION)
+        rerun = self._schedule(participant, phase, ScheduledRun.RERUN)
+        interactive = self._schedule(participant, phase)
+
+        for job_id in running:
+            complete_runs(job_id)
+        dispatch_runs()
+        self.assertEqual(self._dispatched(), running + [interactive, rerun])
+        self.assertNotIn(migration, self._dispatched())
+
+    def test_runs_are_shared_fairly_between_competitions(self):
+        busy_competition, busy_phase = self._competition()
+        busy_participant = self._participant(busy_competition)
+        with self.settings(COMPUTE_MAX_IN_FLIGHT=1):
+            busy_jobs = [self._schedule(busy_participant, busy_phase) for _ in range(3)]
+            competition, phase = self._competition()
+            job = self._schedule(self._participant(competition), phase)
+        self.assertEqual(self._dispatched(), busy_jobs[:1])
+
+        dispatch_runs()
+        # The other competition has no run in flight, so its later run goes first.
+        self.assertEqual(self._dispatched(), busy_jobs[:1] + [job])
+
+    def test_competition_cap_is_enforced(self):
+        competition, phase = self._competition()
+        competition.max_concurrent_runs = 1
+        competition.save()
+        participant = self._participant(competition)
+        jobs = [self._schedule(participant, phase) for _ in range(2)]
+        other_competition, other_phase = self._competition()
+        other_job = self._schedule(self._participant(other_competition), other_phase)
+        self.assertEqual(self._dispatched(), [jobs[0], other_job])
+
+    def test_expired_runs_no_longer_count_in_flight(self):
+        competition, phase = self._competition()
+        participant = self._participant(competition)
+        jobs = [self._schedule(participant, phase) for _ in range(3)]
+        ScheduledRun.objects.filter(job__pk=jobs[0]).update(expires_at=datetime.datetime(2000, 1, 1))
+        dispatch_runs()
+        self.assertEqual(self._dispatched(), jobs)
+
+    def test_cancelled_submissions_are_not_dispatched(self):
+        competition, phase = self._competition()
+        participant = self._participant(competition)
+        jobs = [self._schedule(participant, phase) for _ in range(3)]
+        cancelled = CompetitionSubmissionStatus.objects.get(codename=CompetitionSubmissionStatus.CANCELLED)
+        submission_id = ScheduledRun.objects.get(job__pk=jobs[2]).submission_id
+        CompetitionSubmission.objects.filter(pk=submission_id).update(status=cancelled)
+        complete_runs(jobs[0])
+        dispatch_runs()
+        self.assertEqual(self._dispatched(), jobs[:2])
+        self.assertIsNotNone(ScheduledRun.objects.get(job__pk=jobs[2]).completed_at)
+
+    def test_runs_are_dispatched_periodically(self):
+        competition, phase = self._competition()
+        participant = self._participant(competition)
+        jobs = [self._schedule(participant, phase) for _ in range(3)]
+        ScheduledRun.objects.filter(job__pk=jobs[0]).update(expires_at=datetime.datetime(2000, 1, 1))
+        stopped = threading.Event()
+        self.queue.send_message.side_effect = lambda message: stopped.set()
+        dispatch_runs_periodically(stopped, interval=0)
+        self.assertEqual(self._dispatched(), jobs)
+
+    def test_runs_are_sent_after_their_claims_are_committed(self):
+        competition, phase = self._competition()
+        participant = self._participant(competition)
+        claims = []
+
+        def send_message(message):
+            claims.append((transaction.is_managed(),
+                           ScheduledRun.objects.get(job__pk=json.loads(message)['id']).dispatched_at is not None))
+        self.queue.send_message.side_effect = send_message
+        self._schedule(participant, phase)
+        self.assertEqual(claims, [(False, True)])
+
+    def test_runs_are_not_dispatched_inside_a_transaction(self):
+        competition, phase = self._competition()
+        participant = self._participant(competition)
+        with transaction.commit_on_success():
+            job = self._schedule(participant, phase)
+        self.assertEqual(self._dispatched(), [])
+        dispatch_runs()
+        self.assertEqual(self._dispatched(), [job])
+
+    def test_runs_which_could_not_be_sent_stay_in_the_ready_list(self):
+        competition, phase = self._competition()
+        participant = self._participant(competition)
+        self.queue.send_message.side_effect = Exception("Service Bus is down")
+        with transaction.commit_on_success():
+            jobs = [self._schedule(participant, phase) for _ in range(2)]
+        self.assertEqual(dispatch_runs(), 0)
+        self.assertEqual(ScheduledRun.objects.queued().count(), 2)
+        self.queue.send_message.side_effect = None
+        dispatch_runs()
+        self.assertEqual(self._dispatched()[-2:], jobs)
@@ -126,3 +126,38 @@ class CompetitionSubmissionDownloadTests(TestCase):
         resp = self.client.get(new_url)
         self.assertEquals(resp.status_code, 200)
         self.assertEquals(resp.content, "new stdout")
+
+    def test_submission_output_range_returns_requested_bytes(self):
+        self.client.login(username="participant", password="pass")
+        resp = self.client.get(self.url, HTTP_RANGE="bytes=5-7")
+        self.assertEquals(resp.status_code, 206)
+        self.assertEquals(resp.content, "std")
+        self.assertEquals(resp["Content-Range"], "bytes 5-7/12")
+
+        resp = self.client.get(self.url, HTTP_RANGE="bytes=9-")
+        self.assertEquals(resp.status_code, 206)
+        self.assertEquals(resp.content, "out")
+
+    def test_submission_output_range_past_end_returns_416(self):
+        self.client.login(username="participant", password="pass")
+        resp = self.client.get(self.url, HTTP_RANGE="bytes=12-")
+        self.assertEquals(resp.status_code, 416)
+        self.assertEquals(resp["Content-Range"], "bytes */12")
+
+    def test_submission_output_tail_returns_last_bytes(self):
+        self.client.login(username="participant", password="pass")
+        resp = self.client.get(self.url + "?tail=3")
+        self.assertEquals(resp.status_code, 206)
+        self.assertEquals(resp.content, "out")
+        self.assertEquals(resp["Content-Range"], "bytes 9-11/12")
+
+        resp = self.client.get(self.url + "?tail=100")
+        self.assertEquals(resp.content, "test std out")
+
+    def test_submission_output_tail_below_one_returns_whole_file(self):
+        self.client.login(username="participant", password="pass")
+        for tail in ("0", "-3"):
+            resp = self.client.get(self.url + "?tail=" + tail)
+            self.assertEquals(resp.status_code, 200)
+            self.assertEquals(resp.content, "test std out")
+            self.assertFalse(resp.has_header("Content-Range"))
@@ -0,0 +1,150 @@
+import datetime
+import json
+
+from django.db import connection
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+
+from apps.jobs.models import Job
+from apps.web.models import (Competition,
+                             CompetitionParticipant,
+                             CompetitionPhase,
+                             CompetitionSubmission,
+                             CompetitionSubmissionMetadata,
+                             CompetitionSubmissionStatus,
+                             ParticipantStatus,
+                             SchedulerLock,
+                             SubmissionScore,
+                             SubmissionScoreDef)
+from apps.web.tasks import update_submission_batch_task, update_submission_task
+
+User = get_user_model()
+
+
+class SubmissionBatchUpdateTests(TestCase):
+    def setUp(self):
+        self.organizer = User.objects.create_user(username="organizer", password="pass")
+        self.competition = Competition.objects.create(creator=self.organizer, modified_by=self.organizer, published=True)
+        self.phase = CompetitionPhase.objects.create(
+            competition=self.competition,
+            phasenumber=1,
+            start_date=datetime.datetime.now() - datetime.timedelta(days=30),
+        )
+        self.approved = ParticipantStatus.objects.get_or_create(name='approved', codename=ParticipantStatus.APPROVED)[0]
+        self.submitted = CompetitionSubmissionStatus.objects.get_or_create(name="submitted", codename="submitted")[0]
+        for codename in ("running", "finished", "failed", "cancelled"):
+            CompetitionSubmissionStatus.objects.get_or_create(name=codename, codename=codename)
+        # The migrations create the lock of the scheduler.
+        SchedulerLock.objects.create(name='dispatch')
+        self.user_count = 0
+
+    def _add_submission(self):
+        self.user_count += 1
+        user = User.objects.create_user(username="participant%d" % self.user_count, password="pass")
+        participant = CompetitionParticipant.objects.create(user=user, competition=self.competition, status=self.approved)
+        submission = CompetitionSubmission.objects.create(participant=participant, phase=self.phase, status=self.submitted)
+        CompetitionSubmission.objects.filter(pk=submission.pk).update(status=self.submitted)
+        job = Job.objects.create_job('evaluate_submission', {'submission_id': submission.pk})
+        return submission, job
+
+    def _update(self, job, status, extra=None):
+        task_args = {'status': status}
+        if extra:
+            task_args['extra'] = extra
+        return {'id': job.pk, 'task_type': 'run_update', 'task_args': task_args}
+
+    def _status(self, submission):
+        return CompetitionSubmission.objects.get(pk=submission.pk).status.codename
+
+    def test_running_updates_are_applied_to_the_whole_batch(self):
+        submissions, updates = [], []
+        for _ in range(3):
+            submission, job = self._add_submission()
+            submissions.append(submission)
+            updates.append(self._update(job, 'running', {'metadata': {'hostname': 'worker%d' % submission.pk}}))
+
+        update_submission_batch_task(updates[0]['id'], {'updates': updates})
+
+        for submission, update in zip(submissions, updates):
+            self.assertEqual(self._status(submission), CompetitionSubmissionStatus.RUNNING)
+            self.assertIsNotNone(CompetitionSubmission.objects.get(pk=submission.pk).started_at)
+            self.assertEqual(Job.objects.get(pk=update['id']).status, Job.RUNNING)
+            metadata = CompetitionSubmissionMetadata.objects.get(submission=submission)
+            self.assertTrue(metadata.is_predict)
+            self.assertEqual(metadata.hostname, 'worker%d' % submission.pk)
+
+    def test_running_updates_queries_do_not_grow_with_the_batch(self):
+        def count_queries(size):
+            updates = []
+            for _ in range(size):
+                submission, job = self._add_submission()
+                updates.append(self._update(job, 'running', {'metadata': {'hostname': 'worker'}}))
+            use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            start = len(connection.queries)
+            try:
+                update_submission_batch_task(updates[0]['id'], {'updates': updates})
+            finally:
+                connection.use_debug_cursor = use_debug_cursor
+            return len(connection.queries) - start
+
+        self.assertEqual(count_queries(2), count_queries(8))
+
+    def test_final_updates_are_applied_after_running_updates(self):
+        running_submission, running_job = self._add_submission()
+        failed_submission, failed_job = self._add_submission()
+        updates = [self._update(running_job, 'running'),
+                   self._update(failed_job, 'failed', {'traceback': 'error'})]
+
+        update_submission_batch_task(running_job.pk, {'updates': updates})
+
+        self.assertEqual(self._status(running_submission), CompetitionSubmissionStatus.RUNNING)
+        self.assertEqual(self._status(failed_submission), CompetitionSubmissionStatus.FAILED)
+        self.assertEqual(CompetitionSubmission.objects.get(pk=failed_submission.pk).exception_details, 'error')
+
+    def test_running_update_does_not_change_a_final_submission(self):
+        submission, job = self._add_submission()
+        cancelled = CompetitionSubmissionStatus.objects.get(codename=CompetitionSubmissionStatus.CANCELLED)
+        CompetitionSubmission.objects.filter(pk=submission.pk).update(status=cancelled)
+
+        update_submission_batch_task(job.pk, {'updates': [self._update(job, 'running')]})
+
+        self.assertEqual(self._status(submission), CompetitionSubmissionStatus.CANCELLED)
+
+    def _add_scoring_submission(self):
+        submission, job = self._add_submission()
+        CompetitionSubmission.objects.filter(pk=submission.pk).update(execution_key=json.dumps({'score': job.pk}))
+        return submission, job
+
+    def _scores(self, submission):
+        return dict((score.scoredef.key, float(score.value)) for score in SubmissionScore.objects.filter(result=submission))
+
+    def test_scores_sent_by_the_worker_are_saved(self):
+        SubmissionScoreDef.objects.create(competition=self.competition, key='accuracy', label='Accuracy')
+        SubmissionScoreDef.objects.create(competition=self.competition, key='recall', label='Recall')
+        submission, job = self._add_scoring_submission()
+
+        update_submission_task(job.pk, {'status': 'finished',
+                                        'extra': {'scores': [['accuracy', 0.5], ['recall', 0.25], ['unknown', 1]]}})
+
+        self.assertEqual(self._status(submission), CompetitionSubmissionStatus.FINISHED)
+        self.assertEqual(self._scores(submission), {'accuracy': 0.5, 'recall': 0.25})
+
+    def test_scores_queries_do_not_grow_with_the_scores(self):
+        def count_queries(size):
+            keys = ['score%d_%d' % (size, i) for i in range(size)]
+            for key in keys:
+                SubmissionScoreDef.objects.create(competition=self.competition, key=key, label=key)
+            submission, job = self._add_scoring_submission()
+            use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            start = len(connection.queries)
+            try:
+                update_submission_task(job.pk, {'status': 'finished',
+                                                'extra': {'scores': [[key, 1.0] for key in keys]}})
+            finally:
+                connection.use_debug_cursor = use_debug_cursor
+            self.assertEqual(len(self._scores(submission)), size)
+            return len(connection.queries) - start
+
+        self.assertEqual(count_queries(2), count_queries(8))
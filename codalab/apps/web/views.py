@@ -1,12 +1,9 @@
-import csv
 import datetime
 import json
-import os
-import StringIO
+import re
 import sys
 import traceback
 import yaml
-import zipfile
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -17,7 +14,6 @@ from django.core.exceptions import ImproperlyConfigured
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.exceptions import PermissionDenied
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.core.servers.basehttp import FileWrapper
 from django.core.urlresolvers import reverse
 from django.db.models import Q
 from django.http import Http404
@@ -32,6 +28,8 @@ from django.views.generic import View, TemplateView, DetailView, ListView, FormV
 
 from mimetypes import MimeTypes
 
+from apps.web import downloads
+from apps.web import exports
 from apps.web import forms
 from apps.web import models
 from apps.web import tasks
@@ -41,6 +39,7 @@ from apps.forums.models import Forum
 from apps.common.competition_utils import get_most_popular_competitions, get_featured_competitions
 from tasks import evaluate_submission
 from apps.teams.models import TeamMembership, get_user_team, get_competition_teams, get_competition_pending_teams, get_competition_deleted_teams
+from codalabtools import zipstream
 
 
 from extra_views import CreateWithInlinesView, UpdateWithInlinesView, InlineFormSet, NamedFormsetsMixin
@@ -643,9 +642,10 @@ class CompetitionResultsDownload(View):
         phase = competition.phases.get(pk=self.kwargs['phase'])
         if phase.is_blind:
             return HttpResponse(status=403)
-        response = HttpResponse(competition.get_results_csv(phase.pk), status=200, content_type="text/csv")
-        response["Content-Disposition"] = "attachment; filename=%s results.csv" % phase.competition.title
-        return response
+        return exports.export_response(request,
+                                       "%s results" % phase.competition.title,
+                                       lambda: competition.iter_results_rows(phase),
+                                       lambda: competition.iter_results_records(phase))
 
 
 class CompetitionCompleteResultsDownload(View):
@@ -655,63 +655,10 @@ class CompetitionCompleteResultsDownload(View):
         phase = competition.phases.get(pk=self.kwargs['phase'])
         if phase.is_blind:
             return HttpResponse(status=403)
-        groups = phase.scores(include_scores_not_on_leaderboard=True)
-        leader_board = models.PhaseLeaderBoard.objects.get(phase=phase)
-
-        csvfile = StringIO.StringIO()
-        csvwriter = csv.writer(csvfile)
-
-        for group in groups:
-            csvwriter.writerow([group['label'].encode("utf-8")])
-            csvwriter.writerow([])
-
-            headers = ["User"]
-            sub_headers = [""]
-            for header in group['headers']:
-                subs = header['subs']
-                if subs:
-                    for sub in subs:
-                        headers.append(header['label'].encode("utf-8"))
-                        sub_headers.append(sub['label'].encode("utf-8"))
-                else:
-                    headers.append(header['label'].encode("utf-8"))
-            headers.append('Description')
-            headers.append('Date')
-            headers.append('Filename')
-            headers.append('Is on leaderboard?')
-            csvwriter.writerow(headers)
-            csvwriter.writerow(sub_headers)
-
-            if len(group['scores']) <= 0:
-                csvwriter.writerow(["No data available"])
-            else:
-                leader_board_entries = models.PhaseLeaderBoardEntry.objects.filter(board=leader_board).values_list('result__id', flat=True)
-
-                for pk, scores in group['scores']:
-                    submission = models.CompetitionSubmission.objects.get(pk=scores['id'])
-                    row = [scores['username']]
-                    for v in scores['values']:
-                        if 'rnk' in v:
-                            row.append("%s (%s)" % (v['val'], v['rnk']))
-                        else:
-                            row.append("%s (%s)" % (v['val'], v['hidden_rnk']))
-
-                    row.append(submission.description)
-                    row.append(submission.submitted_at)
-                    row.append(submission.get_filename())
-
-                    is_on_leaderboard = submission.pk in leader_board_entries
-                    row.append(is_on_leaderboard)
-
-                    row = [unicode(r).encode("utf-8") for r in row]
-                    csvwriter.writerow(row)
-
-            csvwriter.writerow([])
-            csvwriter.writerow([])
-
-        response = HttpResponse(csvfile.getvalue(), status=200, content_type="text/csv")
-        response["Content-Disposition"] = "attachment; filename=competition_results.csv"
-        return response
+        return exports.export_response(request,
+                                       "competition_results",
+                                       lambda: competition.iter_complete_results_rows(phase),
+                                       lambda: competition.iter_complete_results_records(phase))
 
 ### Views for My Codalab
 
@@ -923,9 +870,47 @@ class MyCompetitionSubmissionToggleMakePublic(LoginRequiredMixin, View):
             raise Http404()
 
 
+def _requested_byte_range(request, size):
+    """
+    Returns the (first, last) positions of the bytes requested from a file of the given size,
+    either as the last bytes of the file with the 'tail' query parameter or as a single range
+    in the Range header. Returns None if the whole file is requested and False if the range
+    cannot be satisfied.
+    """
+    if 'tail' in request.GET:
+        try:
+            length = int(request.GET['tail'])
+        except ValueError:
+            return None
+        if length < 1 or size == 0:
+            return None
+        return max(0, size - length), size - 1
+    match = re.match(r'^bytes=(\d*)-(\d*)$', request.META.get('HTTP_RANGE', '').strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # The last bytes of the file
+        length = int(last)
+        if length == 0 or size == 0:
+            return False
+        return max(0, size - length), size - 1
+    first = int(first)
+    if last != '' and int(last) < first:
+        return None
+    if first >= size:
+        return False
+    last = int(last) if last else size - 1
+    return first, min(last, size - 1)
+
+
 class MyCompetitionSubmissionOutput(LoginRequiredMixin, View):
     """
     This view serves the files associated with a submission.
+
+    Part of a file can be requested with a Range header or, for the last bytes of the file,
+    the 'tail' query parameter. Logs are uploaded while submissions run, so this lets pages
+    follow them without downloading the whole file each time.
     """
     def get(self, request, *args, **kwargs):
         submission = models.CompetitionSubmission.objects.get(pk=kwargs.get('submission_id'))
@@ -950,12 +935,33 @@ class MyCompetitionSubmissionOutput(LoginRequiredMixin, View):
         except:
             return HttpResponse(status=500)
         try:
-            response = HttpResponse(file.read(), status=200, content_type=file_type)
+            byte_range = None
+            if 'tail' in request.GET or 'HTTP_RANGE' in request.META:
+                size = file.size
+                byte_range = _requested_byte_range(request, size)
+            if byte_range is False:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % size
+                return response
+            if byte_range is None and file_type == 'application/zip':
+                # Archives can be large: the storage or the front web server sends them.
+                return downloads.file_response(file, file_type, file_name)
+            if byte_range is not None:
+                first, last = byte_range
+                range_file = file.storage.open(file.name)
+                try:
+                    range_file.seek(first)
+                    content = range_file.read(last - first + 1)
+                finally:
+                    range_file.close()
+                response = HttpResponse(content, status=206, content_type=file_type)
+                response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+            else:
+                response = HttpResponse(file.read(), status=200, content_type=file_type)
+            response['Accept-Ranges'] = 'bytes'
+            response['Content-Type'] = file_type
             if file_type == 'application/zip':
-                response['Content-Type'] = 'application/zip'
                 response['Content-Disposition'] = 'attachment; filename="{0}"'.format(file_name)
-            else:
-                response['Content-Type'] = file_type
             return response
         except azure.WindowsAzureMissingResourceError:
             # for stderr.txt which does not exist when no errors have occurred
@@ -1210,34 +1216,23 @@ def download_dataset(request, dataset_key):
         raise Http404()
 
     try:
-        if dataset.sub_data_files.count() > 0:
-            # TODO: Could refactor this to only zip this stuff up one time, maybe after dataset creation?
-            zip_buffer = StringIO.StringIO()
-
-            zip_file = zipfile.ZipFile(zip_buffer, "w")
-            file_name = ""
-
-            for sub_dataset in dataset.sub_data_files.all():
-                file_dir, file_name = os.path.split(sub_dataset.data_file.file.name)
-                zip_file.writestr(file_name, sub_dataset.data_file.read())
-
-            zip_file.close()
-
-            resp = HttpResponse(zip_buffer.getvalue(), mimetype = "application/x-zip-compressed")
+        members = dataset.get_composite_members()
+        if len(members) > 0:
+            archive = dataset.composite_archive
+            if archive.name and dataset.composite_archive_hash == dataset.get_composite_manifest_hash(members):
+                return downloads.file_response(archive, "application/x-zip-compressed", '%s.zip' % dataset.name)
+            else:
+                # The prebuilt archive is missing or stale: zip the files on the fly until it is rebuilt.
+                if cache.add("dataset_archive_build_%s" % dataset.pk, True, 10 * 60):
+                    tasks.build_dataset_archive(dataset.pk)
+                resp = StreamingHttpResponse(dataset.get_composite_archive_stream(members), content_type="application/x-zip-compressed")
             resp['Content-Disposition'] = 'attachment; filename=%s.zip' % dataset.name
             return resp
         else:
             mime = MimeTypes()
-            file_type = mime.guess_type(dataset.data_file.file.name)
-            response = StreamingHttpResponse(
-                FileWrapper(dataset.data_file.file, blksize=8192 * 100),
-                status=200,
-                content_type=file_type
-            )
-            response['Content-Length'] = dataset.data_file.file.size
-            if file_type != 'text/plain':
-                response['Content-Disposition'] = 'attachment; filename="{0}"'.format(dataset.data_file.file.name)
-            return response
+            file_type = mime.guess_type(dataset.data_file.name)[0] or 'application/octet-stream'
+            file_name = dataset.data_file.name if file_type != 'text/plain' else None
+            return downloads.file_response(dataset.data_file, file_type, file_name)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         print "*** print_tb:"
@@ -1291,12 +1286,11 @@ def download_competition_bundle(request, competition_pk):
         raise Http404()
 
     try:
-        zip_buffer = StringIO.StringIO()
-        zip_file = zipfile.ZipFile(zip_buffer, "w")
+        zip_stream = zipstream.ZipStream()
         yaml_data = yaml.load(competition.original_yaml_file)
 
         # Grab logo
-        zip_file.writestr(yaml_data["image"], competition.image.file.read())
+        zip_stream.add(yaml_data["image"], models.stored_file_reader(competition.image), size=competition.image.size)
 
         # Grab html pages
         for p in competition.pagecontent.pages.all():
@@ -1307,7 +1301,7 @@ def download_competition_bundle(request, competition_pk):
                 if p.codename == 'get_data':
                     # overwrite for consistency
                     p.codename = 'data'
-                zip_file.writestr(yaml_data["html"][p.codename], p.html.encode("utf-8"))
+                zip_stream.add(yaml_data["html"][p.codename], p.html.encode("utf-8"))
 
         # Grab input data, reference data, scoring program
         file_name_cache = []
@@ -1315,26 +1309,27 @@ def download_competition_bundle(request, competition_pk):
         for phase in competition.phases.all():
             for phase_index, phase_yaml in yaml_data["phases"].items():
                 if phase_yaml["phasenumber"] == phase.phasenumber:
-                    if phase.reference_data and phase.reference_data.file.name not in file_name_cache:
-                        yaml_data["phases"][phase_index]["reference_data"] = phase.reference_data.file.name
-                        file_name_cache += phase.reference_data.file.name
-                        zip_file.writestr(phase.reference_data.file.name, phase.reference_data.file.read())
-
-                    if phase.input_data and phase.input_data.file.name not in file_name_cache:
-                        yaml_data["phases"][phase_index]["input_data"] = phase.input_data.file.name
-                        file_name_cache += phase.input_data.file.name
-                        zip_file.writestr(phase.input_data.file.name, phase.input_data.file.read())
-
-                    if phase.scoring_program and phase.scoring_program.file.name not in file_name_cache:
-                        yaml_data["phases"][phase_index]["scoring_program"] = phase.scoring_program.file.name
-                        file_name_cache += phase.scoring_program.file.name
-                        zip_file.writestr(phase.scoring_program.file.name, phase.scoring_program.file.read())
-
-        zip_file.writestr("competition.yaml", yaml.dump(yaml_data))
-
-        zip_file.close()
-
-        resp = HttpResponse(zip_buffer.getvalue(), mimetype = "application/x-zip-compressed")
+                    if phase.reference_data:
+                        yaml_data["phases"][phase_index]["reference_data"] = phase.reference_data.name
+                        if phase.reference_data.name not in file_name_cache:
+                            file_name_cache.append(phase.reference_data.name)
+                            zip_stream.add(phase.reference_data.name, models.stored_file_reader(phase.reference_data), size=phase.reference_data.size)
+
+                    if phase.input_data:
+                        yaml_data["phases"][phase_index]["input_data"] = phase.input_data.name
+                        if phase.input_data.name not in file_name_cache:
+                            file_name_cache.append(phase.input_data.name)
+                            zip_stream.add(phase.input_data.name, models.stored_file_reader(phase.input_data), size=phase.input_data.size)
+
+                    if phase.scoring_program:
+                        yaml_data["phases"][phase_index]["scoring_program"] = phase.scoring_program.name
+                        if phase.scoring_program.name not in file_name_cache:
+                            file_name_cache.append(phase.scoring_program.name)
+                            zip_stream.add(phase.scoring_program.name, models.stored_file_reader(phase.scoring_program), size=phase.scoring_program.size)
+
+        zip_stream.add("competition.yaml", yaml.dump(yaml_data))
+
+        resp = StreamingHttpResponse(zip_stream, content_type="application/x-zip-compressed")
         resp['Content-Disposition'] = 'attachment; filename=%s-%s.zip' % (competition.title, competition.pk)
         return resp
     except:
@@ -1366,8 +1361,7 @@ def download_leaderboard_results(request, competition_pk, phase_pk):
         raise Http404()
 
     try:
-        zip_buffer = StringIO.StringIO()
-        zip_file = zipfile.ZipFile(zip_buffer, "w")
+        zip_stream = zipstream.ZipStream()
 
         # Add teach team name in an easy to read way
         team_name_cache = {}
@@ -1380,17 +1374,17 @@ def download_leaderboard_results(request, competition_pk, phase_pk):
             team_name_string += "Team: %s; members: %s\n" % (name, members)
 
         if team_name_string:
-            zip_file.writestr("team_names_and_members.txt", team_name_string.encode('utf8'))
+            zip_stream.add("team_names_and_members.txt", team_name_string.encode('utf8'))
 
         # Add each submission
         for entry in leaderboard_entries:
             submission = entry.result
             username_or_team_name = submission.participant.user.username if not submission.participant.user.team_name else "Team %s " % submission.participant.user.team_name
             file_name = "%s - %s submission.zip" % (username_or_team_name, submission.submission_number)
-            zip_file.writestr(file_name, submission.file.read())
+            zip_stream.add(file_name, models.stored_file_reader(submission.file), size=submission.file.size)
 
             output_file_name = "%s - %s output.zip" % (username_or_team_name, submission.submission_number)
-            zip_file.writestr(output_file_name, submission.output_file.read())
+            zip_stream.add(output_file_name, models.stored_file_reader(submission.output_file), size=submission.output_file.size)
 
             profile_data_file_name = "%s - %s profile.txt" % (username_or_team_name, submission.submission_number)
 
@@ -1417,16 +1411,14 @@ def download_leaderboard_results(request, competition_pk, phase_pk):
                 'Bibtex': submission.participant.user.bibtex,
             }
             user_profile_data_string = '\n'.join(['%s: %s' % (k, v) for k, v in user_profile_data.items()])
-            zip_file.writestr(profile_data_file_name, user_profile_data_string.encode('utf-8'))
+            zip_stream.add(profile_data_file_name, user_profile_data_string.encode('utf-8'))
 
             metadata_fields = ['method_name', 'method_description', 'project_url', 'publication_url', 'bibtex', 'team_name', 'organization_or_affiliation']
             submission_metadata_file_name = "%s - %s method.txt" % (username_or_team_name, submission.submission_number)
             submission_metadata_file_string = "\n".join(["%s: %s" % (field, getattr(submission, field)) for field in metadata_fields])
-            zip_file.writestr(submission_metadata_file_name, submission_metadata_file_string.encode('utf-8'))
-
-        zip_file.close()
+            zip_stream.add(submission_metadata_file_name, submission_metadata_file_string.encode('utf-8'))
 
-        resp = HttpResponse(zip_buffer.getvalue(), mimetype = "application/x-zip-compressed")
+        resp = StreamingHttpResponse(zip_stream, content_type="application/x-zip-compressed")
         resp['Content-Disposition'] = 'attachment; filename=%s-%s-results.zip' % (competition.title, competition.pk)
         return resp
     except:
@@ -1520,7 +1512,8 @@ def submission_re_run(request, submission_pk):
             )
             new_submission.save(ignore_submission_limits=True)
 
-            evaluate_submission(new_submission.pk, submission.phase.is_scoring_only)
+            evaluate_submission(new_submission.pk, submission.phase.is_scoring_only,
+                                priority=models.ScheduledRun.RERUN)
 
             return HttpResponse()
         except models.CompetitionSubmission.DoesNotExist:
@@ -1550,7 +1543,8 @@ def submission_migrate(request, pk):
 
             new_submission.save(ignore_submission_limits=True)
 
-            evaluate_submission(new_submission.pk, submission.phase.is_scoring_only)
+            evaluate_submission(new_submission.pk, submission.phase.is_scoring_only,
+                                priority=models.ScheduledRun.MIGRATION)
             submission.is_migrated = True
             submission.save()
 
@@ -2,9 +2,21 @@
 Common utilities to interact with Azure Storage.
 """
 
+import base64
 import datetime
+import hashlib
+import hmac
+import logging
+import os
 import os.path
 import re, itertools
+import threading
+import time
+import urllib
+import uuid
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
 from django.core.files.base import File
 from django.core.files.storage import Storage
 from django.core.exceptions import ImproperlyConfigured
@@ -41,30 +53,172 @@ except ImportError:
 
 from storages.utils import setting
 
+from codalabtools.azure_extensions import (BlobExistsError,
+                                           create_only_blob_service,
+                                           get_connection_pool,
+                                           pool_connections)
+from codalabtools.local_storage import LocalBlobService
+from codalabtools.uploader import BlockUploader
+
+
+logger = logging.getLogger(__name__)
+
+# Size of the ranges in which blobs are read.
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Number of ranges read in the background ahead of a sequential reader.
+READ_AHEAD = 2
+
+# Size of the end of a blob which is read at once on its first access. The central directory
+# of a zip archive lives there, so opening an archive takes one request.
+TAIL_SIZE = 64 * 1024
+
+# Number of threads reading ranges ahead for all the open blobs.
+READ_AHEAD_THREADS = 4
+
+# Size of the blocks in which blobs are written.
+WRITE_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Largest block accepted by the version of the storage service the SDK talks to (2011-08-18).
+MAX_WRITE_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Number of blocks uploaded concurrently by a storage.
+UPLOAD_THREADS = 4
+
+# Ways AzureStorage finds a free name for a new file. With NAMING_CONDITIONAL, the blob is
+# created only if its name is free, and under a name with a random suffix otherwise. With
+# NAMING_LIST, the blobs whose name starts like the file's are listed first to find a name
+# with a free numeric suffix.
+NAMING_CONDITIONAL = 'conditional'
+NAMING_LIST = 'list'
+
+# Number of names tried by a conditional save before it gives up.
+MAX_NAME_ATTEMPTS = 5
+
+_read_ahead_pool = None
+_read_ahead_pool_pid = None
+_read_ahead_pool_lock = threading.Lock()
+
+def _get_read_ahead_pool():
+    """Returns the pool of threads reading ranges ahead, creating it in each process on first use."""
+    global _read_ahead_pool, _read_ahead_pool_pid
+    with _read_ahead_pool_lock:
+        if _read_ahead_pool is None or _read_ahead_pool_pid != os.getpid():
+            _read_ahead_pool = ThreadPool(setting("AZURE_READ_AHEAD_THREADS", READ_AHEAD_THREADS))
+            _read_ahead_pool_pid = os.getpid()
+        return _read_ahead_pool
+
+_local_blob_service = None
+_local_blob_service_key = None
+_local_blob_service_lock = threading.Lock()
+
+def get_local_blob_service():
+    """
+    Returns the LocalBlobService standing for every storage account when LOCAL_BLOB_ROOT is
+    set, or None. The service is created once per process and settings.
+    """
+    global _local_blob_service, _local_blob_service_key
+    root = setting("LOCAL_BLOB_ROOT")
+    if not root:
+        return None
+    key = (os.getpid(),
+           root,
+           setting("LOCAL_BLOB_KEY") or settings.SECRET_KEY,
+           setting("LOCAL_BLOB_URL", '/blobs'),
+           tuple(setting("LOCAL_BLOB_PUBLIC_CONTAINERS", [setting("AZURE_CONTAINER")])))
+    with _local_blob_service_lock:
+        if _local_blob_service is None or _local_blob_service_key != key:
+            _local_blob_service = LocalBlobService(root, secret=key[2], base_url=key[3], public_containers=key[4])
+            _local_blob_service_key = key
+        return _local_blob_service
+
+def get_blob_service(account_name, account_key):
+    """
+    Returns the BlobService of a storage account, on pooled connections, or the
+    LocalBlobService if LOCAL_BLOB_ROOT is set.
+    """
+    local_service = get_local_blob_service()
+    if local_service is not None:
+        return local_service
+    return pool_connections(azure.storage.BlobService(account_name, account_key),
+                            get_connection_pool(setting("AZURE_CONNECTION_POOL_SIZE")))
 
 def clean_name(name):
     return os.path.normpath(name).replace("\\", "/")
 
+def _split_name(file_name):
+    """Splits a file name into its root and its extensions, such as 'archive' and '.tar.gz'."""
+    try:
+        return re.match('^([^\.\s]+)(\.\S+)$', file_name).groups()
+    except AttributeError:
+        return (file_name, '')
+
 
 class AzureStorage(Storage):
-    chunk_size = 65536
 
     def __init__(self, *args, **kwargs):
         self.account_name = kwargs.pop('account_name', setting("AZURE_ACCOUNT_NAME"))
         self.account_key = kwargs.pop('account_key', setting("AZURE_ACCOUNT_KEY"))
         self.azure_container = kwargs.pop('azure_container', setting("AZURE_CONTAINER"))
+        self.read_block_size = kwargs.pop('read_block_size', setting("AZURE_READ_BLOCK_SIZE", READ_BLOCK_SIZE))
+        self.read_ahead = kwargs.pop('read_ahead', setting("AZURE_READ_AHEAD", READ_AHEAD))
+        self.write_block_size = kwargs.pop('write_block_size', setting("AZURE_WRITE_BLOCK_SIZE", WRITE_BLOCK_SIZE))
+        if not 0 < self.write_block_size <= MAX_WRITE_BLOCK_SIZE:
+            raise ImproperlyConfigured("AZURE_WRITE_BLOCK_SIZE must be between 1 and %d bytes: %s"
+                                       % (MAX_WRITE_BLOCK_SIZE, self.write_block_size))
+        self.upload_threads = kwargs.pop('upload_threads', setting("AZURE_UPLOAD_THREADS", UPLOAD_THREADS))
+        self.naming = kwargs.pop('naming', setting("AZURE_STORAGE_NAMING", NAMING_CONDITIONAL))
+        if self.naming not in (NAMING_CONDITIONAL, NAMING_LIST):
+            raise ImproperlyConfigured("Unknown AZURE_STORAGE_NAMING: %s" % self.naming)
         super(AzureStorage, self).__init__(*args, **kwargs)
         self._connection = None
+        self._create_only_connection = None
+        self._uploader = None
+        self._uploader_pid = None
+        self._uploader_lock = threading.Lock()
 
     @property
     def connection(self):
         if self._connection is None:
-            self._connection = azure.storage.BlobService(
-                self.account_name, self.account_key)
+            self._connection = get_blob_service(self.account_name, self.account_key)
         return self._connection
 
+    @property
+    def is_local(self):
+        """True if the files are stored by a LocalBlobService."""
+        return isinstance(self.connection, LocalBlobService)
+
+    @property
+    def create_only_connection(self):
+        """A BlobService whose commits fail with BlobExistsError instead of overwriting a blob."""
+        if self._create_only_connection is None:
+            if self.is_local:
+                self._create_only_connection = self.connection.create_only_service()
+            else:
+                self._create_only_connection = create_only_blob_service(self.connection, self.account_name,
+                                                                        self.account_key)
+        return self._create_only_connection
+
+    @property
+    def uploader(self):
+        """
+        The BlockUploader which sends the blocks of the files written to this storage. Each
+        process has its own.
+        """
+        with self._uploader_lock:
+            if self._uploader is None or self._uploader_pid != os.getpid():
+                self._uploader = BlockUploader(self.connection, block_size=self.write_block_size,
+                                               threads=self.upload_threads)
+                self._uploader_pid = os.getpid()
+            return self._uploader
+
     def _open(self, name, mode="rb"):
-        return AzureBlockBlobFile(self.connection, self.azure_container, name, mode)
+        if self.is_local and 'w' not in mode:
+            # Local files are read straight from the file system.
+            return File(open(self.path(name), mode))
+        return AzureBlockBlobFile(self.connection, self.azure_container, name, mode,
+                                  block_size=self.read_block_size, read_ahead=self.read_ahead,
+                                  uploader=self.uploader if 'w' in mode else None)
 
     def exists(self, name):
         try:
@@ -78,18 +232,43 @@ class AzureStorage(Storage):
         self.connection.delete_blob(self.azure_container, name)
 
     def _save(self, name, content):
-        f = self._open(name, 'wb')
-        cur = 0
-        while True:
-            data = content.read(self.chunk_size)
-            if not len(data): break
-            f.write(data)
-        f.close()
-        return name
+        # The blocks of content are uploaded concurrently while the next ones are read, and
+        # committed once.
+        if self.naming == NAMING_LIST:
+            # The name is free (see get_available_name).
+            self.uploader.upload(self.azure_container, clean_name(name), content)
+            return name
+        name = clean_name(name)
+        for attempt in range(MAX_NAME_ATTEMPTS):
+            try:
+                self.uploader.upload(self.azure_container, name, content, commit_service=self.create_only_connection)
+                return name
+            except BlobExistsError:
+                dir_path, file_name = os.path.split(name)
+                file_root, file_ext = _split_name(file_name)
+                name = pathjoin(dir_path, "%s_%s%s" % (file_root, uuid.uuid4().hex[:7], file_ext))
+                logger.debug("Blob exists: saving to %s instead.", name)
+                content.seek(0)
+        raise IOError("Unable to find a free name for %s." % name)
+
+    def path(self, name):
+        if not self.is_local:
+            return super(AzureStorage, self).path(name)
+        return self.connection.blob_path(self.azure_container, clean_name(name))
 
     def url(self, name):
+        if self.is_local:
+            return self.connection.blob_url(self.azure_container, name)
         return "https://%s%s/%s/%s" % (self.account_name, azure.BLOB_SERVICE_HOST_BASE, self.azure_container, name)
 
+    def signed_url(self, name, duration=16, content_disposition=None):
+        """
+        Returns a URL giving read access to a file for duration minutes. The file is sent with
+        the given Content-Disposition header, if any.
+        """
+        return make_blob_sas_url(self.account_name, self.account_key, self.azure_container, clean_name(name),
+                                 permission='r', duration=duration, content_disposition=content_disposition)
+
     def properties(self, name):
         return self.connection.get_blob_properties(
             self.azure_container, name)
@@ -98,12 +277,12 @@ class AzureStorage(Storage):
         return self.properties(name)["content-length"]
 
     def get_available_name(self, name):
+        if self.naming == NAMING_CONDITIONAL:
+            # The name is checked when the blob is created (see _save): no need to list blobs.
+            return clean_name(name)
         dir_path, file_name = os.path.split(name)
         name = clean_name(name)
-        try:
-            file_root, file_ext = re.match('^([^\.\s]+)(\.\S+)$', file_name).groups()
-        except AttributeError:
-            file_root, file_ext = (file_name, '')
+        file_root, file_ext = _split_name(file_name)
         path_prefix = pathjoin(dir_path, file_root)
         file_list = {f.name: True for f in self.connection.list_blobs(self.azure_container, path_prefix)}
         ct = itertools.count(1)
@@ -113,24 +292,55 @@ class AzureStorage(Storage):
 
 
 class AzureBlockBlobFile(RawIOBase):
+    """
+    A file backed by a Block Blob.
+
+    Reads are buffered: the blob is read in ranges of block_size bytes, which are kept for the
+    next reads, and while the blob is read sequentially the next read_ahead ranges are read in
+    the background. The last TAIL_SIZE bytes of the blob are read together on their first
+    access. Seeking only moves the position.
 
-    def __init__(self, connection, container, name, mode):
+    Writes are gathered into the blocks of a BlockUploader, which sends them concurrently
+    while the next ones are written; the blob is committed when the file is closed.
+    """
+
+    def __init__(self, connection, container, name, mode, block_size=READ_BLOCK_SIZE, read_ahead=READ_AHEAD,
+                 tail_size=TAIL_SIZE, uploader=None):
         name = clean_name(name)
         self.connection = connection
         self.name = name
         self.container = container
         self.mode = mode
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.tail_size = tail_size
         self._properties = None
+        self._writer = None
+        self._own_uploader = None
+        self._cur = 0
+        self._lock = threading.Lock()
+        # Ranges read so far, by index, least recently used first.
+        self._blocks = OrderedDict()
+        # Ranges being read ahead, by index.
+        self._pending = {}
+        self._last_block = -1
+        self._tail = None
+        self._requests = 0
+        self._bytes_read = 0
+        self._opened_at = time.time()
         if 'w' in mode:
             try:
                 self.properties
                 if 'a' not in mode:
                     raise Exception("File Already Exists.")
             except azure.WindowsAzureMissingResourceError as e:
-                res = self.connection.put_blob(self.container, self.name, '', "BlockBlob")
-        self._cur = 0
-        self._end = (int(self.properties['content-length']) - 1) if int(self.properties['content-length']) > 0 else 0
-        self._block_list = []
+                pass
+            if uploader is None:
+                uploader = self._own_uploader = BlockUploader(self.connection, threads=1)
+            self._writer = uploader.writer(self.container, self.name)
+        else:
+            # Opening a missing blob fails here rather than on the first read.
+            self.properties
 
     @property
     def properties(self):
@@ -142,66 +352,173 @@ class AzureBlockBlobFile(RawIOBase):
     def size(self):
         return int(self.properties.get('content-length'))
 
+    @property
+    def request_count(self):
+        """The number of range requests sent to read the blob."""
+        return self._requests
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
     def seek(self, offset, from_what=0):
         if from_what == 2:
-            pos = int(offset) + (self.size - 1)
+            pos = self.size + int(offset)
         elif from_what == 1:
             pos = self._cur + int(offset)
         else:
             pos = int(offset)
-        self.flush()
-        if pos > self._end:
-            raise Exception("Cannot seek past end of file")
+        if pos < 0:
+            raise IOError("Cannot seek before the beginning of the file")
         self._cur = pos
+        return self._cur
 
     def tell(self):
         return self._cur
 
-    def read(self, num_bytes=None):
-        start = self._cur
-        if not num_bytes:
-            end = self.size -1
-        else:
-            end = self._cur+num_bytes-1
-        if self._cur > self._end:
-            raise Exception("Something odd happened.")
-        if self._cur == self._end and not num_bytes:
-            return None
-        if self._end < end:
-            end = self._end
-        content = self.connection.get_blob(self.container,
-                                           self.name,
-                                           x_ms_range='bytes=%d-%d' % (start, end))
-        self._cur = self._cur + len(content) if self._cur < self._end else self._end
+    def _fetch(self, start, end):
+        """Reads the bytes of the blob from start to end (excluded) in one request."""
+        content = self.connection.get_blob(self.container, self.name, x_ms_range='bytes=%d-%d' % (start, end - 1))
+        with self._lock:
+            self._requests += 1
+            self._bytes_read += len(content)
         return content
 
+    def _fetch_block(self, index):
+        # Blocks stop where the tail starts, so no byte is read twice.
+        start = index * self.block_size
+        return self._fetch(start, min(start + self.block_size, self._tail_start()))
+
+    def _get_block(self, index):
+        """Returns a range of the blob, reading it unless it was kept or read ahead."""
+        with self._lock:
+            if index in self._blocks:
+                data = self._blocks.pop(index)
+                self._blocks[index] = data
+                return data
+            pending = self._pending.pop(index, None)
+        data = None
+        if pending is not None:
+            try:
+                data = pending.get()
+            except Exception:
+                logger.warning("Failed to read ahead %s; reading it again.", self.name, exc_info=True)
+        if data is None:
+            data = self._fetch_block(index)
+        with self._lock:
+            self._blocks[index] = data
+            while len(self._blocks) > self.read_ahead + 2:
+                self._blocks.popitem(last=False)
+        return data
+
+    def _schedule_read_ahead(self, index):
+        last_index = (self._tail_start() - 1) // self.block_size
+        pool = None
+        for ahead in range(index + 1, min(index + self.read_ahead, last_index) + 1):
+            with self._lock:
+                if ahead in self._blocks or ahead in self._pending:
+                    continue
+                pool = pool or _get_read_ahead_pool()
+                self._pending[ahead] = pool.apply_async(self._fetch_block, (ahead,))
+
+    def _tail_start(self):
+        return max(0, self.size - self.tail_size)
+
+    def read(self, num_bytes=-1):
+        size = self.size
+        if num_bytes is None or num_bytes < 0:
+            num_bytes = max(0, size - self._cur)
+        end = min(self._cur + num_bytes, size)
+        tail_start = self._tail_start()
+        chunks = []
+        while self._cur < end:
+            if self._cur >= tail_start:
+                if self._tail is None:
+                    self._tail = self._fetch(tail_start, size)
+                data, offset = self._tail, self._cur - tail_start
+            else:
+                index = self._cur // self.block_size
+                data, offset = self._get_block(index), self._cur - index * self.block_size
+                if index == self._last_block + 1 and self.read_ahead > 0:
+                    self._schedule_read_ahead(index)
+                self._last_block = index
+            chunk = data[offset:offset + end - self._cur]
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+            self._cur += len(chunk)
+        return ''.join(chunks)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def writable(self):
+        return 'w' in self.mode
+
     def write(self, data):
-        blockid = "%6d" % len(self._block_list)
-        try:
-            self.connection.put_block(self.container, self.name, data, blockid)
-            self._block_list.append((blockid, len(data)))
-            return len(data)
-        except azure.WindowsAzureError as e:
-            raise e
+        return self._writer.write(data)
 
     def flush(self):
-        if self._block_list:
-            self.connection.put_block_list(self.container, self.name, [b[0] for b in self._block_list])
-            self._end = sum([b[1] for b in self._block_list]) - 1
-            self._cur = 0
-            self._block_list = []
+        # Written blocks are committed once, when the file is closed.
+        pass
 
     def close(self):
-        self.flush()
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            try:
+                writer.close()
+            finally:
+                if self._own_uploader is not None:
+                    self._own_uploader.close()
+        if self._requests > 0 and (self._blocks or self._tail is not None):
+            elapsed = time.time() - self._opened_at
+            logger.debug("Read %d bytes of %s in %d requests (%.1f MB/s).", self._bytes_read, self.name,
+                         self._requests, self._bytes_read / (1024.0 * 1024.0) / max(elapsed, 0.001))
+        with self._lock:
+            self._blocks.clear()
+            self._pending.clear()
+            self._tail = None
 
 PREFERRED_STORAGE_X_MS_VERSION = '2013-08-15'
 
+def _make_versioned_sas_query(account_name, account_key, container_name, blob_name, permission, start, expiry,
+                              content_disposition):
+    """
+    Returns the query string of a Blob SAS of version PREFERRED_STORAGE_X_MS_VERSION, which
+    makes the storage service send the Blob with the given Content-Disposition header. The SDK
+    only signs older versions, which cannot override response headers.
+    """
+    string_to_sign = '\n'.join((permission,
+                                start,
+                                expiry,
+                                '/%s/%s/%s' % (account_name, container_name, blob_name),
+                                '',  # signed identifier
+                                PREFERRED_STORAGE_X_MS_VERSION,
+                                '',  # rscc
+                                content_disposition,
+                                '',  # rsce
+                                '',  # rscl
+                                ''))  # rsct
+    signature = hmac.new(base64.b64decode(account_key), string_to_sign.encode('utf-8'), hashlib.sha256).digest()
+    return urllib.urlencode([('sv', PREFERRED_STORAGE_X_MS_VERSION),
+                             ('st', start),
+                             ('se', expiry),
+                             ('sr', RESOURCE_BLOB),
+                             ('sp', permission),
+                             ('rscd', content_disposition),
+                             ('sig', base64.b64encode(signature))])
+
 def make_blob_sas_url(account_name,
                       account_key,
                       container_name,
                       blob_name,
                       permission='w',
-                      duration=16):
+                      duration=16,
+                      content_disposition=None):
     """
     Generate a Blob SAS URL to allow a client to upload a file.
 
@@ -212,14 +529,26 @@ def make_blob_sas_url(account_name,
     duration: A timedelta representing duration until SAS expiration.
        SAS start date will be utcnow() minus one minute. Expiry date
        is start date plus duration.
+    content_disposition: Optional Content-Disposition header with which the Blob is read
+       through the URL.
 
-    Returns the SAS URL.
+    Returns the SAS URL, or a URL signed by the LocalBlobService if LOCAL_BLOB_ROOT is set.
     """
+    local_service = get_local_blob_service()
+    if local_service is not None:
+        expiry = time.time() + duration * 60
+        return local_service.make_blob_url(container_name, blob_name, permission, expiry,
+                                           content_disposition=content_disposition)
     sas = SharedAccessSignature(account_name, account_key)
     resource_path = '%s/%s' % (container_name, blob_name)
     date_format = "%Y-%m-%dT%H:%M:%SZ"
     start = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
     expiry = start + datetime.timedelta(minutes=duration)
+    if content_disposition is not None:
+        query = _make_versioned_sas_query(account_name, account_key, container_name, blob_name, permission,
+                                          start.strftime(date_format), expiry.strftime(date_format),
+                                          content_disposition)
+        return 'https://{0}.blob.core.windows.net/{1}/{2}?{3}'.format(account_name, container_name, blob_name, query)
     sap = SharedAccessPolicy(AccessPolicy(
             start.strftime(date_format), 
             expiry.strftime(date_format),
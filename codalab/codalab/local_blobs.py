@@ -0,0 +1,133 @@
+"""
+Serves the Blobs of the LocalBlobService configured by LOCAL_BLOB_ROOT.
+
+The view stands for the Blob endpoint of Azure Storage, so the URLs returned by
+make_blob_sas_url work the same way with local storage: GET reads a Blob (with one byte range
+at most), and PUT writes a Blob whole, a block of a Blob (comp=block) or its block list
+(comp=blocklist).
+"""
+import logging
+import re
+
+from xml.etree import ElementTree
+
+from azure import WindowsAzureError, WindowsAzureMissingResourceError
+from django.core.servers.basehttp import FileWrapper
+from django.http import (Http404,
+                         HttpResponse,
+                         HttpResponseBadRequest,
+                         HttpResponseForbidden,
+                         HttpResponseNotAllowed,
+                         StreamingHttpResponse)
+from django.views.decorators.csrf import csrf_exempt
+
+from codalab.azure_storage import get_local_blob_service
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks in which Blobs are sent.
+CHUNK_SIZE = 64 * 1024
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _range_reader(blob_file, size):
+    """Yields the next size bytes of a file in chunks, then closes it."""
+    try:
+        while size > 0:
+            chunk = blob_file.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                break
+            size -= len(chunk)
+            yield chunk
+    finally:
+        blob_file.close()
+
+
+def _get(request, service, container, blob_name):
+    try:
+        properties = service.get_blob_properties(container, blob_name)
+    except WindowsAzureMissingResourceError:
+        raise Http404()
+    if request.META.get('HTTP_IF_NONE_MATCH') == properties['etag']:
+        return HttpResponse(status=304)
+    size = int(properties['content-length'])
+    start, end = 0, size - 1
+    match = _RANGE_RE.match(request.META.get('HTTP_RANGE', '') or request.META.get('HTTP_X_MS_RANGE', ''))
+    if match and (match.group(1) or match.group(2)):
+        if match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+        else:
+            start = max(0, size - int(match.group(2)))
+        if start > end:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+    blob_file = open(service.blob_path(container, blob_name), 'rb')
+    if request.method == 'HEAD':
+        blob_file.close()
+        response = HttpResponse(status=200)
+    elif start == 0 and end == size - 1:
+        response = StreamingHttpResponse(FileWrapper(blob_file, CHUNK_SIZE), status=200)
+    else:
+        blob_file.seek(start)
+        response = StreamingHttpResponse(_range_reader(blob_file, end + 1 - start), status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    response['Content-Type'] = properties['content-type']
+    response['Content-Length'] = str(max(0, end + 1 - start))
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = properties['etag']
+    response['Last-Modified'] = properties['last-modified']
+    if request.GET.get('rscd'):
+        # The signed URL overrides the header, like a SAS.
+        response['Content-Disposition'] = request.GET['rscd']
+    return response
+
+
+def _put(request, service, container, blob_name):
+    comp = request.GET.get('comp')
+    content_type = request.META.get('HTTP_X_MS_BLOB_CONTENT_TYPE') or None
+    try:
+        if comp == 'block':
+            service.put_block(container, blob_name, request.body, request.GET.get('blockid', '').encode('utf-8'),
+                              content_md5=request.META.get('HTTP_CONTENT_MD5'))
+        elif comp == 'blocklist':
+            block_list = [element.text.strip().encode('utf-8')
+                          for element in ElementTree.fromstring(request.body)
+                          if element.tag in ('Latest', 'Committed', 'Uncommitted')]
+            service.put_block_list(container, blob_name, block_list, x_ms_blob_content_type=content_type)
+        elif comp is None:
+            service.put_blob(container, blob_name, request.body, request.META.get('HTTP_X_MS_BLOB_TYPE'),
+                             content_md5=request.META.get('HTTP_CONTENT_MD5'), x_ms_blob_content_type=content_type)
+        else:
+            return HttpResponseBadRequest("Unsupported operation: %s" % comp)
+    except (WindowsAzureError, ElementTree.ParseError) as e:
+        logger.warning("Failed to write %s/%s: %s", container, blob_name, e)
+        return HttpResponseBadRequest(str(e))
+    return HttpResponse(status=201)
+
+
+@csrf_exempt
+def serve_blob(request, container, blob_name):
+    """
+    Reads or writes a Blob given a URL signed by the LocalBlobService.
+    """
+    service = get_local_blob_service()
+    if service is None:
+        raise Http404()
+    if request.method in ('GET', 'HEAD'):
+        permission = 'r'
+    elif request.method == 'PUT':
+        permission = 'w'
+    else:
+        return HttpResponseNotAllowed(['GET', 'HEAD', 'PUT'])
+    try:
+        service.blob_path(container, blob_name)
+    except WindowsAzureError:
+        raise Http404()
+    if not service.check_blob_url(container, blob_name, permission, request.GET):
+        return HttpResponseForbidden()
+    if permission == 'r':
+        return _get(request, service, container, blob_name)
+    return _put(request, service, container, blob_name)
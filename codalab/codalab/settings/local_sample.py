@@ -26,6 +26,8 @@ class Dev(DevBase):
     BUNDLE_AZURE_ACCOUNT_NAME = AZURE_ACCOUNT_NAME
     BUNDLE_AZURE_ACCOUNT_KEY = AZURE_ACCOUNT_KEY
     BUNDLE_AZURE_CONTAINER = 'name_of_your_private_container_for_bundles'
+    # Uncomment to store the containers above in a local directory instead of Azure.
+    # LOCAL_BLOB_ROOT = '/var/lib/codalab/blobs'
 
     # Service Bus
     SBS_NAMESPACE = '<enter name>'
@@ -28,6 +28,9 @@ urlpatterns = patterns('',
     url(r'^media/(?P<path>.*)$', 'django.views.static.serve',
         {'document_root': settings.MEDIA_ROOT}),
 
+    # Blobs of the local storage (see LOCAL_BLOB_ROOT)
+    url(r'^blobs/(?P<container>[^/]+)/(?P<blob_name>.+)$', 'codalab.local_blobs.serve_blob', name='local_blob'),
+
     # JS Reverse for saner AJAX calls
     url(r'^jsreverse/$', 'django_js_reverse.views.urls_js', name='js_reverse')
 )
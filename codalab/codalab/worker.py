@@ -5,6 +5,7 @@ Defines the worker process which handles background tasks for the web site.
 import logging
 import os
 import sys
+import threading
 import time
 from os.path import dirname, abspath, basename
 
@@ -17,7 +18,9 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "codalab.settings")
 from configurations import importer
 importer.install()
 
-from codalabtools import BaseWorker
+from django.conf import settings
+
+from codalabtools import PoolWorker
 from apps.jobs.models import (update_job_status_task,
                               getQueue,
                               Job)
@@ -25,7 +28,10 @@ from apps.web.tasks import (echo_task,
                             create_competition_task,
                             evaluate_submission_task,
                             update_submission_task,
-                            send_mass_email_task)
+                            update_submission_batch_task,
+                            send_mass_email_task,
+                            build_dataset_archive_task)
+from apps.web.scheduling import dispatch_runs_periodically
 
 logger = logging.getLogger('codalab')
 
@@ -40,9 +46,19 @@ def start_worker():
         'create_competition': create_competition_task,
         'evaluate_submission': evaluate_submission_task,
         'run_update': update_submission_task,
-        'send_mass_email': send_mass_email_task
+        'run_update_batch': update_submission_batch_task,
+        'send_mass_email': send_mass_email_task,
+        'build_dataset_archive': build_dataset_archive_task
     }
-    worker = BaseWorker(queue, vtable, logger)
+    worker = PoolWorker(queue, vtable, logger,
+                        executors=settings.SITE_WORKER_EXECUTORS,
+                        executor_type=settings.SITE_WORKER_EXECUTOR_TYPE,
+                        prefetch=settings.SITE_WORKER_PREFETCH,
+                        limits=settings.SITE_WORKER_TASK_LIMITS)
+    # Expired runs make room in flight even when no run is scheduled or completes.
+    dispatcher = threading.Thread(target=dispatch_runs_periodically, args=(threading.Event(),))
+    dispatcher.daemon = True
+    dispatcher.start()
     logger.info("Starting site worker.")
     worker.start()
 
@@ -2,14 +2,17 @@
 Package containing the CodaLab client tools.
 """
 
+import importlib
 import json
 import logging
 import multiprocessing
 import os
+import random
+import threading
 import yaml
 import time
 
-from Queue import Empty
+from Queue import Empty, Queue as ThreadQueue
 
 class BaseConfig(object):
     """
@@ -53,6 +56,15 @@ class Queue(object):
         """
         raise NotImplementedError()
 
+    def receive_messages(self, max_count):
+        """
+        Gets up to max_count messages from the queue.
+
+        Returns a list of QueueMessage instances, which is empty if no message was received.
+        """
+        msg = self.receive_message()
+        return [] if msg is None else [msg]
+
     def send_message(self, body):
         """
         Sends a message to the queue.
@@ -61,6 +73,15 @@ class Queue(object):
         """
         raise NotImplementedError()
 
+    def send_messages(self, bodies):
+        """
+        Sends several messages to the queue.
+
+        bodies: A list of strings representing the bodies of the messages.
+        """
+        for body in bodies:
+            self.send_message(body)
+
 class QueueMessage(object):
     """
     Provides an abstract definition for a message exchanged through a queue.
@@ -71,6 +92,57 @@ class QueueMessage(object):
     def get_queue(self):
         """Gets the Queue instance from which the message was retrieved."""
         raise NotImplementedError()
+    def ack(self):
+        """
+        Removes the message from the queue once the receiver has taken charge of it. Queues
+        which hide received messages for a visibility timeout deliver them again if they are
+        not acknowledged in time; queues which remove messages as soon as they are received
+        ignore acknowledgements.
+        """
+        pass
+
+# Queue backends: map a backend name to the dotted path of a function which creates a Queue
+# given the name of the queue and the backend's options as keyword arguments.
+_QUEUE_BACKENDS = {
+    'azure': 'codalabtools.azure_extensions.create_queue',
+    'sql': 'codalabtools.sql_queue.create_queue',
+}
+
+def register_queue_backend(backend, factory):
+    """
+    Registers a queue backend.
+
+    backend: The name of the backend.
+    factory: A function, or the dotted path of a function, which returns a Queue given the
+        name of the queue and the backend's options as keyword arguments.
+    """
+    _QUEUE_BACKENDS[backend] = factory
+
+def create_queue(backend, name, **options):
+    """
+    Returns a Queue given the name of its backend, its own name and the backend's options.
+    """
+    if backend not in _QUEUE_BACKENDS:
+        raise ValueError("Unknown queue backend: %s" % backend)
+    factory = _QUEUE_BACKENDS[backend]
+    if isinstance(factory, basestring):
+        module_name, function_name = factory.rsplit('.', 1)
+        factory = getattr(importlib.import_module(module_name), function_name)
+    return factory(name, **options)
+
+def backoff_delay(attempt, base, cap=60):
+    """
+    Returns the number of seconds to wait before retrying a request which failed.
+
+    The delay grows exponentially with the attempt but is capped, and half of it is random so
+    that clients which failed together do not retry together.
+
+    attempt: The number of retries made so far, starting at 0.
+    base: The delay in seconds before the first retry, before jitter.
+    cap: The maximum delay in seconds.
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
 
 class QueueMessageError(Exception):
     """Indicates that the body of a queue message cannot be decoded or is invalid."""
@@ -100,72 +172,325 @@ def decode_message_body(message):
         raise QueueMessageError("Missing key: task_type.")
     return data
 
+def parse_scores(text):
+    """
+    Returns the scores of a scores.txt file as a list of (key, value) pairs, where each
+    non-empty line of the file reads 'key: value' and value is a number.
+
+    Raises ValueError if a line is malformed.
+    """
+    scores = []
+    for line in text.split("\n"):
+        if len(line.strip()) > 0:
+            label, value = line.split(":")
+            scores.append((label.strip(), float(value)))
+    return scores
+
 class BaseWorker(object):
     """
     Defines the base implementation for a worker process which listens to a queue for
     messages. Each message defines a task. When the worker receives a message, it performs
     the task then goes back to listening mode.
+
+    A worker has one or more execution slots. Each slot is a process which listens to the
+    queue only while it is not running a task, so a worker never takes more tasks than it
+    has slots to run them.
     """
 
-    def __init__(self, queue, vtable, logger):
+    # Seconds after which a slot waiting for a message is considered stuck and restarted.
+    LISTEN_TIMEOUT = 120
+
+    def __init__(self, queue, vtable, logger, slots=1):
         """
         queue: The Queue object to listen to.
         vtable: A map from a task type to a function which contructs a runnable task. Given a
             message with an identifier I, a task type T and task arguments A, the function
             constructed to run the task is: F = vtable[T](I, A). And F() runs the task.
+            vtable may also be a function which returns the map for a given slot number; it
+            is called in the slot's process, which lets tasks use per-slot resources.
         logger: The logging.Logger object to use.
+        slots: The number of tasks run concurrently.
         """
         self.queue = queue
         self.logger = logger
         self.vtable = vtable
+        self.slots = slots
 
-    def _message_receive_listen(self, queue):
+    def _message_receive_listen(self, queue, slot=0):
+        vtable = self.vtable(slot) if callable(self.vtable) else self.vtable
         while True:
             try:
-                self.logger.debug("Waiting for message.")
-                queue.put('waiting for message')
+                self.logger.debug("Waiting for message (slot=%s).", slot)
+                queue.put((slot, 'waiting for message'))
                 msg = self.queue.receive_message()
-                queue.put('received message')
+                queue.put((slot, 'received message'))
                 if msg is not None:
                     self.logger.debug("Received message: %s", msg.get_body())
+                    # The slot takes charge of the task, which may run for longer than the queue's
+                    # visibility timeout.
+                    msg.ack()
                     data = decode_message_body(msg)
                     task_id = data['id']
                     task_type = data['task_type']
                     task_args = data['task_args'] if 'task_args' in data else None
-                    if task_type in self.vtable:
-                        self.logger.info("Running task: id=%s task_type=%s", task_id, task_type)
-                        self.vtable[task_type](task_id, task_args)
-                        self.logger.info("Task complete: id=%s task_type=%s", task_id, task_type)
+                    if task_type in vtable:
+                        self.logger.info("Running task: id=%s task_type=%s slot=%s", task_id, task_type, slot)
+                        vtable[task_type](task_id, task_args)
+                        self.logger.info("Task complete: id=%s task_type=%s slot=%s", task_id, task_type, slot)
                     else:
                         self.logger.warning("Unknown task_type=%s for task with id=%s", task_type, task_id)
             # catch all non-"system exiting" exceptions
             except Exception:
                 self.logger.exception("An error has occurred.")
 
+    def _start_slot(self, queue, slot):
+        worker = multiprocessing.Process(target=self._message_receive_listen, args=(queue, slot))
+        worker.start()
+        return worker
+
     def start(self):
         """
         Starts the worker loop on the current thread.
         """
-        self.logger.debug("BaseWorker entering worker loop.")
+        self.logger.debug("BaseWorker entering worker loop with %d slot(s).", self.slots)
 
-        last_message = None
-        queue = multiprocessing.Queue(8)
-        worker = multiprocessing.Process(target=self._message_receive_listen, args=(queue,))
-        worker.start()
+        queue = multiprocessing.Queue(8 * self.slots)
+        workers = {}
+        last_messages = {}
+        for slot in range(self.slots):
+            workers[slot] = self._start_slot(queue, slot)
+            last_messages[slot] = (None, time.time())
 
         while True:
             try:
-                result = queue.get(True, 120)
+                slot, result = queue.get(True, self.LISTEN_TIMEOUT)
+                last_messages[slot] = (result, time.time())
+                self.logger.debug("Process thread status result: %s (slot=%s)" % (result, slot))
             except Empty:
-                result = None
+                self.logger.debug("Process thread status result: None")
 
-            self.logger.debug("Process thread status result: %s" % result)
+            now = time.time()
+            for slot in range(self.slots):
+                last_message, received_at = last_messages[slot]
+                # We don't want to shut off submissions in process, so only terminate if we're waiting for a message
+                if last_message == 'waiting for message' and now - received_at >= self.LISTEN_TIMEOUT:
+                    self.logger.debug("Restarting worker thread (slot=%s)", slot)
+                    workers[slot].terminate()
+                    workers[slot] = self._start_slot(queue, slot)
+                    last_messages[slot] = (None, now)
 
-            # We don't want to shut off submissions in process, so only terminate if we're waiting for a message
-            if last_message == 'waiting for message' and result is None:
-                self.logger.debug("Restarting worker thread")
-                worker.terminate()
-                worker = multiprocessing.Process(target=self._message_receive_listen, args=(queue,))
-                worker.start()
 
-            last_message = result
+class PoolWorker(BaseWorker):
+    """
+    Defines a worker which runs the tasks of several messages at once on a pool of executors.
+
+    A receiver process fetches messages from the queue ahead of time, keeping at most
+    `prefetch` of them waiting for an executor. Each task is handed to a free executor, which
+    is a thread or a process, so a slow task only holds up its own executor. At most
+    `limits[T]` tasks of type T run at once: a message whose task type is at its limit waits
+    without holding up messages of other types, and without counting against `prefetch`.
+
+    The worker keeps track of the tasks in flight on each executor. Its supervisor restarts
+    the receiver when it is stuck waiting for a message and replaces executor processes which
+    died, but never interrupts an executor running a task.
+    """
+
+    THREAD = 'thread'
+    PROCESS = 'process'
+
+    # Seconds between two checks of the receiver and the executors.
+    SUPERVISE_INTERVAL = 5
+
+    def __init__(self, queue, vtable, logger, executors=4, executor_type=THREAD, prefetch=None, limits=None):
+        """
+        queue: The Queue object to listen to.
+        vtable: A map from a task type to the function which runs the task (see BaseWorker).
+        logger: The logging.Logger object to use.
+        executors: The number of tasks run concurrently.
+        executor_type: PoolWorker.THREAD or PoolWorker.PROCESS.
+        prefetch: The maximum number of messages received ahead of time. Defaults to the
+            number of executors.
+        limits: An optional map from a task type to the maximum number of tasks of that type
+            run concurrently.
+        """
+        super(PoolWorker, self).__init__(queue, vtable, logger, slots=executors)
+        if executor_type not in (PoolWorker.THREAD, PoolWorker.PROCESS):
+            raise ValueError("Invalid executor type: %s" % executor_type)
+        self.executor_type = executor_type
+        self.prefetch = prefetch or executors
+        self.limits = limits or {}
+        self.in_flight = {}
+        self._stopped = threading.Event()
+
+    def _receive_messages(self, events, permits):
+        while True:
+            permits.acquire()
+            # Receive as many messages at once as there are free prefetch buffers.
+            count = 1
+            while count < self.prefetch and permits.acquire(False):
+                count += 1
+            received = 0
+            try:
+                events.put(('receiver', ('waiting for message', count)))
+                msgs = self.queue.receive_messages(count)
+                events.put(('receiver', ('received message', 0)))
+                for msg in msgs:
+                    events.put(('message', msg.get_body()))
+                    msg.ack()
+                    received += 1
+            except Exception:
+                self.logger.exception("An error has occurred while receiving a message.")
+            finally:
+                for _ in range(count - received):
+                    permits.release()
+
+    def _execute_tasks(self, executor, tasks, events):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            task_id, task_type, task_args = task
+            try:
+                self.logger.info("Running task: id=%s task_type=%s executor=%s", task_id, task_type, executor)
+                self.vtable[task_type](task_id, task_args)
+                self.logger.info("Task complete: id=%s task_type=%s executor=%s", task_id, task_type, executor)
+            except Exception:
+                self.logger.exception("An error has occurred (task id=%s task_type=%s).", task_id, task_type)
+            events.put(('done', executor))
+
+    def _start_receiver(self, events, permits):
+        receiver = multiprocessing.Process(target=self._receive_messages, args=(events, permits))
+        receiver.daemon = True
+        receiver.start()
+        return receiver
+
+    def _start_executor(self, executor, events):
+        if self.executor_type == PoolWorker.PROCESS:
+            tasks = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=self._execute_tasks, args=(executor, tasks, events))
+        else:
+            tasks = ThreadQueue()
+            worker = threading.Thread(target=self._execute_tasks, args=(executor, tasks, events))
+        worker.daemon = True
+        worker.start()
+        return worker, tasks
+
+    def _dispatch(self, pending, executors, permits):
+        """
+        Hands pending tasks to free executors, in order, within the limits of their task types.
+
+        `pending` holds [task, holds_permit] pairs. A task whose type is at its limit gives back
+        its prefetch permit while it waits, so that it does not keep the receiver from fetching
+        messages of other types. At most `prefetch` tasks of each type wait without a permit.
+        """
+        running = {}
+        for task_id, task_type, started_at in self.in_flight.values():
+            running[task_type] = running.get(task_type, 0) + 1
+        parked = {}
+        for (task_id, task_type, task_args), holds_permit in pending:
+            if not holds_permit:
+                parked[task_type] = parked.get(task_type, 0) + 1
+        free = [executor for executor in sorted(executors) if executor not in self.in_flight]
+        for entry in list(pending):
+            task, holds_permit = entry
+            task_id, task_type, task_args = task
+            if running.get(task_type, 0) >= self.limits.get(task_type, self.slots):
+                if holds_permit and parked.get(task_type, 0) < self.prefetch:
+                    entry[1] = False
+                    parked[task_type] = parked.get(task_type, 0) + 1
+                    permits.release()
+                continue
+            if len(free) == 0:
+                continue
+            pending.remove(entry)
+            if holds_permit:
+                permits.release()
+            else:
+                parked[task_type] -= 1
+            executor = free.pop(0)
+            self.in_flight[executor] = (task_id, task_type, time.time())
+            running[task_type] = running.get(task_type, 0) + 1
+            executors[executor][1].put(task)
+
+    def stop(self):
+        """
+        Stops the worker loop. `start` returns once the tasks in flight are done.
+        """
+        self._stopped.set()
+
+    def start(self):
+        """
+        Starts the worker loop on the current thread.
+        """
+        self.logger.debug("PoolWorker entering worker loop with %d %s executor(s).", self.slots, self.executor_type)
+        events = multiprocessing.Queue()
+        permits = multiprocessing.Semaphore(self.prefetch)
+        receiver = self._start_receiver(events, permits)
+        receiver_state = ((None, 0), time.time())
+        executors = {}
+        for executor in range(self.slots):
+            executors[executor] = self._start_executor(executor, events)
+        pending = []
+        try:
+            while not self._stopped.is_set():
+                try:
+                    source, result = events.get(True, self.SUPERVISE_INTERVAL)
+                    if source == 'receiver':
+                        receiver_state = (result, time.time())
+                    elif source == 'message':
+                        try:
+                            data = decode_message_body(_Message(result))
+                        except QueueMessageError:
+                            self.logger.exception("Invalid message: %s", result)
+                            permits.release()
+                        else:
+                            task_type = data['task_type']
+                            if task_type in self.vtable:
+                                pending.append([(data['id'], task_type, data.get('task_args')), True])
+                            else:
+                                self.logger.warning("Unknown task_type=%s for task with id=%s", task_type, data['id'])
+                                permits.release()
+                    elif source == 'done':
+                        self.in_flight.pop(result, None)
+                except Empty:
+                    self.logger.debug("Tasks in flight: %s", self.in_flight.values())
+
+                self._replace_dead_executors(executors, events)
+                (state, held_permits), changed_at = receiver_state
+                if state == 'waiting for message' and time.time() - changed_at >= self.LISTEN_TIMEOUT:
+                    self.logger.debug("Restarting message receiver.")
+                    receiver.terminate()
+                    # Give back the permits the receiver held while it waited for messages.
+                    for _ in range(held_permits):
+                        permits.release()
+                    receiver = self._start_receiver(events, permits)
+                    receiver_state = ((None, 0), time.time())
+                self._dispatch(pending, executors, permits)
+        finally:
+            receiver.terminate()
+            if len(pending) > 0:
+                self.logger.warning("Dropping %d task(s) received but not started.", len(pending))
+            for worker, tasks in executors.values():
+                tasks.put(None)
+            for worker, tasks in executors.values():
+                worker.join()
+
+    def _replace_dead_executors(self, executors, events):
+        """Replaces the executor processes which died, along with the task they were running."""
+        for executor, (worker, tasks) in executors.items():
+            if worker.is_alive():
+                continue
+            if executor in self.in_flight:
+                task_id, task_type, started_at = self.in_flight.pop(executor)
+                self.logger.error("Executor %s died while running task: id=%s task_type=%s", executor, task_id, task_type)
+            else:
+                self.logger.error("Executor %s died.", executor)
+            executors[executor] = self._start_executor(executor, events)
+
+class _Message(QueueMessage):
+    """A message whose body was received by another process."""
+    def __init__(self, body):
+        self.body = body
+
+    def get_body(self):
+        return self.body
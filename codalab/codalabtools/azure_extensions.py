@@ -1,7 +1,13 @@
 """
 This module defines Windows Azure extensions for CodaLab.
 """
+import httplib
 import logging
+import os
+import socket
+import sys
+import threading
+import time
 from time import sleep
 
 from azure import (
@@ -9,6 +15,10 @@ from azure import (
     WindowsAzureError
 )
 
+from azure.http import (
+    HTTPError,
+    HTTPResponse)
+
 from azure.storage import (
     _sign_storage_blob_request,
     BlobService,
@@ -19,11 +29,208 @@ from azure.servicebus import (
     Message)
 
 from codalabtools import (
+    backoff_delay,
     Queue,
     QueueMessage)
 
 logger = logging.getLogger('codalabtools')
 
+# Default maximum number of idle connections kept open per host.
+POOL_SIZE = 8
+
+# Default number of times a failed Service Bus request is retried.
+MAX_RETRIES = 3
+
+# Default delay in seconds before the first retry of a Service Bus request.
+RETRY_DELAY = 1.0
+
+# Errors of a connection which the server closed while it was idle in a pool.
+_STALE_CONNECTION_ERRORS = (httplib.HTTPException, socket.error)
+
+class ConnectionPool(object):
+    """
+    Keeps the connections of finished requests open so later requests to the same host reuse
+    them instead of opening a new HTTPS connection each time.
+
+    The pool also counts how often a request found a connection to reuse (a hit) or had to
+    open one (a miss), and how long requests took. A pool must not share connections between
+    processes: connections opened before a fork are dropped by the child process.
+    """
+    def __init__(self, max_idle=POOL_SIZE):
+        """
+        max_idle: Maximum number of idle connections kept open per host.
+        """
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._stats = self._new_stats()
+
+    @staticmethod
+    def _new_stats():
+        return {'hits': 0, 'misses': 0, 'discarded': 0, 'requests': 0, 'errors': 0,
+                'total_time': 0.0, 'max_time': 0.0}
+
+    def _check_pid(self):
+        if os.getpid() != self._pid:
+            # The connections belong to the parent process: forget them without closing them.
+            self._idle = {}
+            self._stats = self._new_stats()
+            self._pid = os.getpid()
+
+    def acquire(self, key):
+        """
+        Returns an idle connection to the given (protocol, host) or None if there is none.
+        """
+        with self._lock:
+            self._check_pid()
+            idle = self._idle.get(key)
+            if idle:
+                self._stats['hits'] += 1
+                return idle.pop()
+            self._stats['misses'] += 1
+            return None
+
+    def release(self, key, connection):
+        """
+        Returns a connection whose response was read entirely to the pool. The connection is
+        closed if the pool already holds max_idle connections to its host.
+        """
+        with self._lock:
+            self._check_pid()
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+            self._stats['discarded'] += 1
+        connection.close()
+
+    def record(self, elapsed, failed=False):
+        """
+        Records the duration in seconds of a request.
+        """
+        with self._lock:
+            self._check_pid()
+            self._stats['requests'] += 1
+            if failed:
+                self._stats['errors'] += 1
+            self._stats['total_time'] += elapsed
+            self._stats['max_time'] = max(self._stats['max_time'], elapsed)
+
+    def stats(self):
+        """
+        Returns a dictionary of the pool's metrics: hits, misses, discarded (connections closed
+        because the pool was full), requests, errors, idle (connections open now), and the
+        total, mean and maximum duration of requests in seconds.
+        """
+        with self._lock:
+            self._check_pid()
+            stats = dict(self._stats)
+            stats['idle'] = sum(len(idle) for idle in self._idle.values())
+        stats['mean_time'] = stats['total_time'] / stats['requests'] if stats['requests'] > 0 else 0.0
+        return stats
+
+    def clear(self):
+        """
+        Closes the idle connections.
+        """
+        with self._lock:
+            self._check_pid()
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+_connection_pool = ConnectionPool()
+
+def get_connection_pool(max_idle=None):
+    """
+    Returns the connection pool shared by the Azure services of the process.
+
+    max_idle: If given, the new maximum number of idle connections kept open per host.
+    """
+    if max_idle is not None:
+        _connection_pool.max_idle = max_idle
+    return _connection_pool
+
+class PooledHTTPClient(object):
+    """
+    Wraps the HTTP client of an Azure service so that its requests reuse the connections of a
+    ConnectionPool. Requests through a proxy or on Windows are passed to the wrapped client.
+    """
+    def __init__(self, client, pool):
+        self._client = client
+        self.pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _send(self, connection, request):
+        connection.putrequest(request.method, request.path)
+        self._client.send_request_headers(connection, request.headers)
+        self._client.send_request_body(connection, request.body)
+        resp = connection.getresponse()
+        # The whole body is read, so the connection is ready for the next request.
+        respbody = resp.read()
+        return resp, respbody
+
+    def perform_request(self, request):
+        """Sends a request and returns its response, like the wrapped client's perform_request."""
+        if sys.platform.lower().startswith('win') or self._client.proxy_host:
+            return self._client.perform_request(request)
+        key = (request.protocol_override or self._client.protocol, request.host)
+        start = time.time()
+        failed = True
+        try:
+            connection = self.pool.acquire(key)
+            try:
+                if connection is None:
+                    connection = self._client.get_connection(request)
+                    resp, respbody = self._send(connection, request)
+                else:
+                    try:
+                        resp, respbody = self._send(connection, request)
+                    except _STALE_CONNECTION_ERRORS:
+                        # The server closed the connection while it was idle: retry on a new one.
+                        connection.close()
+                        connection = self._client.get_connection(request)
+                        resp, respbody = self._send(connection, request)
+            except:
+                if connection is not None:
+                    connection.close()
+                raise
+            if resp.will_close:
+                connection.close()
+            else:
+                self.pool.release(key, connection)
+            failed = int(resp.status) >= 300
+        finally:
+            self.pool.record(time.time() - start, failed)
+
+        # The client is shared by threads: the response is not kept on it, unlike the wrapped client.
+        status, message, headers = int(resp.status), resp.reason, resp.getheaders()
+        if status >= 300:
+            raise HTTPError(status, message, headers, respbody)
+        return HTTPResponse(status, message, headers, respbody)
+
+def pool_connections(service, pool=None):
+    """
+    Makes an Azure service (BlobService, ServiceBusService...) send its requests on pooled
+    connections and returns the service.
+
+    service: The service. Services created by its with_filter method are not pooled.
+    pool: The ConnectionPool to use. Defaults to the pool shared by the process.
+    """
+    client = service._httpclient
+    if isinstance(client, PooledHTTPClient):
+        return service
+    pooled = PooledHTTPClient(client, pool or get_connection_pool())
+    # ServiceBusService binds the client's perform_request as the end of its filter chain.
+    if getattr(service, '_filter', None) == client.perform_request:
+        service._filter = pooled.perform_request
+    service._httpclient = pooled
+    return service
+
 class AzureServiceBusQueueMessage(QueueMessage):
     """
     Implements a QueueMessage backed by a Windows Azure Service Bus Queue Message.
@@ -45,18 +252,20 @@ class AzureServiceBusQueue(Queue):
     # conditions occurs: a message is received or the timeout period has elapsed.
     polling_timeout = 60
 
-    def __init__(self, namespace, key, issuer, name):
-        self.service = ServiceBusService(service_namespace=namespace, account_key=key, issuer=issuer)
+    def __init__(self, namespace, key, issuer, name, max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY,
+                 pool=None):
+        self.service = pool_connections(ServiceBusService(service_namespace=namespace, account_key=key, issuer=issuer),
+                                        pool)
         #self.service = ServiceBusService(service_namespace=namespace,  shared_access_key_value=key, shared_access_key_name=issuer)
         self.name = name
-        self.max_retries = 3
-        self.wait = lambda count: 1.0*(2**count)
+        self.max_retries = max_retries
+        self.wait = lambda count: backoff_delay(count, retry_delay)
 
     def _try_request(self, fn, retry_count=0, fail=None):
         '''Helper to retry request for sending and receiving messages.'''
         try:
             return fn()
-        except (WindowsAzureError) as e:
+        except (WindowsAzureError, httplib.HTTPException, socket.error) as e:
             if retry_count < self.max_retries:
                 logger.error("Retrying request after error occurred. Attempt %s of %s.",
                              retry_count+1, self.max_retries)
@@ -81,6 +290,44 @@ class AzureServiceBusQueue(Queue):
         fail = lambda: logger.error("Failed to send message. Message body is:\n%s", body)
         self._try_request(op, fail=fail)
 
+def create_queue(name, namespace, key, issuer, pool_size=None, **options):
+    """
+    Creates an AzureServiceBusQueue. This is the factory of the 'azure' queue backend.
+
+    pool_size: If given, the maximum number of idle connections kept open per host by the
+        connection pool shared by the process.
+    options: The max_retries and retry_delay of the queue.
+    """
+    return AzureServiceBusQueue(namespace, key, issuer, name, pool=get_connection_pool(pool_size), **options)
+
+
+class BlobExistsError(Exception):
+    """Indicates that a blob was not created because a blob of the same name exists."""
+    pass
+
+def create_only_blob_service(blob_service, account_name, account_key):
+    """
+    Returns a BlobService whose requests only create blobs: a request which would overwrite an
+    existing blob fails with BlobExistsError. It sends its requests with If-None-Match: *, so
+    only requests which create a blob (put_blob, put_block_list) should be sent through it.
+
+    blob_service: The BlobService to send the requests through.
+    account_name: Storage account name.
+    account_key: Storage account key.
+    """
+    def request_filter(request, next_filter):
+        """ Intercepts request to add the condition, which must be signed."""
+        request.headers = [(k, v) for (k, v) in request.headers if k not in ('If-None-Match', 'Authorization')]
+        request.headers.append(('If-None-Match', '*'))
+        request.headers.append(('Authorization', _sign_storage_blob_request(request, account_name, account_key)))
+        try:
+            return next_filter(request)
+        except HTTPError as e:
+            if e.status in (409, 412):
+                raise BlobExistsError("Blob already exists: %s" % request.path)
+            raise
+
+    return blob_service.with_filter(request_filter)
 
 class CorsRule(WindowsAzureData):
     '''CORS Rule for Windows Azure storage service.'''
@@ -0,0 +1,181 @@
+"""
+Defines a persistent cache of staged bundles for compute workers.
+
+Bundles are cached extracted, keyed by the name of their Blob and its ETag (or Content-MD5),
+so a run needing a bundle which was already staged by an earlier run neither downloads nor
+unzips it again: the cached tree is hard-linked into the run directory. Cached files are made
+read-only because the links share their content with the cache.
+
+Entries are built in a staging directory and renamed into place, so an interrupted build never
+leaves a partial entry behind. An advisory lock on the cache directory lets runs of several
+worker processes share the cache: runs linking entries hold it shared and eviction holds it
+exclusively. Entries are evicted in least recently used order once the cache outgrows its size.
+"""
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+from contextlib import contextmanager
+from os.path import join
+
+logger = logging.getLogger('codalabtools')
+
+# Staging directories older than this (in seconds) were left behind by a crashed run.
+STALE_STAGING_AGE = 24 * 60 * 60
+
+_READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+_EXECUTABLE = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+
+def _tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(join(root, name))
+    return size
+
+
+def _link_file(source, dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        # Cache and run directory are on different file systems.
+        shutil.copy2(source, dest)
+
+
+class BundleCache(object):
+    """
+    A size-bounded, least recently used cache of extracted bundles.
+    """
+    def __init__(self, root, max_size):
+        """
+        root: Path of the cache directory. It should be on the same file system as the
+            directories runs are staged in, so cached files can be hard-linked rather than copied.
+        max_size: Maximum total size in bytes of the cached files.
+        """
+        self.root = root
+        self.max_size = max_size
+        self.entries_dir = join(root, 'entries')
+        self.staging_dir = join(root, 'staging')
+        for path in (self.entries_dir, self.staging_dir):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+        self._remove_stale_staging()
+
+    @contextmanager
+    def _lock(self, operation):
+        with open(join(self.root, 'lock'), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _remove_stale_staging(self):
+        limit = time.time() - STALE_STAGING_AGE
+        for name in os.listdir(self.staging_dir):
+            path = join(self.staging_dir, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def key(self, container, blob_id, properties):
+        """
+        Returns the cache key of a Blob given its properties, or None if the properties have
+        neither an ETag nor a Content-MD5 to identify its content.
+        """
+        version = properties.get('etag') or properties.get('content-md5')
+        if not version:
+            return None
+        return hashlib.sha1("%s\n%s\n%s" % (container, blob_id, version)).hexdigest()
+
+    def link(self, key, dest):
+        """
+        Links the cached tree of an entry into the directory dest, replacing files which are
+        already there. Returns False if the entry is not cached.
+        """
+        with self._lock(fcntl.LOCK_SH):
+            entry = join(self.entries_dir, key)
+            tree = join(entry, 'tree')
+            if not os.path.isdir(tree):
+                return False
+            # Mark the entry as recently used.
+            os.utime(entry, None)
+            for root, dirs, files in os.walk(tree):
+                dest_root = os.path.normpath(join(dest, os.path.relpath(root, tree)))
+                if not os.path.isdir(dest_root):
+                    os.mkdir(dest_root)
+                for name in files:
+                    _link_file(join(root, name), join(dest_root, name))
+        return True
+
+    def add(self, key, build):
+        """
+        Adds an entry to the cache.
+
+        key: Key of the entry.
+        build: Function which stages the bundle in the directory given as its argument.
+
+        Returns True if the entry was added, False if another run added it first.
+        """
+        staging = tempfile.mkdtemp(dir=self.staging_dir)
+        try:
+            tree = join(staging, 'tree')
+            os.mkdir(tree)
+            build(tree)
+            for root, dirs, files in os.walk(tree):
+                for name in files:
+                    path = join(root, name)
+                    os.chmod(path, _READ_ONLY | (os.stat(path).st_mode & _EXECUTABLE))
+            with open(join(staging, 'size'), 'w') as f:
+                f.write(str(_tree_size(tree)))
+            try:
+                os.rename(staging, join(self.entries_dir, key))
+            except OSError as e:
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+                return False
+        finally:
+            if os.path.exists(staging):
+                shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+        return True
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in its maximum size.
+        """
+        with self._lock(fcntl.LOCK_EX):
+            entries = []
+            total_size = 0
+            for key in os.listdir(self.entries_dir):
+                entry = join(self.entries_dir, key)
+                try:
+                    with open(join(entry, 'size')) as f:
+                        size = int(f.read())
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except (IOError, OSError, ValueError):
+                    # Not a complete entry.
+                    shutil.rmtree(entry, ignore_errors=True)
+                    continue
+                total_size += size
+            entries.sort()
+            while total_size > self.max_size and len(entries) > 0:
+                used_at, size, entry = entries.pop(0)
+                logger.debug("Evicting cached bundle %s (%d bytes)", entry, size)
+                shutil.rmtree(entry, ignore_errors=True)
+                total_size -= size
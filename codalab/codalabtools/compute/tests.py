@@ -1,10 +1,29 @@
 """
 Defines unit tests for this package.
 """
+import azure
+import hashlib
+import json
 import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+import zipfile
+
+import mock
+
+from os.path import join
+from StringIO import StringIO
 from unittest import TestCase
 
-from codalabtools.compute.worker import WorkerConfig
+from codalabtools import Queue, zipstream
+from codalabtools.compute.bundle_cache import BundleCache
+from codalabtools.compute.worker import (WorkerConfig, UpdateBatcher, getBundle, limit, pack_output, read_scores, supervise,
+                                         _monotonic)
 
 class ComputeConfigTests(TestCase):
     """Tests for WorkerConfig."""
@@ -57,3 +76,390 @@ class ComputeConfigTests(TestCase):
             }
         }
         self.assertDictEqual(log_cfg_expected, cfg.getLoggerDictConfig())
+
+class SlotConfigTests(TestCase):
+    """Tests for the execution slots settings of WorkerConfig."""
+
+    def _config(self, settings):
+        cfg_file = tempfile.NamedTemporaryFile(suffix='.config', delete=False)
+        with cfg_file:
+            yaml.dump({'compute-worker': settings}, cfg_file)
+        self.addCleanup(os.remove, cfg_file.name)
+        return WorkerConfig(cfg_file.name)
+
+    def defaults_test(self):
+        """Runs one program at a time without limits by default."""
+        cfg = self._config({'local-root': '/tmp'})
+        self.assertEqual(1, cfg.getSlots())
+        self.assertIsNone(cfg.getSlotMemoryLimit())
+        self.assertIsNone(cfg.getSlotCpus(0))
+
+    def slot_cpus_test(self):
+        """Divides the CPUs evenly between slots."""
+        cfg = self._config({'slots': 4, 'pin-slot-cpus': True, 'slot-memory-limit': 2 ** 30})
+        self.assertEqual(2 ** 30, cfg.getSlotMemoryLimit())
+        with mock.patch('psutil.cpu_count', return_value=8):
+            self.assertEqual([[0, 1], [2, 3], [4, 5], [6, 7]], [cfg.getSlotCpus(slot) for slot in range(4)])
+        with mock.patch('psutil.cpu_count', return_value=2):
+            self.assertEqual([[0], [1], [0], [1]], [cfg.getSlotCpus(slot) for slot in range(4)])
+
+    def queue_backend_test(self):
+        """Uses Service Bus by default, or the queue backend of the 'queue' section."""
+        service_bus = {'namespace': 'ns', 'key': 'key', 'issuer': 'owner', 'listen-to': 'compute'}
+        cfg = self._config({'azure-service-bus': service_bus})
+        self.assertEqual('azure', cfg.getQueueBackend())
+        self.assertEqual({'namespace': 'ns', 'key': 'key', 'issuer': 'owner'}, cfg.getQueueOptions())
+        self.assertEqual('compute', cfg.getQueueName())
+        cfg = self._config({'queue': {'backend': 'sql', 'url': 'sqlite:///queue.db', 'listen-to': 'local'}})
+        self.assertEqual('sql', cfg.getQueueBackend())
+        self.assertEqual({'url': 'sqlite:///queue.db'}, cfg.getQueueOptions())
+        self.assertEqual('local', cfg.getQueueName())
+
+    def limit_test(self):
+        """Applies the memory limit to the program's process only."""
+        memory_limit = 2 ** 32
+        output = subprocess.check_output(
+            [sys.executable, '-c', 'import resource; print resource.getrlimit(resource.RLIMIT_AS)[0]'],
+            preexec_fn=limit(memory_limit=memory_limit))
+        self.assertEqual(memory_limit, int(output))
+        self.assertNotEqual(memory_limit, resource.getrlimit(resource.RLIMIT_AS)[0])
+
+class SuperviseTests(TestCase):
+    """Tests for supervise."""
+
+    def _start(self, command):
+        return subprocess.Popen(command, preexec_fn=limit(), stdout=subprocess.PIPE)
+
+    def exit_is_noticed_immediately_test(self):
+        """Returns as soon as the program exits."""
+        start = _monotonic()
+        for _ in range(10):
+            exit_code, timed_out = supervise(self._start(['sh', '-c', 'exit 3']), _monotonic() + 60)
+            self.assertEqual((3, False), (exit_code, timed_out))
+        # Polling once a second would take at least 10 seconds.
+        self.assertTrue(_monotonic() - start < 5)
+
+    def process_group_is_killed_at_deadline_test(self):
+        """Kills the program and the processes it started at the deadline."""
+        process = self._start(['sh', '-c', 'sleep 60 & echo $!; wait'])
+        child_pid = int(process.stdout.readline())
+        start = _monotonic()
+        exit_code, timed_out = supervise(process, _monotonic() + 0.2)
+        self.assertTrue(timed_out)
+        self.assertTrue(_monotonic() - start < 5)
+        # The background child is killed with the program; wait for it to be reaped by init.
+        for _ in range(50):
+            try:
+                os.kill(child_pid, 0)
+            except OSError:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail("Child process %d is still running" % child_pid)
+
+class FakeQueue(Queue):
+    """Records the bodies of the messages sent."""
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, body):
+        self.messages.append(json.loads(body))
+
+class UpdateBatcherTests(TestCase):
+    """Tests for UpdateBatcher."""
+
+    def setUp(self):
+        self.queue = FakeQueue()
+
+    def updates_are_held_for_the_window_test(self):
+        """Sends the updates once the window has elapsed."""
+        batcher = UpdateBatcher(self.queue, window=0.1)
+        batcher.send(1, 'running')
+        self.assertEqual([], self.queue.messages)
+        for _ in range(50):
+            if self.queue.messages:
+                break
+            time.sleep(0.1)
+        self.assertEqual([{'id': 1, 'task_type': 'run_update', 'task_args': {'status': 'running'}}],
+                         self.queue.messages)
+
+    def updates_of_a_task_are_coalesced_test(self):
+        """Sends only the last status of a task, with the metadata of all its updates."""
+        batcher = UpdateBatcher(self.queue, window=60)
+        batcher.send(1, 'running', extra={'metadata': {'hostname': 'worker', 'end_cpu_usage': None}})
+        batcher.send(1, 'failed', extra={'traceback': 'error', 'metadata': {'end_cpu_usage': 5}})
+        batcher.flush()
+        self.assertEqual([{'id': 1,
+                           'task_type': 'run_update',
+                           'task_args': {'status': 'failed',
+                                         'extra': {'traceback': 'error',
+                                                   'metadata': {'hostname': 'worker', 'end_cpu_usage': 5}}}}],
+                         self.queue.messages)
+
+    def updates_of_several_tasks_are_batched_test(self):
+        """Sends the updates of several tasks in one message."""
+        batcher = UpdateBatcher(self.queue, window=60, max_batch=3)
+        for task_id in range(1, 4):
+            batcher.send(task_id, 'running')
+        self.assertEqual(1, len(self.queue.messages))
+        message = self.queue.messages[0]
+        self.assertEqual('run_update_batch', message['task_type'])
+        self.assertEqual([1, 2, 3], [update['id'] for update in message['task_args']['updates']])
+        batcher.flush()
+        self.assertEqual(1, len(self.queue.messages))
+
+    def final_updates_are_sent_immediately_test(self):
+        """Sends the updates held so far as soon as a task reaches a final status."""
+        batcher = UpdateBatcher(self.queue, window=60)
+        batcher.send(1, 'running')
+        batcher.send(2, 'running')
+        self.assertEqual([], self.queue.messages)
+        batcher.send(1, 'finished')
+        self.assertEqual(1, len(self.queue.messages))
+        updates = self.queue.messages[0]['task_args']['updates']
+        self.assertEqual([(1, 'finished'), (2, 'running')],
+                         [(update['id'], update['task_args']['status']) for update in updates])
+
+    def updates_are_sent_immediately_without_window_test(self):
+        """Sends each update as it is received when the window is 0."""
+        batcher = UpdateBatcher(self.queue, window=0)
+        batcher.send(1, 'running')
+        batcher.send(1, 'finished')
+        self.assertEqual(['running', 'finished'], [message['task_args']['status'] for message in self.queue.messages])
+
+class PackOutputTests(TestCase):
+    """Tests for pack_output."""
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def _write(self, rel_path, content):
+        path = join(self.output_dir, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def _read(self, archive):
+        return zipfile.ZipFile(StringIO(''.join(archive)))
+
+    def archives_test(self):
+        """Packs the private results in the private output archive only."""
+        self._write('scores.txt', 'score: 1.0\n' * 100)
+        self._write('plot.png', '\x89PNG' + 'x' * 100)
+        self._write(join('html', 'detailed.html'), '<html></html>')
+        self._write(join('private', 'secret.txt'), 'secret')
+        self._write(join('private', 'details.html'), '<html>private</html>')
+        output_archive, private_output_archive, html_file = pack_output(self.output_dir)
+
+        output_zip = self._read(output_archive)
+        self.assertEqual(sorted(output_zip.namelist()), ['html/detailed.html', 'plot.png', 'scores.txt'])
+        self.assertEqual(output_zip.read('scores.txt'), 'score: 1.0\n' * 100)
+        self.assertEqual(output_zip.getinfo('scores.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(output_zip.getinfo('plot.png').compress_type, zipfile.ZIP_STORED)
+
+        private_output_zip = self._read(private_output_archive)
+        self.assertEqual(sorted(private_output_zip.namelist()),
+                         ['html/detailed.html', 'plot.png', 'private/details.html', 'private/secret.txt', 'scores.txt'])
+        self.assertEqual(private_output_zip.read('private/secret.txt'), 'secret')
+        self.assertEqual(html_file, join(self.output_dir, 'html', 'detailed.html'))
+
+    def archives_written_together_test(self):
+        """Writes the same archives when they are written together."""
+        self._write('scores.txt', 'score: 1.0\n' * 100)
+        self._write(join('private', 'secret.txt'), 'secret')
+        output_archive, private_output_archive, html_file = pack_output(self.output_dir)
+        sinks = [StringIO(), StringIO()]
+        zipstream.write_archives([output_archive, private_output_archive], sinks)
+        output_zip, private_output_zip = [zipfile.ZipFile(StringIO(sink.getvalue())) for sink in sinks]
+        self.assertEqual(['scores.txt'], output_zip.namelist())
+        self.assertEqual(['scores.txt', 'private/secret.txt'], private_output_zip.namelist())
+        self.assertEqual('score: 1.0\n' * 100, output_zip.read('scores.txt'))
+        self.assertEqual('score: 1.0\n' * 100, private_output_zip.read('scores.txt'))
+        self.assertEqual(''.join(output_archive), sinks[0].getvalue())
+
+    def no_private_results_test(self):
+        """Does not make a private output archive without private results."""
+        self._write('scores.txt', 'score: 1.0\n')
+        output_archive, private_output_archive, html_file = pack_output(self.output_dir)
+        self.assertIsNone(private_output_archive)
+        self.assertIsNone(html_file)
+        self.assertEqual(self._read(output_archive).namelist(), ['scores.txt'])
+
+    def read_scores_test(self):
+        """Parses scores.txt, unless it is missing, malformed or too large to be sent."""
+        self.assertIsNone(read_scores(self.output_dir))
+        self._write('scores.txt', 'accuracy: 0.5\nrecall:0.25\n\n')
+        self.assertEqual([('accuracy', 0.5), ('recall', 0.25)], read_scores(self.output_dir))
+        self._write('scores.txt', 'accuracy 0.5\n')
+        self.assertIsNone(read_scores(self.output_dir))
+        with mock.patch('codalabtools.compute.worker.MAX_SCORES_SIZE', 4):
+            self._write('scores.txt', 'accuracy: 0.5\n')
+            self.assertIsNone(read_scores(self.output_dir))
+
+class FakeBlobService(object):
+    """In-memory stand-in for BlobService which records the ranges requested."""
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.ranges = []
+
+    def get_blob_properties(self, container, blob_id):
+        if blob_id not in self.blobs:
+            raise azure.WindowsAzureMissingResourceError("Not found")
+        return {'content-length': str(len(self.blobs[blob_id])),
+                'etag': '"%s"' % hashlib.md5(self.blobs[blob_id]).hexdigest()}
+
+    def get_blob(self, container, blob_id, x_ms_range=None):
+        start, end = [int(_) for _ in x_ms_range[len('bytes='):].split('-')]
+        self.ranges.append((blob_id, start, end))
+        return self.blobs[blob_id][start:end + 1]
+
+class GetBundleTests(TestCase):
+    """Tests for getBundle."""
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def _zip(self, files):
+        data = StringIO()
+        with zipfile.ZipFile(data, 'w') as z:
+            for name, content in files.items():
+                # A fixed date, so the same files always give the same blob.
+                z.writestr(zipfile.ZipInfo(name, date_time=(2015, 1, 1, 0, 0, 0)), content)
+        return data.getvalue()
+
+    def _blobs(self):
+        return {
+            'run.txt': yaml.dump({'program': 'program.zip', 'input': 'input.zip', 'description': 'run'}),
+            'program.zip': self._zip({'metadata': yaml.dump({'command': 'python evaluate.py'}),
+                                      'evaluate.py': 'print "hello"\n'}),
+            'input.zip': self._zip({'metadata': yaml.dump({'ref': 'ref.zip', 'res': 'missing.zip'})}),
+            'ref.zip': self._zip({'truth.txt': '1 2 3\n' * 1000}),
+        }
+
+    def stages_referenced_bundles_test(self):
+        """Stages the bundle tree and reports missing bundles as None."""
+        bundles = getBundle(self.root_dir, FakeBlobService(self._blobs()), 'container', 'run.txt', 'run')
+        self.assertEqual(sorted(bundles.keys()),
+                         ['run', join('run', 'input'), join('run', 'input', 'ref'), join('run', 'input', 'res'),
+                          join('run', 'program')])
+        self.assertEqual(bundles[join('run', 'program')], {'command': 'python evaluate.py'})
+        self.assertIsNone(bundles[join('run', 'input', 'ref')])
+        self.assertIsNone(bundles[join('run', 'input', 'res')])
+        with open(join(self.root_dir, 'run', 'input', 'ref', 'truth.txt')) as f:
+            self.assertEqual(f.read(), '1 2 3\n' * 1000)
+        # temporary bundle files are removed once extracted
+        self.assertEqual(sorted(os.listdir(self.root_dir)), ['run'])
+
+    def downloads_in_ranges_test(self):
+        """Downloads each bundle in ranges of the requested size."""
+        blob_service = FakeBlobService(self._blobs())
+        getBundle(self.root_dir, blob_service, 'container', 'run.txt', 'run', chunk_size=100)
+        ref_ranges = [(start, end) for (blob_id, start, end) in blob_service.ranges if blob_id == 'ref.zip']
+        self.assertTrue(len(ref_ranges) > 1)
+        self.assertTrue(all(end - start < 100 for (start, end) in ref_ranges))
+
+    def respects_max_depth_test(self):
+        """Does not follow references deeper than max_depth."""
+        bundles = getBundle(self.root_dir, FakeBlobService(self._blobs()), 'container', 'run.txt', 'run', max_depth=1)
+        self.assertNotIn(join('run', 'input', 'ref'), bundles)
+
+    def raises_staging_errors_test(self):
+        """Raises errors raised while staging a bundle."""
+        blobs = self._blobs()
+        blobs['program.zip'] = 'not a zip file'
+        with self.assertRaises(zipfile.BadZipfile):
+            getBundle(self.root_dir, FakeBlobService(blobs), 'container', 'run.txt', 'run')
+
+    def cached_bundles_are_not_downloaded_again_test(self):
+        """Links bundles staged by an earlier run from the bundle cache."""
+        cache = BundleCache(self.cache_dir, 10 * 1024 * 1024)
+        first_run = join(self.root_dir, 'first')
+        second_run = join(self.root_dir, 'second')
+        os.mkdir(first_run)
+        os.mkdir(second_run)
+        first_bundles = getBundle(first_run, FakeBlobService(self._blobs()), 'container', 'run.txt', 'run', cache=cache)
+
+        blob_service = FakeBlobService(self._blobs())
+        second_bundles = getBundle(second_run, blob_service, 'container', 'run.txt', 'run', cache=cache)
+        self.assertEqual(blob_service.ranges, [])
+        self.assertEqual(second_bundles, first_bundles)
+        truth_path = join('run', 'input', 'ref', 'truth.txt')
+        self.assertEqual(os.stat(join(first_run, truth_path)).st_ino, os.stat(join(second_run, truth_path)).st_ino)
+
+    def changed_bundles_are_downloaded_again_test(self):
+        """Downloads a bundle again when its content changed."""
+        cache = BundleCache(self.cache_dir, 10 * 1024 * 1024)
+        getBundle(self.root_dir, FakeBlobService(self._blobs()), 'container', 'run.txt', 'run', cache=cache)
+        shutil.rmtree(join(self.root_dir, 'run'))
+
+        blobs = self._blobs()
+        blobs['ref.zip'] = self._zip({'truth.txt': '4 5 6\n'})
+        blob_service = FakeBlobService(blobs)
+        getBundle(self.root_dir, blob_service, 'container', 'run.txt', 'run', cache=cache)
+        self.assertEqual(set(blob_id for (blob_id, start, end) in blob_service.ranges), set(['ref.zip']))
+        with open(join(self.root_dir, 'run', 'input', 'ref', 'truth.txt')) as f:
+            self.assertEqual(f.read(), '4 5 6\n')
+
+class BundleCacheTests(TestCase):
+    """Tests for BundleCache."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.run_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.run_dir)
+
+    def _build(self, content):
+        def build(path):
+            with open(join(path, 'data.txt'), 'w') as f:
+                f.write(content)
+        return build
+
+    def cached_files_are_read_only_test(self):
+        """Makes cached files read-only since runs share them."""
+        cache = BundleCache(self.cache_dir, 1024)
+        self.assertTrue(cache.add('a', self._build('a' * 10)))
+        self.assertTrue(cache.link('a', join(self.run_dir, 'a')))
+        self.assertFalse(os.stat(join(self.run_dir, 'a', 'data.txt')).st_mode & 0o222)
+
+    def second_add_of_an_entry_is_ignored_test(self):
+        """Keeps the first copy of an entry added twice."""
+        cache = BundleCache(self.cache_dir, 1024)
+        self.assertTrue(cache.add('a', self._build('first')))
+        self.assertFalse(cache.add('a', self._build('second')))
+        cache.link('a', join(self.run_dir, 'a'))
+        with open(join(self.run_dir, 'a', 'data.txt')) as f:
+            self.assertEqual(f.read(), 'first')
+        self.assertEqual(os.listdir(cache.staging_dir), [])
+
+    def least_recently_used_entries_are_evicted_test(self):
+        """Evicts the least recently used entries once the cache is full."""
+        cache = BundleCache(self.cache_dir, 25)
+        cache.add('a', self._build('a' * 10))
+        cache.add('b', self._build('b' * 10))
+        os.utime(join(cache.entries_dir, 'a'), (0, 0))
+        os.utime(join(cache.entries_dir, 'b'), (1, 1))
+        cache.link('a', join(self.run_dir, 'a'))
+        cache.add('c', self._build('c' * 10))
+        self.assertEqual(sorted(os.listdir(cache.entries_dir)), ['a', 'c'])
+        self.assertFalse(cache.link('b', join(self.run_dir, 'b')))
+
+    def failed_builds_leave_no_entry_test(self):
+        """Does not keep entries whose build failed."""
+        cache = BundleCache(self.cache_dir, 1024)
+        def build(path):
+            self._build('partial')(path)
+            raise IOError("Disk full")
+        with self.assertRaises(IOError):
+            cache.add('a', build)
+        self.assertEqual(os.listdir(cache.entries_dir), [])
+        self.assertEqual(os.listdir(cache.staging_dir), [])
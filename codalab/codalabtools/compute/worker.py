@@ -12,29 +12,36 @@ import platform
 import psutil
 import pwd
 import grp
-import signal
-import math
+import Queue
+import resource
 import select
+import signal
 import shutil
 import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import yaml
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from os.path import dirname, abspath, join
 from subprocess import Popen, PIPE, call
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
 
 # Add codalabtools to the module search path
 sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
 
 from azure.storage import BlobService
-from codalabtools import BaseWorker, BaseConfig
-from codalabtools.azure_extensions import AzureServiceBusQueue
+from codalabtools import BaseWorker, BaseConfig, create_queue, parse_scores, zipstream
+from codalabtools.azure_extensions import get_connection_pool, pool_connections, POOL_SIZE
+from codalabtools.compute.bundle_cache import BundleCache
+from codalabtools.local_storage import LocalBlobService
+from codalabtools.uploader import BlockUploader, LiveFileUploader, FLUSH_INTERVAL, UPLOAD_THREADS
 
 logger = logging.getLogger('codalabtools')
 
@@ -61,6 +68,13 @@ class WorkerConfig(BaseConfig):
         """Gets the Azure Storage account key."""
         return self._winfo['azure-storage']['account-key']
 
+    def getLocalStorageRoot(self):
+        """
+        Gets the path of the directory of the LocalBlobService storing the bundles, or None if
+        they are stored in Azure.
+        """
+        return self._winfo['local-storage']['path'] if 'local-storage' in self._winfo else None
+
     def getAzureServiceBusNamespace(self):
         """Gets the Azure Service Bus namespace."""
         return self._winfo['azure-service-bus']['namespace']
@@ -77,13 +91,142 @@ class WorkerConfig(BaseConfig):
         """Gets the name of the Azure Service Bus queue to listen to."""
         return self._winfo['azure-service-bus']['listen-to']
 
+    def getQueueBackend(self):
+        """Gets the name of the queue backend: 'azure' (the default) or 'sql'."""
+        return self._winfo.get('queue', {}).get('backend', 'azure')
+
+    def getQueueOptions(self):
+        """
+        Gets the options of the queue backend. The Azure Service Bus credentials are the
+        options of the 'azure' backend; other backends read theirs from the 'queue' section.
+        """
+        if self.getQueueBackend() == 'azure':
+            return {
+                'namespace': self.getAzureServiceBusNamespace(),
+                'key': self.getAzureServiceBusKey(),
+                'issuer': self.getAzureServiceBusIssuer(),
+            }
+        options = dict(self._winfo['queue'])
+        del options['backend']
+        options.pop('listen-to', None)
+        return options
+
+    def getQueueName(self):
+        """Gets the name of the queue to listen to."""
+        if 'listen-to' in self._winfo.get('queue', {}):
+            return self._winfo['queue']['listen-to']
+        return self.getAzureServiceBusQueue()
+
     def getLocalRoot(self):
         """Gets the path for the local directory where files are staged or None if the path is not provided."""
         return self._winfo['local-root'] if 'local-root' in self._winfo else None
 
-def getBundle(root_path, blob_service, container, bundle_id, bundle_rel_path, max_depth=3):
+    def getStagingThreads(self):
+        """Gets the number of bundles staged concurrently."""
+        return self._winfo.get('staging-threads', STAGING_THREADS)
+
+    def getSlots(self):
+        """Gets the number of runs executed concurrently."""
+        return self._winfo.get('slots', 1)
+
+    def getSlotMemoryLimit(self):
+        """Gets the maximum memory in bytes of a program run in a slot or None if there is no limit."""
+        return self._winfo.get('slot-memory-limit')
+
+    def getSlotCpus(self, slot):
+        """
+        Gets the list of CPUs programs run in the given slot are pinned to, or None if
+        programs are not pinned. The CPUs are divided evenly between slots.
+        """
+        if slot is None or not self._winfo.get('pin-slot-cpus', False):
+            return None
+        cpu_count = psutil.cpu_count()
+        slot_cpu_count = max(1, cpu_count // self.getSlots())
+        first_cpu = (slot * slot_cpu_count) % cpu_count
+        return range(first_cpu, min(first_cpu + slot_cpu_count, cpu_count))
+
+    def getUploadThreads(self):
+        """Gets the number of blocks uploaded concurrently."""
+        return self._winfo.get('upload-threads', UPLOAD_THREADS)
+
+    def getLogFlushInterval(self):
+        """Gets the number of seconds between two uploads of the logs of a running program."""
+        return self._winfo.get('log-flush-interval', FLUSH_INTERVAL)
+
+    def getConnectionPoolSize(self):
+        """Gets the maximum number of idle connections kept open per Azure host."""
+        return self._winfo.get('connection-pool-size', POOL_SIZE)
+
+    def getStatusUpdateWindow(self):
+        """Gets the number of seconds during which status updates are held to be sent together."""
+        return self._winfo.get('status-update-window', UPDATE_WINDOW)
+
+    def getBundleCacheRoot(self):
+        """Gets the path of the bundle cache directory or None if bundles are not cached."""
+        return self._winfo['bundle-cache']['path'] if 'bundle-cache' in self._winfo else None
+
+    def getBundleCacheMaxSize(self):
+        """Gets the maximum size in bytes of the bundle cache."""
+        return self._winfo['bundle-cache'].get('max-size', BUNDLE_CACHE_MAX_SIZE)
+
+# Size of the ranges in which bundles are downloaded.
+BUNDLE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Number of bundles downloaded and extracted concurrently.
+STAGING_THREADS = 4
+
+# Default maximum size of the bundle cache.
+BUNDLE_CACHE_MAX_SIZE = 20 * 1024 * 1024 * 1024
+
+# Metadata keys which describe a bundle rather than reference another bundle.
+_BUNDLE_METADATA_KEYS = ("description", "command", "exitCode", "elapsedTime", "stdout", "stderr", "submitted-by", "submitted-at")
+
+
+def _download_blob(blob_service, container, blob_id, blob_file, blob_size, chunk_size=BUNDLE_CHUNK_SIZE):
+    """
+    Downloads a Blob to a file in ranges, so the Blob is never held in memory as a whole. The
+    Blobs of a LocalBlobService are copied from their file.
+
+    blob_service: A BlobService object.
+    container: Name of the container holding the Blob.
+    blob_id: Name of the Blob relative to the container.
+    blob_file: File object opened for writing.
+    blob_size: Size of the Blob in bytes.
+    chunk_size: Size of each ranged request.
+    """
+    if isinstance(blob_service, LocalBlobService):
+        with open(blob_service.blob_path(container, blob_id), 'rb') as f:
+            shutil.copyfileobj(f, blob_file, chunk_size)
+        return
+    offset = 0
+    while offset < blob_size:
+        end = min(offset + chunk_size, blob_size) - 1
+        chunk = blob_service.get_blob(container, blob_id, x_ms_range='bytes=%d-%d' % (offset, end))
+        if not chunk:
+            raise IOError("Unexpected end of blob %s at offset %d of %d" % (blob_id, offset, blob_size))
+        blob_file.write(chunk)
+        offset += len(chunk)
+
+def _extract_bundle(bundle_file_name, bundle_ext, bundle_path):
+    """
+    Stages a downloaded bundle in the directory bundle_path: zip bundles are extracted and
+    other bundles are copied as the bundle's metadata.
+    """
+    if bundle_ext == '.zip':
+        with ZipFile(bundle_file_name, 'r') as z:
+            z.extractall(bundle_path)
+    else:
+        if not os.path.isdir(bundle_path):
+            os.mkdir(bundle_path)
+        shutil.copyfile(bundle_file_name, join(bundle_path, 'metadata'))
+
+def getBundle(root_path, blob_service, container, bundle_id, bundle_rel_path, max_depth=3,
+              threads=STAGING_THREADS, chunk_size=BUNDLE_CHUNK_SIZE, cache=None):
     """
-    be controlled with the max_depth parameter.
+    Downloads and stages a bundle and the bundles it references. Bundles are resolved
+    breadth-first: the bundles referenced by a bundle's metadata are downloaded and extracted
+    concurrently on a pool of threads as soon as that metadata is read. The depth of the
+    references followed can be controlled with the max_depth parameter.
 
     root_path: Path of the local directory under which all files are staged for execution.
     blob_service: Azure BlobService to access the storage account holding the bundles.
@@ -97,6 +240,10 @@ def getBundle(root_path, blob_service, container, bundle_id, bundle_rel_path, ma
         program bundle will be located at 'C:\\tmp123\\run\\program'.
     max_depth: An optional argument to limit the depth of recursion when resolving bundle
         dependencies.
+    threads: Number of bundles staged concurrently.
+    chunk_size: Size of the ranges in which each bundle is downloaded.
+    cache: An optional BundleCache. Bundles found in the cache are linked into place instead
+        of being downloaded and extracted; other bundles are added to it.
 
     Return value: A dictionary where each key denotes the relative path of a bundle which
         was staged. The value associated with a key is a dictionary representing the bundle's
@@ -104,92 +251,256 @@ def getBundle(root_path, blob_service, container, bundle_id, bundle_rel_path, ma
         the set of keys should contain at the minimum: 'run', 'run\\program' and 'run\\input'.
     """
 
-    def getThem(bundle_id, bundle_rel_path, bundles, depth):
-        """Recursively gets the bundles."""
-        # download the bundle and save it to a temporary location
-        try:
-            logger.debug("Getting bundle_id=%s from container=%s" % (container, bundle_id))
-            blob = blob_service.get_blob(container, bundle_id)
-        except azure.WindowsAzureMissingResourceError:
-            #file not found lets None this bundle
-            bundles[bundle_rel_path] = None
-            return bundles
-
+    def stageIt(bundle_id, bundle_rel_path):
+        """Downloads and extracts a bundle, or links it from the cache. Returns its metadata."""
         bundle_ext = os.path.splitext(bundle_id)[1]
-        bundle_file = tempfile.NamedTemporaryFile(prefix='tmp', suffix=bundle_ext, dir=root_path, delete=False)
-
-        logger.debug("Reading from bundle_file.name=%s" % bundle_file.name)
-
-        #take our temp file and write whatever is it form the blob
-        with open(bundle_file.name, 'wb') as f:
-            f.write(blob)
-        # stage the bundle directory
         bundle_path = join(root_path, bundle_rel_path)
         metadata_path = join(bundle_path, 'metadata')
-
-        if bundle_ext == '.zip':
-            with ZipFile(bundle_file.file, 'r') as z:
-                z.extractall(bundle_path)
+        properties = blob_service.get_blob_properties(container, bundle_id)
+        cache_key = cache.key(container, bundle_id, properties) if cache is not None else None
+        if cache_key is not None and cache.link(cache_key, bundle_path):
+            logger.debug("Linked bundle_id=%s from the bundle cache", bundle_id)
         else:
-            os.mkdir(bundle_path)
-            shutil.copyfile(bundle_file.name, metadata_path)
+            bundle_file = tempfile.NamedTemporaryFile(prefix='tmp', suffix=bundle_ext, dir=root_path, delete=False)
+            try:
+                logger.debug("Getting bundle_id=%s from container=%s into %s", bundle_id, container, bundle_file.name)
+                with bundle_file:
+                    _download_blob(blob_service, container, bundle_id, bundle_file,
+                                   int(properties['content-length']), chunk_size)
+                # stage the bundle directory
+                staged = False
+                if cache_key is not None:
+                    cache.add(cache_key, lambda path: _extract_bundle(bundle_file.name, bundle_ext, path))
+                    # The entry may already be evicted if the bundle is larger than the cache.
+                    staged = cache.link(cache_key, bundle_path)
+                if not staged:
+                    _extract_bundle(bundle_file.name, bundle_ext, bundle_path)
+            finally:
+                os.remove(bundle_file.name)
         # read the metadata if it exists
         bundle_info = None
         if os.path.exists(metadata_path):
             with open(metadata_path) as mf:
                 bundle_info = yaml.load(mf)
-        bundles[bundle_rel_path] = bundle_info
-        # get referenced bundles
-
-        if (bundle_info is not None) and isinstance(bundle_info, dict) and (depth < max_depth):
-            for (k, v) in bundle_info.items():
-                if k not in ("description", "command", "exitCode", "elapsedTime", "stdout", "stderr", "submitted-by", "submitted-at"):
-                    if isinstance(v, str):
-                        getThem(v, join(bundle_rel_path, k), bundles, depth + 1)
-
-        return bundles
+        return bundle_info
 
-    return getThem(bundle_id, bundle_rel_path, {}, 0)
+    results = Queue.Queue()
+    cancelled = threading.Event()
 
-def _send_update(queue, task_id, status, extra=None):
+    def getIt(bundle_id, bundle_rel_path, depth):
+        """Stages a bundle on a pool thread and reports the outcome to the results queue."""
+        if cancelled.is_set():
+            results.put((bundle_rel_path, depth, None, None))
+            return
+        try:
+            results.put((bundle_rel_path, depth, stageIt(bundle_id, bundle_rel_path), None))
+        except azure.WindowsAzureMissingResourceError:
+            #file not found lets None this bundle
+            results.put((bundle_rel_path, depth, None, None))
+        except:
+            results.put((bundle_rel_path, depth, None, sys.exc_info()))
+
+    bundles = {}
+    pool = ThreadPool(threads)
+    try:
+        pool.apply_async(getIt, (bundle_id, bundle_rel_path, 0))
+        pending = 1
+        while pending > 0:
+            rel_path, depth, bundle_info, error = results.get()
+            pending -= 1
+            if error is not None:
+                raise error[0], error[1], error[2]
+            bundles[rel_path] = bundle_info
+            # get referenced bundles
+            if (bundle_info is not None) and isinstance(bundle_info, dict) and (depth < max_depth):
+                for (k, v) in bundle_info.items():
+                    if k not in _BUNDLE_METADATA_KEYS and isinstance(v, str):
+                        pool.apply_async(getIt, (v, join(rel_path, k), depth + 1))
+                        pending += 1
+    finally:
+        # Let bundles being staged finish before the caller cleans up, and skip the others.
+        cancelled.set()
+        pool.close()
+        pool.join()
+
+    return bundles
+
+def _update_message(task_id, status, extra=None):
     """
-    Sends a status update about the running task.
+    Returns the message which reports a status update about a task.
 
-    queue: The Queue to send the update to.
-    id: The task ID.
+    task_id: The task ID.
     status: The new status for the task. One of 'running', 'finished' or 'failed'.
+    extra: Optional dictionary of extra information ('traceback', 'metadata').
     """
     task_args = {'status': status}
     if extra:
         task_args['extra'] = extra
-    body = json.dumps({
+    return {
         'id': task_id,
         'task_type': 'run_update',
         'task_args': task_args
-    })
-    queue.send_message(body)
+    }
 
-def _upload(blob_service, container, blob_id, blob_file, content_type = None):
-    """
-    Uploads a Blob.
+# Seconds during which status updates are held so they can be coalesced and sent together.
+UPDATE_WINDOW = 2
 
-    blob_service: A BlobService object.
-    container: Name of the container to uplaod the Blob to.
-    blob_id: Name of the Blob relative to the container.
-    blob_file: Path of the local file to upload as a BlockBlob.
-    """
-    with open(blob_file, 'rb') as f:
-        blob = f.read()
-        blob_service.put_blob(container, blob_id, blob, x_ms_blob_type='BlockBlob', x_ms_blob_content_type=content_type)
+# Maximum number of updates sent in one message.
+MAX_UPDATE_BATCH = 50
+
+# Statuses which end a run. Updates to them are sent immediately.
+FINAL_STATUSES = ('finished', 'failed')
+
+# Batches whose message would be larger than this (in bytes) are sent as one message per update.
+MAX_UPDATE_BATCH_BYTES = 192 * 1024
 
+# Largest scores.txt whose scores are sent with the final status update of a run. The site
+# reads larger ones from output.zip.
+MAX_SCORES_SIZE = 16 * 1024
 
-class ExecutionTimeLimitExceeded(Exception):
-    pass
+def _merge_extra(extra, new_extra):
+    """Merges the extra information of a newer update of a task into that of an older one."""
+    merged = dict(extra)
+    for key, value in new_extra.items():
+        if key == 'metadata' and 'metadata' in merged:
+            merged[key] = dict(merged[key], **value)
+        else:
+            merged[key] = value
+    return merged
+
+class UpdateBatcher(object):
+    """
+    Coalesces the status updates of tasks and sends them to a queue in batches.
+
+    Updates are held for `window` seconds after the first one arrives. Updates about the same
+    task received meanwhile are merged into one: the last status wins and the metadata is
+    combined, so a run which completes within the window never reports that it is running.
+    An update to a final status is sent at once, with the updates held so far: it is never
+    left to a timer which may not fire before the process exits. The updates of several tasks are sent in a single 'run_update_batch' message, whose
+    task_args hold the list of their 'run_update' messages; a lone update is sent as a plain
+    'run_update' message.
+    """
+    def __init__(self, queue, window=UPDATE_WINDOW, max_batch=MAX_UPDATE_BATCH):
+        """
+        queue: The Queue to send the updates to.
+        window: Seconds during which updates are held. With 0, updates are sent immediately.
+        max_batch: Maximum number of updates sent in one message.
+        """
+        self.queue = queue
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._timer = None
+
+    def send(self, task_id, status, extra=None):
+        """
+        Queues a status update about a task. See `_update_message` for the arguments.
+        """
+        with self._lock:
+            if task_id in self._pending:
+                pending_status, pending_extra = self._pending[task_id]
+                self._pending[task_id] = (status, _merge_extra(pending_extra, extra or {}))
+            else:
+                self._pending[task_id] = (status, dict(extra or {}))
+            send_now = self.window <= 0 or status in FINAL_STATUSES or len(self._pending) >= self.max_batch
+            if not send_now and self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush_later)
+                self._timer.daemon = True
+                self._timer.start()
+        if send_now:
+            self.flush()
+
+    def _flush_later(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Failed to send status updates.")
 
+    def flush(self):
+        """
+        Sends the updates held by the batcher.
+        """
+        with self._send_lock:
+            with self._lock:
+                pending, self._pending = self._pending, OrderedDict()
+                timer, self._timer = self._timer, None
+            if timer is not None:
+                timer.cancel()
+            if len(pending) == 0:
+                return
+            messages = [_update_message(task_id, status, extra) for task_id, (status, extra) in pending.items()]
+            if len(messages) == 1:
+                bodies = [json.dumps(messages[0])]
+            else:
+                body = json.dumps({
+                    'id': messages[0]['id'],
+                    'task_type': 'run_update_batch',
+                    'task_args': {'updates': messages}
+                })
+                if len(body) <= MAX_UPDATE_BATCH_BYTES:
+                    bodies = [body]
+                else:
+                    bodies = [json.dumps(message) for message in messages]
+            self.queue.send_messages(bodies)
 
-def alarm_handler(signum, frame):
-    raise ExecutionTimeLimitExceeded
+# Extensions of files which are already compressed: they are stored in archives as they are.
+_COMPRESSED_EXTENSIONS = frozenset(['.7z', '.bz2', '.gif', '.gz', '.jpeg', '.jpg', '.mp3', '.mp4', '.npz', '.png',
+                                    '.rar', '.tgz', '.xz', '.zip'])
 
+def read_scores(output_dir):
+    """
+    Returns the parsed scores of the scores.txt file of an output directory, or None if the
+    file is missing, too large to be sent in a status update or malformed.
+    """
+    path = join(output_dir, 'scores.txt')
+    if not os.path.isfile(path) or os.path.getsize(path) > MAX_SCORES_SIZE:
+        return None
+    try:
+        with open(path, 'r') as f:
+            return parse_scores(f.read())
+    except ValueError:
+        logger.warning("Unable to parse %s; the site will read it from the output archive.", path)
+        return None
+
+def pack_output(output_dir, private_dir_name='private'):
+    """
+    Walks the output directory of a run once and prepares its archives. The archives are
+    ZipStreams, so they are zipped while they are uploaded and never written to disk.
+    Already compressed files are stored rather than deflated again. Both archives add each
+    file with the same source, so zipstream.write_archives compresses the shared files once.
+
+    output_dir: Path of the output directory.
+    private_dir_name: Name of the sub-directory holding private results.
+
+    Returns a tuple (output archive, private output archive, html file). The output archive
+        holds all the files except the private results. The private output archive holds all
+        the files and is None when there are no private results. The html file is the path
+        of the first html file found outside the private results, or None.
+    """
+    output_archive = zipstream.ZipStream()
+    private_output_archive = zipstream.ZipStream()
+    has_private_output = os.path.isdir(join(output_dir, private_dir_name))
+    html_file = None
+    for root, dirs, files in os.walk(output_dir):
+        dirs.sort()
+        rel_root = os.path.relpath(root, output_dir)
+        is_private = rel_root.split(os.sep)[0] == private_dir_name
+        for file_name in sorted(files):
+            file_path = join(root, file_name)
+            arcname = os.path.normpath(join(rel_root, file_name))
+            file_ext = os.path.splitext(file_name)[1].lower()
+            compress_type = ZIP_STORED if file_ext in _COMPRESSED_EXTENSIONS else ZIP_DEFLATED
+            date_time = time.localtime(os.path.getmtime(file_path))[:6]
+            source = lambda file_path=file_path: zipstream.file_chunks(open(file_path, 'rb'))
+            size = os.path.getsize(file_path)
+            private_output_archive.add(arcname, source, date_time, compress_type, size)
+            if not is_private:
+                output_archive.add(arcname, source, date_time, compress_type, size)
+                if html_file is None and file_ext == ".html":
+                    html_file = file_path
+    return output_archive, private_output_archive if has_private_output else None, html_file
 
 def demote(user='workeruser'):
     def result():
@@ -198,14 +509,106 @@ def demote(user='workeruser'):
     return result
 
 
-def get_run_func(config):
+def limit(memory_limit=None, cpus=None, user=None):
+    """
+    Returns a function to run in a program's process before it starts. It starts a new
+    session, applies the resource limits of the slot running the program then, if a user is
+    given, drops into that user.
+
+    memory_limit: Maximum size in bytes of the address space of the process.
+    cpus: List of the CPUs the process may run on.
+    user: Name of the user to run the process as.
+    """
+    def result():
+        # Run the program in its own process group so it can be killed with its children.
+        os.setsid()
+        if memory_limit is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        if cpus:
+            psutil.Process(os.getpid()).cpu_affinity(cpus)
+        if user is not None:
+            demote(user)()
+    return result
+
+
+def _monotonic():
+    """
+    Returns the elapsed real time in seconds since an arbitrary point in the past. Unlike
+    time.time(), it is not affected by changes of the system clock.
+    """
+    return os.times()[4]
+
+
+def supervise(process, deadline):
+    """
+    Waits for a program's process to exit. The process is waited for on a separate thread, so
+    the program's exit is noticed as soon as it happens. If the program is still running at
+    the deadline, its whole process group is killed.
+
+    process: The Popen object of the program, started in its own process group.
+    deadline: The time, as returned by _monotonic(), at which the program is killed.
+
+    Returns a tuple (exit code, True if the program was killed at the deadline).
+    """
+    exited = threading.Event()
+    def wait():
+        process.wait()
+        exited.set()
+    waiter = threading.Thread(target=wait)
+    waiter.daemon = True
+    waiter.start()
+
+    while not exited.is_set():
+        remaining = deadline - _monotonic()
+        if remaining <= 0:
+            break
+        exited.wait(remaining)
+    if exited.is_set():
+        return process.returncode, False
+
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # The group exited in the meantime.
+        pass
+    waiter.join()
+    return process.returncode, True
+
+
+def get_run_func(config, slot=None):
     """
     Returns the function to invoke in order to do a run given the specified configuration.
 
     config: A pre-configured instance of WorkerConfig.
+    slot: The execution slot running the function, when the worker has several slots. Each
+        slot stages its runs in its own directory under the local root and runs programs
+        with the slot's resource limits.
 
     Returns: The function to invoke given a Run task: f(task_id, task_args)
     """
+    local_root = config.getLocalRoot()
+    if slot is not None:
+        local_root = join(local_root, 'slot%d' % slot)
+        if not os.path.isdir(local_root):
+            os.makedirs(local_root)
+    memory_limit = config.getSlotMemoryLimit()
+    cpus = config.getSlotCpus(slot)
+
+    bundle_cache = None
+    if config.getBundleCacheRoot() is not None:
+        bundle_cache = BundleCache(config.getBundleCacheRoot(), config.getBundleCacheMaxSize())
+
+    # Status updates are batched per queue the runs reply to.
+    update_batchers = {}
+
+    # Runs share one Blob service, so their requests reuse the pool's open connections.
+    connection_pool = get_connection_pool(config.getConnectionPoolSize())
+    if config.getLocalStorageRoot() is not None:
+        blob_service = LocalBlobService(config.getLocalStorageRoot())
+    else:
+        blob_service = pool_connections(BlobService(config.getAzureStorageAccountName(),
+                                                    config.getAzureStorageAccountKey()),
+                                        connection_pool)
 
     def run(task_id, task_args):
         """
@@ -219,13 +622,14 @@ def get_run_func(config):
         container = task_args['container_name']
         reply_to_queue_name = task_args['reply_to']
         is_predict_step = task_args.get("predict", False)
-        queue = AzureServiceBusQueue(config.getAzureServiceBusNamespace(),
-                                     config.getAzureServiceBusKey(),
-                                     config.getAzureServiceBusIssuer(),
-                                     reply_to_queue_name)
+        if reply_to_queue_name not in update_batchers:
+            reply_to_queue = create_queue(config.getQueueBackend(), reply_to_queue_name, **config.getQueueOptions())
+            update_batchers[reply_to_queue_name] = UpdateBatcher(reply_to_queue, config.getStatusUpdateWindow())
+        update_batcher = update_batchers[reply_to_queue_name]
         root_dir = None
-        current_dir = os.getcwd()
-        temp_dir = config.getLocalRoot()
+        log_uploaders = []
+        uploader = None
+        temp_dir = local_root
         try:
            running_processes = subprocess.check_output(["fuser", temp_dir])
         except subprocess.CalledProcessError, e:
@@ -249,6 +653,8 @@ def get_run_func(config):
             # Cleanup dir in case any processes didn't clean up properly
             for the_file in os.listdir(temp_dir):
                 file_path = os.path.join(temp_dir, the_file)
+                if bundle_cache is not None and os.path.abspath(file_path) == os.path.abspath(bundle_cache.root):
+                    continue
                 if os.path.isfile(file_path):
                     os.unlink(file_path)
                 elif os.path.isdir(file_path):
@@ -260,15 +666,14 @@ def get_run_func(config):
             except subprocess.CalledProcessError:
                 pass
 
-            _send_update(queue, task_id, 'running', extra={
+            update_batcher.send(task_id, 'running', extra={
                 'metadata': debug_metadata
             })
             # Create temporary directory for the run
-            root_dir = tempfile.mkdtemp(dir=config.getLocalRoot())
+            root_dir = tempfile.mkdtemp(dir=local_root)
             # Fetch and stage the bundles
-            blob_service = BlobService(config.getAzureStorageAccountName(),
-                                       config.getAzureStorageAccountKey())
-            bundles = getBundle(root_dir, blob_service, container, run_id, 'run')
+            bundles = getBundle(root_dir, blob_service, container, run_id, 'run',
+                                threads=config.getStagingThreads(), cache=bundle_cache)
             # Verify we have an input folder: create one if it's not in the bundle.
             input_rel_path = join('run', 'input')
             if input_rel_path not in bundles:
@@ -305,8 +710,8 @@ def get_run_func(config):
             #
             # Invoke custom evaluation program
             run_dir = join(root_dir, 'run')
-            os.chdir(run_dir)
-            os.environ["PATH"] += os.pathsep + run_dir + "/program"
+            run_env = dict(os.environ)
+            run_env["PATH"] = run_env.get("PATH", "") + os.pathsep + run_dir + "/program"
             logger.debug("Execution directory: %s", run_dir)
 
             if is_predict_step:
@@ -322,6 +727,16 @@ def get_run_func(config):
             stderr = open(stderr_file, "a+")
             prog_status = []
 
+            # Upload the logs while the program runs, so its progress can be followed.
+            stdout_id = "%s/%s" % (os.path.splitext(run_id)[0], stdout_file_name)
+            stderr_id = "%s/%s" % (os.path.splitext(run_id)[0], stderr_file_name)
+            log_uploaders = [
+                LiveFileUploader(blob_service, container, stdout_id, stdout_file, interval=config.getLogFlushInterval()),
+                LiveFileUploader(blob_service, container, stderr_id, stderr_file, interval=config.getLogFlushInterval()),
+            ]
+            for log_uploader in log_uploaders:
+                log_uploader.start()
+
             for prog_cmd_counter, prog_cmd in enumerate(prog_cmd_list):
                 # Update command-line with the real paths
                 logger.debug("CMD: %s", prog_cmd)
@@ -333,7 +748,7 @@ def get_run_func(config):
                                     .replace("\\", os.path.sep)
                 logger.debug("Invoking program: %s", prog_cmd)
 
-                startTime = time.time()
+                startTime = _monotonic()
                 exit_code = None
                 timed_out = False
 
@@ -343,47 +758,34 @@ def get_run_func(config):
                     # Run as separate user
                     evaluator_process = Popen(
                         prog_cmd.split(' '),
-                        preexec_fn=demote(),  # this pre-execution function drops into a lower user
+                        # this pre-execution function applies the slot's limits and drops into a lower user
+                        preexec_fn=limit(memory_limit, cpus, user='workeruser'),
                         stdout=stdout,
                         stderr=stderr,
-                        env=os.environ
+                        cwd=run_dir,
+                        env=run_env
                     )
                 else:
                     evaluator_process = Popen(
                         prog_cmd.split(' '),
+                        preexec_fn=limit(memory_limit, cpus),
                         stdout=stdout,
                         stderr=stderr,
-                        env=os.environ
+                        cwd=run_dir,
+                        env=run_env
                     )
 
                 logger.debug("Started process, pid=%s" % evaluator_process.pid)
 
-                time_difference = time.time() - startTime
-                signal.signal(signal.SIGALRM, alarm_handler)
-                signal.alarm(int(math.fabs(math.ceil(execution_time_limit - time_difference))))
-
-                exit_code = None
-
-                logger.debug("Checking process, exit_code = %s" % exit_code)
-
-                try:
-                    while exit_code == None:
-                        time.sleep(1)
-                        exit_code = evaluator_process.poll()
-                except (ValueError, OSError):
-                    pass # tried to communicate with dead process
-                except ExecutionTimeLimitExceeded:
+                exit_code, timed_out = supervise(evaluator_process, startTime + execution_time_limit)
+                if timed_out:
                     exit_code = -1
                     logger.info("Killed process for running too long!")
                     stderr.write("Execution time limit exceeded!")
-                    evaluator_process.kill()
-                    timed_out = True
-
-                signal.alarm(0)
 
                 logger.debug("Exit Code: %d", exit_code)
 
-                endTime = time.time()
+                endTime = _monotonic()
                 elapsedTime = endTime - startTime
 
                 if len(prog_cmd_list) == 1:
@@ -405,40 +807,38 @@ def get_run_func(config):
             stderr.close()
 
             logger.debug("Saving output files")
-            stdout_id = "%s/%s" % (os.path.splitext(run_id)[0], stdout_file_name)
-            _upload(blob_service, container, stdout_id, stdout_file)
-            stderr_id = "%s/%s" % (os.path.splitext(run_id)[0], stderr_file_name)
-            _upload(blob_service, container, stderr_id, stderr_file)
-
-            private_dir = join(output_dir, 'private')
-            if os.path.exists(private_dir):
-                logger.debug("Packing private results...")
-                private_output_file = join(root_dir, 'run', 'private_output.zip')
-                shutil.make_archive(os.path.splitext(private_output_file)[0], 'zip', output_dir)
-                private_output_id = "%s/private_output.zip" % (os.path.splitext(run_id)[0])
-                _upload(blob_service, container, private_output_id, private_output_file)
-                shutil.rmtree(private_dir)
-
-            # Pack results and send them to Blob storage
+            for log_uploader in log_uploaders:
+                log_uploader.close()
+
+            # Output files are uploaded concurrently while the results are packed.
+            uploader = BlockUploader(blob_service, threads=config.getUploadThreads())
+
+            # Pack results and send them to Blob storage as they are zipped
             logger.debug("Packing results...")
-            output_file = join(root_dir, 'run', 'output.zip')
-            shutil.make_archive(os.path.splitext(output_file)[0], 'zip', output_dir)
-            output_id = "%s/output.zip" % (os.path.splitext(run_id)[0])
-            _upload(blob_service, container, output_id, output_file)
-
-            # Check if the output folder contain an "html file" and copy the html file as detailed_results.html
-            # traverse root directory, and list directories as dirs and files as files
-            html_found = False
-            for root, dirs, files in os.walk(output_dir):
-                if not (html_found):
-                    path = root.split('/')
-                    for file in files:
-                        file_to_upload = os.path.join(root,file)
-                        file_ext = os.path.splitext(file_to_upload)[1]
-                        if file_ext.lower() ==".html":
-                            html_file_id = "%s/html/%s" % (os.path.splitext(run_id)[0],"detailed_results.html")
-                            _upload(blob_service, container, html_file_id, file_to_upload, "html")
-                            html_found = True
+            output_archive, private_output_archive, html_file = pack_output(output_dir)
+
+            # Copy the output's html file, if any, as detailed_results.html
+            if html_file is not None:
+                html_file_id = "%s/html/%s" % (os.path.splitext(run_id)[0],"detailed_results.html")
+                uploader.submit(container, html_file_id, html_file, "html")
+
+            # Both archives are zipped in one pass, so the files they share are compressed once.
+            archives = [output_archive]
+            writers = [uploader.writer(container, "%s/output.zip" % (os.path.splitext(run_id)[0]))]
+            if private_output_archive is not None:
+                archives.append(private_output_archive)
+                writers.append(uploader.writer(container, "%s/private_output.zip" % (os.path.splitext(run_id)[0])))
+            try:
+                zipstream.write_archives(archives, writers)
+            except:
+                for writer in writers:
+                    writer.abort()
+                uploader.wait()
+                raise
+            for writer in writers:
+                writer.close()
+
+            uploader.wait()
 
             # Save extra metadata
             debug_metadata["end_virtual_memory_usage"] = json.dumps(psutil.virtual_memory()._asdict())
@@ -448,19 +848,22 @@ def get_run_func(config):
             # check if timed out AFTER output files are written! If we exit sooner, no output is written
             if timed_out:
                 logger.exception("Run task timed out (task_id=%s).", task_id)
-                _send_update(queue, task_id, 'failed', extra={
+                update_batcher.send(task_id, 'failed', extra={
                     'metadata': debug_metadata
                 })
             elif exit_code != 0:
                 logger.exception("Run task exit code non-zero (task_id=%s).", task_id)
-                _send_update(queue, task_id, 'failed', extra={
+                update_batcher.send(task_id, 'failed', extra={
                     'traceback': open(stderr_file).read(),
                     'metadata': debug_metadata
                 })
             else:
-                _send_update(queue, task_id, 'finished', extra={
-                    'metadata': debug_metadata
-                })
+                extra = {'metadata': debug_metadata}
+                # Scores are sent with the update, so the site needs not download output.zip.
+                scores = read_scores(output_dir)
+                if scores is not None:
+                    extra['scores'] = scores
+                update_batcher.send(task_id, 'finished', extra=extra)
         except Exception:
             if debug_metadata['end_virtual_memory_usage'] == None:
                 # We didnt' make it far enough to save end metadata... so do it!
@@ -469,19 +872,25 @@ def get_run_func(config):
                 debug_metadata["end_cpu_usage"] = psutil.cpu_percent(interval=None)
 
             logger.exception("Run task failed (task_id=%s).", task_id)
-            _send_update(queue, task_id, 'failed', extra={
+            update_batcher.send(task_id, 'failed', extra={
                 'traceback': traceback.format_exc(),
                 'metadata': debug_metadata
             })
 
         # comment out for dev and viewing of raw folder outputs.
+        for log_uploader in log_uploaders:
+            log_uploader.stop()
+        if uploader is not None:
+            # Let uploads still reading files from the run directory finish.
+            uploader.close()
+
         if root_dir is not None:
             # Try cleaning-up temporary directory
             try:
-                os.chdir(current_dir)
                 shutil.rmtree(root_dir)
             except:
                 logger.exception("Unable to clean-up local folder %s (task_id=%s)", root_dir, task_id)
+        logger.debug("Connection pool after run (task_id=%s): %s", task_id, connection_pool.stats())
     return run
 
 def main():
@@ -493,16 +902,19 @@ def main():
     logging.config.dictConfig(config.getLoggerDictConfig())
 
     # queue to listen to for notifications of tasks to perform
-    queue = AzureServiceBusQueue(config.getAzureServiceBusNamespace(),
-                                 config.getAzureServiceBusKey(),
-                                 config.getAzureServiceBusIssuer(),
-                                 config.getAzureServiceBusQueue())
+    queue = create_queue(config.getQueueBackend(), config.getQueueName(), **config.getQueueOptions())
+    slots = config.getSlots()
     # map task type to function to accomplish the task
-    vtable = {
-        'run' : get_run_func(config)
-    }
+    if slots > 1:
+        vtable = lambda slot: {
+            'run' : get_run_func(config, slot)
+        }
+    else:
+        vtable = {
+            'run' : get_run_func(config)
+        }
     # create and start the worker
-    worker = BaseWorker(queue, vtable, logger)
+    worker = BaseWorker(queue, vtable, logger, slots=slots)
     logger.info("Starting compute worker.")
     worker.start()
 
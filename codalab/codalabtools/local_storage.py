@@ -0,0 +1,401 @@
+"""
+Defines a stand-in for Windows Azure Blob storage backed by a local directory.
+
+LocalBlobService implements the part of azure.storage.BlobService which CodaLab uses (ranged
+reads, block uploads, properties, listing and deletion) over a directory tree. The site and
+the compute workers can then run on a single machine without any round trip to Azure. The
+Blobs of a container are the files under the directory named after the container.
+
+Blocks which are not committed yet live under ROOT/.blocks. The properties which a file does
+not hold itself (content type, MD5 and the list of committed blocks) live in a JSON file under
+ROOT/.properties. A Blob is written to a temporary file under ROOT/.tmp, then moved into place,
+so readers never see a partial Blob. Ranges are read through mmap, straight from the page cache.
+
+In place of Shared Access Signatures, the service signs URLs with HMAC-SHA256: make_blob_url
+signs a URL and check_blob_url checks one. The Blobs of public containers can also be read
+through the unsigned URLs of blob_url.
+"""
+import base64
+import binascii
+import copy
+import errno
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import time
+import urllib
+
+from email.utils import formatdate
+
+from azure import (
+    WindowsAzureConflictError,
+    WindowsAzureError,
+    WindowsAzureMissingResourceError)
+
+from azure.storage import Blob
+
+from codalabtools.azure_extensions import BlobExistsError
+
+# Size of the chunks in which blocks are copied into a Blob.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Directories of the root which are not containers.
+_BLOCKS_DIR = '.blocks'
+_PROPERTIES_DIR = '.properties'
+_TEMP_DIR = '.tmp'
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _remove(path):
+    """Removes a file, which may not exist. Returns True if the file was removed."""
+    try:
+        os.remove(path)
+        return True
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+
+def _md5(data):
+    return base64.b64encode(hashlib.md5(data).digest())
+
+def _copy(source, dest, size=None):
+    """Copies size bytes, or the rest of the file, from the current position of source to dest."""
+    while size is None or size > 0:
+        chunk = source.read(COPY_CHUNK_SIZE if size is None else min(size, COPY_CHUNK_SIZE))
+        if not chunk:
+            if size is not None:
+                raise IOError("Unexpected end of %s" % source.name)
+            break
+        dest.write(chunk)
+        if size is not None:
+            size -= len(chunk)
+
+class LocalBlobService(object):
+    """
+    Implements the BlobService methods used by CodaLab over a directory tree.
+    """
+    def __init__(self, root, secret=None, base_url='/blobs', public_containers=()):
+        """
+        root: Path of the directory holding the containers.
+        secret: Key with which URLs are signed. Required by make_blob_url and check_blob_url.
+        base_url: URL under which a web server serves the containers.
+        public_containers: Names of the containers whose Blobs anyone can read, like the
+            containers created with public access in Azure.
+        """
+        self.root = os.path.abspath(root)
+        self.secret = secret.encode('utf-8') if isinstance(secret, unicode) else secret
+        self.base_url = base_url.rstrip('/')
+        self.public_containers = frozenset(public_containers)
+        self._create_only = False
+        for name in (_BLOCKS_DIR, _PROPERTIES_DIR, _TEMP_DIR):
+            _makedirs(os.path.join(self.root, name))
+
+    def create_only_service(self):
+        """
+        Returns a service on the same directory whose commits (put_blob, put_block_list) fail
+        with BlobExistsError instead of replacing an existing Blob.
+        """
+        service = copy.copy(self)
+        service._create_only = True
+        return service
+
+    def _path(self, *names):
+        path = os.path.normpath(os.path.join(self.root, *names))
+        if not path.startswith(self.root + os.sep):
+            raise WindowsAzureError("Invalid name: %s" % '/'.join(names))
+        return path
+
+    def container_path(self, container_name):
+        """Returns the path of the directory of a container."""
+        if container_name.startswith('.') or '/' in container_name:
+            raise WindowsAzureError("Invalid container name: %s" % container_name)
+        return self._path(container_name)
+
+    def blob_path(self, container_name, blob_name):
+        """
+        Returns the path of the file of a Blob, which web servers can send with sendfile.
+        """
+        container_path = self.container_path(container_name)
+        path = self._path(container_path, blob_name)
+        if not path.startswith(container_path + os.sep):
+            raise WindowsAzureError("Invalid blob name: %s" % blob_name)
+        return path
+
+    def _properties_path(self, container_name, blob_name):
+        self.blob_path(container_name, blob_name)
+        return self._path(_PROPERTIES_DIR, container_name, blob_name + '.json')
+
+    def _blocks_path(self, container_name, blob_name, block_id=None):
+        self.blob_path(container_name, blob_name)
+        path = self._path(_BLOCKS_DIR, container_name, hashlib.sha1(blob_name.encode('utf-8')).hexdigest())
+        return path if block_id is None else os.path.join(path, binascii.hexlify(block_id))
+
+    def _temp_file(self):
+        """Returns an open temporary file, on the same file system as the Blobs."""
+        return tempfile.NamedTemporaryFile(dir=os.path.join(self.root, _TEMP_DIR), delete=False)
+
+    def _read_properties(self, container_name, blob_name):
+        try:
+            with open(self._properties_path(container_name, blob_name)) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+
+    def _write_properties(self, container_name, blob_name, properties):
+        path = self._properties_path(container_name, blob_name)
+        _makedirs(os.path.dirname(path))
+        with self._temp_file() as f:
+            json.dump(properties, f)
+        os.rename(f.name, path)
+
+    def _commit(self, temp_path, container_name, blob_name, properties):
+        """Moves a temporary file into place as a Blob."""
+        path = self.blob_path(container_name, blob_name)
+        try:
+            _makedirs(os.path.dirname(path))
+            if self._create_only:
+                # Unlike rename, link fails if the Blob exists.
+                try:
+                    os.link(temp_path, path)
+                except OSError as e:
+                    if e.errno == errno.EEXIST:
+                        raise BlobExistsError("Blob already exists: %s/%s" % (container_name, blob_name))
+                    raise
+            else:
+                os.rename(temp_path, path)
+        finally:
+            _remove(temp_path)
+        self._write_properties(container_name, blob_name, properties)
+
+    def create_container(self, container_name, x_ms_meta_name_values=None, x_ms_blob_public_access=None,
+                         fail_on_exist=False):
+        path = self.container_path(container_name)
+        if os.path.isdir(path):
+            if fail_on_exist:
+                raise WindowsAzureConflictError("The specified container already exists.")
+            return False
+        _makedirs(path)
+        return True
+
+    def list_blobs(self, container_name, prefix=None, marker=None, maxresults=None, include=None, delimiter=None):
+        """
+        Returns the list of the Blobs of a container, sorted by name. Only the name and
+        properties of the Blobs are set.
+        """
+        prefix = prefix or ''
+        container_path = self.container_path(container_name)
+        # Only the directory of the prefix is walked.
+        top = self._path(container_path, os.path.dirname(prefix)) if '/' in prefix else container_path
+        blobs = []
+        for dir_path, _, file_names in os.walk(top):
+            for file_name in file_names:
+                name = os.path.relpath(os.path.join(dir_path, file_name), container_path).replace(os.sep, '/')
+                if not name.startswith(prefix):
+                    continue
+                try:
+                    properties = self.get_blob_properties(container_name, name)
+                except WindowsAzureMissingResourceError:
+                    continue
+                blob = Blob()
+                blob.name = name
+                blob.properties.content_length = int(properties['content-length'])
+                blob.properties.etag = properties['etag']
+                blob.properties.last_modified = properties['last-modified']
+                blob.properties.content_type = properties['content-type']
+                blob.properties.content_md5 = properties.get('content-md5', u'')
+                blob.properties.blob_type = properties['x-ms-blob-type']
+                blobs.append(blob)
+        blobs.sort(key=lambda blob: blob.name)
+        return blobs[:maxresults] if maxresults else blobs
+
+    def get_blob_properties(self, container_name, blob_name, x_ms_lease_id=None):
+        try:
+            stat = os.stat(self.blob_path(container_name, blob_name))
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                raise WindowsAzureMissingResourceError("The specified blob does not exist.")
+            raise
+        stored = self._read_properties(container_name, blob_name)
+        properties = {
+            'content-length': str(stat.st_size),
+            # Each commit moves a new file into place, so the inode changes with the content.
+            'etag': '"0x%X%X"' % (int(stat.st_mtime * 1000000), stat.st_ino),
+            'last-modified': formatdate(stat.st_mtime, usegmt=True),
+            'content-type': stored.get('content-type') or 'application/octet-stream',
+            'x-ms-blob-type': 'BlockBlob',
+        }
+        if stored.get('content-md5'):
+            properties['content-md5'] = stored['content-md5']
+        return properties
+
+    def get_blob(self, container_name, blob_name, snapshot=None, x_ms_range=None, x_ms_lease_id=None,
+                 x_ms_range_get_content_md5=None):
+        path = self.blob_path(container_name, blob_name)
+        try:
+            f = open(path, 'rb')
+        except IOError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                raise WindowsAzureMissingResourceError("The specified blob does not exist.")
+            raise
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size - 1
+            if x_ms_range is not None:
+                start, end = [int(value) for value in x_ms_range[len('bytes='):].split('-')]
+                if start >= size:
+                    raise WindowsAzureError("The range specified is invalid for the current size of the resource.")
+            if size == 0:
+                return ''
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return mapped[start:end + 1]
+            finally:
+                mapped.close()
+
+    def put_blob(self, container_name, blob_name, blob, x_ms_blob_type, content_encoding=None,
+                 content_language=None, content_md5=None, cache_control=None, x_ms_blob_content_type=None,
+                 x_ms_blob_content_encoding=None, x_ms_blob_content_language=None, x_ms_blob_content_md5=None,
+                 x_ms_blob_cache_control=None, x_ms_meta_name_values=None, x_ms_lease_id=None,
+                 x_ms_blob_content_length=None, x_ms_blob_sequence_number=None):
+        if x_ms_blob_type != 'BlockBlob':
+            raise WindowsAzureError("Unsupported blob type: %s" % x_ms_blob_type)
+        if content_md5 is not None and content_md5 != _md5(blob):
+            raise WindowsAzureError("The MD5 value specified in the request did not match the MD5 value of the content.")
+        with self._temp_file() as f:
+            f.write(blob)
+        self._commit(f.name, container_name, blob_name, {
+            'content-type': x_ms_blob_content_type,
+            'content-md5': x_ms_blob_content_md5 or _md5(blob),
+            'blocks': [],
+        })
+        shutil.rmtree(self._blocks_path(container_name, blob_name), ignore_errors=True)
+
+    def put_block(self, container_name, blob_name, block, blockid, content_md5=None, x_ms_lease_id=None):
+        if content_md5 is not None and content_md5 != _md5(block):
+            raise WindowsAzureError("The MD5 value specified in the request did not match the MD5 value of the content.")
+        path = self._blocks_path(container_name, blob_name, blockid)
+        _makedirs(os.path.dirname(path))
+        with self._temp_file() as f:
+            f.write(block)
+        os.rename(f.name, path)
+
+    def put_block_list(self, container_name, blob_name, block_list, content_md5=None, x_ms_blob_cache_control=None,
+                       x_ms_blob_content_type=None, x_ms_blob_content_encoding=None, x_ms_blob_content_language=None,
+                       x_ms_blob_content_md5=None, x_ms_meta_name_values=None, x_ms_lease_id=None):
+        """
+        Commits a Blob made of the given blocks, which were either sent with put_block or are
+        committed blocks of the Blob. Uncommitted blocks are preferred, like Azure's 'Latest'.
+        """
+        blocks_path = self._blocks_path(container_name, blob_name)
+        # The committed blocks are read from the current file, which stays readable once replaced.
+        committed = {}
+        offset = 0
+        for block_id, size in self._read_properties(container_name, blob_name).get('blocks', []):
+            committed[block_id] = (offset, size)
+            offset += size
+        try:
+            current = open(self.blob_path(container_name, blob_name), 'rb') if committed else None
+        except IOError:
+            current, committed = None, {}
+        blocks = []
+        try:
+            with self._temp_file() as f:
+                for block_id in block_list:
+                    block_path = self._blocks_path(container_name, blob_name, block_id)
+                    if os.path.exists(block_path):
+                        with open(block_path, 'rb') as block:
+                            _copy(block, f)
+                        blocks.append((block_id, os.path.getsize(block_path)))
+                    elif block_id in committed:
+                        offset, size = committed[block_id]
+                        current.seek(offset)
+                        _copy(current, f, size)
+                        blocks.append((block_id, size))
+                    else:
+                        raise WindowsAzureError("The specified block list is invalid.")
+        except:
+            _remove(f.name)
+            raise
+        finally:
+            if current is not None:
+                current.close()
+        self._commit(f.name, container_name, blob_name, {
+            'content-type': x_ms_blob_content_type,
+            'content-md5': x_ms_blob_content_md5,
+            'blocks': blocks,
+        })
+        # Like Azure, drop the blocks which were not committed.
+        shutil.rmtree(blocks_path, ignore_errors=True)
+
+    def delete_blob(self, container_name, blob_name, snapshot=None, x_ms_lease_id=None):
+        if not _remove(self.blob_path(container_name, blob_name)):
+            raise WindowsAzureMissingResourceError("The specified blob does not exist.")
+        _remove(self._properties_path(container_name, blob_name))
+        shutil.rmtree(self._blocks_path(container_name, blob_name), ignore_errors=True)
+
+    def _signature(self, container_name, blob_name, permission, expiry, content_disposition=None):
+        if not self.secret:
+            raise ValueError("A secret is required to sign URLs.")
+        message = '\n'.join((permission, expiry or '', container_name, blob_name,
+                             content_disposition or '')).encode('utf-8')
+        return base64.urlsafe_b64encode(hmac.new(self.secret, message, hashlib.sha256).digest()).rstrip('=')
+
+    def blob_url(self, container_name, blob_name):
+        """Returns the unsigned URL of a Blob, which only gives access to the Blobs of public containers."""
+        return '%s/%s/%s' % (self.base_url, urllib.quote(container_name), urllib.quote(blob_name.encode('utf-8')))
+
+    def make_blob_url(self, container_name, blob_name, permission='r', expiry=None, content_disposition=None):
+        """
+        Returns a signed URL giving access to a Blob.
+
+        container_name: Name of the container holding the Blob.
+        blob_name: Name of the Blob.
+        permission: The access given: 'r' to read, 'w' to write, or both.
+        expiry: POSIX time after which the URL is refused, or None for a URL which never expires.
+        content_disposition: Optional Content-Disposition header with which the Blob is read
+            through the URL, like the 'rscd' parameter of a SAS.
+        """
+        expiry = None if expiry is None else str(int(expiry))
+        query = [('sp', permission)]
+        if expiry is not None:
+            query.append(('se', expiry))
+        if content_disposition is not None:
+            query.append(('rscd', content_disposition))
+        query.append(('sig', self._signature(container_name, blob_name, permission, expiry, content_disposition)))
+        return '%s?%s' % (self.blob_url(container_name, blob_name), urllib.urlencode(query))
+
+    def check_blob_url(self, container_name, blob_name, permission, params):
+        """
+        Returns True if the query parameters of a URL made by make_blob_url sign the given
+        access ('r' or 'w') to a Blob and have not expired. Blobs of public containers can be
+        read without a signature.
+        """
+        if permission == 'r' and container_name in self.public_containers:
+            return True
+        granted = params.get('sp', '')
+        expiry = params.get('se') or None
+        if permission not in granted:
+            return False
+        if expiry is not None:
+            try:
+                if int(expiry) < time.time():
+                    return False
+            except ValueError:
+                return False
+        signature = params.get('sig', '')
+        if isinstance(signature, unicode):
+            signature = signature.encode('utf-8')
+        return hmac.compare_digest(signature, self._signature(container_name, blob_name, granted, expiry,
+                                                              params.get('rscd') or None))
@@ -0,0 +1,206 @@
+"""
+Defines a Queue backed by a table of a SQL database.
+
+The queue lets the whole submission pipeline run on one machine, or next to the site's own
+database, without any round trip to Service Bus. Messages of all queues are rows of one table.
+A receiver claims several messages at once by stamping them with a receipt and hiding them for
+a visibility timeout; a message which is not acknowledged before the timeout expires is
+delivered again, and a message delivered too many times is moved to a dead-letter queue.
+
+On PostgreSQL and MySQL, candidate rows are selected with SELECT ... FOR UPDATE SKIP LOCKED,
+so concurrent receivers claim distinct messages without waiting for each other. Other
+databases fall back to a conditional UPDATE, which is just as safe but makes concurrent
+receivers contend for the same rows.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import (and_,
+                        create_engine,
+                        Column,
+                        Float,
+                        Index,
+                        Integer,
+                        MetaData,
+                        String,
+                        Table,
+                        Text,
+                        text)
+
+from codalabtools import Queue, QueueMessage
+
+logger = logging.getLogger('codalabtools')
+
+# Seconds during which a received message is hidden from other receivers.
+VISIBILITY_TIMEOUT = 5 * 60
+
+# Seconds receive_message waits for a message before it returns None.
+POLLING_TIMEOUT = 60
+
+# Seconds between two polls of the table while it has no message to deliver.
+POLL_INTERVAL = 0.5
+
+# Number of deliveries after which a message is moved to the dead-letter queue.
+MAX_DELIVERIES = 5
+
+# Suffix of the name of a queue's dead-letter queue.
+DEAD_LETTER_SUFFIX = '.dead'
+
+_SKIP_LOCKED_DIALECTS = ('postgresql', 'mysql')
+
+metadata = MetaData()
+
+messages = Table('codalab_queue_messages', metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('queue', String(256), nullable=False),
+                 Column('body', Text, nullable=False),
+                 Column('visible_at', Float, nullable=False),
+                 Column('receipt', String(32), nullable=True),
+                 Column('deliveries', Integer, nullable=False, default=0),
+                 Index('codalab_queue_messages_visible', 'queue', 'visible_at'))
+
+_SKIP_LOCKED_CANDIDATES = text("SELECT id FROM codalab_queue_messages WHERE queue = :queue AND visible_at <= :now "
+                               "ORDER BY id LIMIT :limit FOR UPDATE SKIP LOCKED")
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _get_engine(url):
+    """Returns the engine of a database, creating its table on first use. Engines are shared by queues."""
+    with _engines_lock:
+        if url not in _engines:
+            engine = create_engine(url)
+            metadata.create_all(engine, checkfirst=True)
+            _engines[url] = engine
+        return _engines[url]
+
+
+class SqlQueueMessage(QueueMessage):
+    """
+    Implements a QueueMessage backed by a row of the messages table.
+    """
+    def __init__(self, queue, message_id, receipt, body, deliveries):
+        self.queue = queue
+        self.message_id = message_id
+        self.receipt = receipt
+        self.body = body
+        self.deliveries = deliveries
+
+    def get_body(self):
+        return self.body
+
+    def get_queue(self):
+        return self.queue
+
+    def ack(self):
+        self.queue.delete_message(self.message_id, self.receipt)
+
+
+class SqlQueue(Queue):
+    """
+    Implements a Queue backed by a table of a SQL database.
+    """
+    def __init__(self, url, name, visibility_timeout=VISIBILITY_TIMEOUT, polling_timeout=POLLING_TIMEOUT,
+                 poll_interval=POLL_INTERVAL, max_deliveries=MAX_DELIVERIES):
+        """
+        url: The SQLAlchemy URL of the database.
+        name: The name of the queue.
+        visibility_timeout: Seconds during which a received message is hidden from other receivers.
+        polling_timeout: Seconds receive_message waits for a message before it returns None.
+        poll_interval: Seconds between two polls while the queue is empty.
+        max_deliveries: Number of deliveries after which a message is moved to the dead-letter queue.
+        """
+        self.url = url
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.polling_timeout = polling_timeout
+        self.poll_interval = poll_interval
+        self.max_deliveries = max_deliveries
+        self._engine = _get_engine(url)
+        self._pid = os.getpid()
+
+    @property
+    def engine(self):
+        if os.getpid() != self._pid:
+            # Connections inherited from the parent process must not be shared with it.
+            self._engine.dispose()
+            self._pid = os.getpid()
+        return self._engine
+
+    def _candidate_ids(self, conn, max_count, now):
+        if self.engine.dialect.name in _SKIP_LOCKED_DIALECTS:
+            rows = conn.execute(_SKIP_LOCKED_CANDIDATES, queue=self.name, now=now, limit=max_count)
+        else:
+            rows = conn.execute(messages.select()
+                                        .with_only_columns([messages.c.id])
+                                        .where(and_(messages.c.queue == self.name, messages.c.visible_at <= now))
+                                        .order_by(messages.c.id)
+                                        .limit(max_count))
+        return [row[0] for row in rows]
+
+    def _claim(self, max_count):
+        """Claims up to max_count visible messages and returns them."""
+        now = time.time()
+        receipt = uuid.uuid4().hex
+        with self.engine.begin() as conn:
+            ids = self._candidate_ids(conn, max_count, now)
+            if len(ids) == 0:
+                return []
+            conn.execute(messages.update()
+                                 .where(and_(messages.c.id.in_(ids), messages.c.visible_at <= now))
+                                 .values(receipt=receipt,
+                                         visible_at=now + self.visibility_timeout,
+                                         deliveries=messages.c.deliveries + 1))
+            rows = conn.execute(messages.select()
+                                        .where(messages.c.receipt == receipt)
+                                        .order_by(messages.c.id)).fetchall()
+            dead_ids = [row.id for row in rows if row.deliveries > self.max_deliveries]
+            if len(dead_ids) > 0:
+                logger.error("Moving %d message(s) delivered more than %d times to %s%s.",
+                             len(dead_ids), self.max_deliveries, self.name, DEAD_LETTER_SUFFIX)
+                conn.execute(messages.update()
+                                     .where(messages.c.id.in_(dead_ids))
+                                     .values(queue=self.name + DEAD_LETTER_SUFFIX, visible_at=now, receipt=None))
+        return [SqlQueueMessage(self, row.id, receipt, row.body, row.deliveries)
+                for row in rows if row.deliveries <= self.max_deliveries]
+
+    def receive_messages(self, max_count):
+        deadline = time.time() + self.polling_timeout
+        while True:
+            msgs = self._claim(max_count)
+            if len(msgs) > 0 or time.time() >= deadline:
+                return msgs
+            time.sleep(self.poll_interval)
+
+    def receive_message(self):
+        msgs = self.receive_messages(1)
+        return msgs[0] if len(msgs) > 0 else None
+
+    def send_message(self, body):
+        self.send_messages([body])
+
+    def send_messages(self, bodies):
+        if len(bodies) == 0:
+            return
+        now = time.time()
+        with self.engine.begin() as conn:
+            conn.execute(messages.insert(),
+                         [{'queue': self.name, 'body': body, 'visible_at': now, 'deliveries': 0} for body in bodies])
+
+    def delete_message(self, message_id, receipt):
+        """
+        Deletes a message, unless its visibility timeout expired and it was received again.
+        """
+        with self.engine.begin() as conn:
+            conn.execute(messages.delete().where(and_(messages.c.id == message_id, messages.c.receipt == receipt)))
+
+
+def create_queue(name, url, **options):
+    """
+    Creates a SqlQueue. This is the factory of the 'sql' queue backend.
+    """
+    return SqlQueue(url, name, **options)
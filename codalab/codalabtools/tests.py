@@ -0,0 +1,708 @@
+"""
+Defines unit tests for this package.
+"""
+import azure
+import base64
+import hashlib
+import httplib
+import json
+import logging
+import os
+import resource
+import shutil
+import StringIO
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+from unittest import TestCase
+
+import mock
+
+from azure.http import HTTPError, HTTPRequest
+from azure.http.httpclient import _HTTPClient
+from azure.servicebus import ServiceBusService
+
+from codalabtools import (PoolWorker, Queue, QueueMessage, backoff_delay, create_queue, register_queue_backend, uploader,
+                          zipstream)
+from codalabtools.azure_extensions import BlobExistsError, ConnectionPool, PooledHTTPClient, pool_connections
+from codalabtools.local_storage import LocalBlobService
+from codalabtools.sql_queue import SqlQueue
+
+class ZipStreamTests(TestCase):
+    """Tests for ZipStream."""
+
+    def _generated_chunks(self, size, chunk_size=1024 * 1024):
+        chunk = ''.join(chr(i % 251) for i in range(chunk_size))
+        while size > 0:
+            yield chunk[:size]
+            size -= chunk_size
+
+    def _stream_size(self, zip_stream):
+        return sum(len(data) for data in zip_stream)
+
+    def test_archive_is_readable(self):
+        """Produces an archive which zipfile reads back."""
+        zip_stream = zipstream.ZipStream()
+        zip_stream.add("a.txt", "first member " * 100)
+        zip_stream.add(u"r\u00e9sultats/b.txt", lambda: iter(["second ", "member"]))
+        zip_stream.add("c.bin", self._generated_chunks(3 * 1024 * 1024 + 17), compress_type=zipfile.ZIP_STORED)
+        zip_stream.add("empty.txt", "")
+        zip_file = zipfile.ZipFile(StringIO.StringIO(''.join(zip_stream)))
+        self.assertIsNone(zip_file.testzip())
+        self.assertEqual(["a.txt", u"r\u00e9sultats/b.txt", "c.bin", "empty.txt"], zip_file.namelist())
+        self.assertEqual("first member " * 100, zip_file.read("a.txt"))
+        self.assertEqual("second member", zip_file.read(u"r\u00e9sultats/b.txt"))
+        self.assertEqual(''.join(self._generated_chunks(3 * 1024 * 1024 + 17)), zip_file.read("c.bin"))
+        self.assertEqual("", zip_file.read("empty.txt"))
+        self.assertEqual(zipfile.ZIP_DEFLATED, zip_file.getinfo("a.txt").compress_type)
+        self.assertEqual(zipfile.ZIP_STORED, zip_file.getinfo("c.bin").compress_type)
+
+    def test_members_of_unknown_size_have_zip64_headers(self):
+        """Writes a Zip64 local header and 64-bit data descriptor for members of unknown size."""
+        zip_stream = zipstream.ZipStream()
+        zip_stream.add("known.txt", "known size")
+        zip_stream.add("unknown.bin", lambda: self._generated_chunks(100000))
+        data = ''.join(zip_stream)
+        zip_file = zipfile.ZipFile(StringIO.StringIO(data))
+        self.assertIsNone(zip_file.testzip())
+        known, unknown = zip_file.infolist()
+        self.assertEqual(20, struct.unpack("<H", data[known.header_offset + 4:known.header_offset + 6])[0])
+        header = data[unknown.header_offset:unknown.header_offset + 30]
+        version, size, compressed_size, extra_length = struct.unpack("<4xH12xLL2xH", header)
+        self.assertEqual((45, 0xFFFFFFFF, 0xFFFFFFFF, 20), (version, size, compressed_size, extra_length))
+        extra = data[unknown.header_offset + 30 + len("unknown.bin"):][:extra_length]
+        self.assertEqual((0x0001, 16, 0, 0), struct.unpack("<2H2Q", extra))
+        self.assertEqual(45, unknown.extract_version)
+        descriptor = data[unknown.header_offset + 30 + len("unknown.bin") + extra_length + unknown.compress_size:]
+        self.assertEqual(("PK\007\010", unknown.CRC, unknown.compress_size, 100000),
+                         struct.unpack("<4sLQQ", descriptor[:24]))
+        # The central directory agrees with the local header: the sizes are in a Zip64 extra field.
+        central = zip_file.start_dir + 46 + len("known.txt")
+        compressed_size, size, name_length, extra_length = struct.unpack("<2L2H", data[central + 20:central + 32])
+        self.assertEqual((0xFFFFFFFF, 0xFFFFFFFF, 20), (compressed_size, size, extra_length))
+        self.assertEqual((0x0001, 16, 100000, unknown.compress_size),
+                         struct.unpack("<2H2Q", data[central + 46 + name_length:][:extra_length]))
+
+    def test_callable_sources_are_opened_lazily(self):
+        """Opens member sources only when the stream reaches them."""
+        opened = []
+        def source(name):
+            def open_source():
+                opened.append(name)
+                return [name]
+            return open_source
+        zip_stream = zipstream.ZipStream()
+        zip_stream.add("a", source("a"))
+        zip_stream.add("b", source("b"))
+        stream = iter(zip_stream)
+        next(stream)
+        self.assertEqual([], opened)
+        list(stream)
+        self.assertEqual(["a", "b"], opened)
+
+    def test_shared_members_are_compressed_once(self):
+        """Reads each member shared by archives written together once, and each archive stays readable."""
+        opened = []
+        def source(name):
+            def open_source():
+                opened.append(name)
+                return [name * 1000]
+            return open_source
+        shared, private = source("shared"), source("private")
+        public_stream, private_stream = zipstream.ZipStream(), zipstream.ZipStream()
+        private_stream.add("private/a.txt", private)
+        private_stream.add("b.txt", shared)
+        public_stream.add("b.txt", shared)
+        public_sink, private_sink = StringIO.StringIO(), StringIO.StringIO()
+        zipstream.write_archives([public_stream, private_stream], [public_sink, private_sink])
+        self.assertEqual(["private", "shared"], opened)
+        public_zip = zipfile.ZipFile(StringIO.StringIO(public_sink.getvalue()))
+        private_zip = zipfile.ZipFile(StringIO.StringIO(private_sink.getvalue()))
+        self.assertIsNone(public_zip.testzip())
+        self.assertIsNone(private_zip.testzip())
+        self.assertEqual(["b.txt"], public_zip.namelist())
+        self.assertEqual(["private/a.txt", "b.txt"], private_zip.namelist())
+        self.assertEqual("shared" * 1000, public_zip.read("b.txt"))
+        self.assertEqual("private" * 1000, private_zip.read("private/a.txt"))
+
+    def test_peak_memory_is_flat(self):
+        """Keeps peak RSS flat while the archive grows."""
+        small = zipstream.ZipStream(compression=zipfile.ZIP_STORED)
+        small.add("small.bin", self._generated_chunks(16 * 1024 * 1024))
+        self.assertGreater(self._stream_size(small), 16 * 1024 * 1024)
+        small_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        large = zipstream.ZipStream(compression=zipfile.ZIP_STORED)
+        for i in range(4):
+            large.add("large-%d.bin" % i, self._generated_chunks(64 * 1024 * 1024))
+        self.assertGreater(self._stream_size(large), 256 * 1024 * 1024)
+        large_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # ru_maxrss is in kilobytes; a buffered archive would have added over 256MB.
+        self.assertLess(large_peak - small_peak, 16 * 1024)
+
+
+class FakeBlobService(object):
+    """In-memory stand-in for the upload methods of BlobService."""
+    def __init__(self, failures=0, delay=0):
+        self.blobs = {}
+        self.properties = {}
+        self.blocks = {}
+        self.failures = failures
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def put_blob(self, container, blob_id, blob, x_ms_blob_type, content_md5=None, x_ms_blob_content_type=None):
+        if content_md5 is not None:
+            assert content_md5 == base64.b64encode(hashlib.md5(blob).digest())
+        self.blobs[blob_id] = blob
+        self.properties[blob_id] = {'content-type': x_ms_blob_content_type}
+
+    def put_block(self, container, blob_id, block, block_id, content_md5=None):
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise azure.WindowsAzureError("Server busy")
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        assert content_md5 == base64.b64encode(hashlib.md5(block).digest())
+        with self.lock:
+            self.blocks[(blob_id, block_id)] = block
+            self.in_flight -= 1
+
+    def put_block_list(self, container, blob_id, block_ids, x_ms_blob_content_type=None, x_ms_blob_content_md5=None):
+        blob = ''.join(self.blocks[(blob_id, block_id)] for block_id in block_ids)
+        if x_ms_blob_content_md5 is not None:
+            assert x_ms_blob_content_md5 == base64.b64encode(hashlib.md5(blob).digest())
+        self.blobs[blob_id] = blob
+        self.properties[blob_id] = {'content-type': x_ms_blob_content_type}
+
+class BlockUploaderTests(TestCase):
+    """Tests for BlockUploader."""
+
+    def _uploader(self, blob_service, **kwargs):
+        block_uploader = uploader.BlockUploader(blob_service, block_size=1024, **kwargs)
+        self.addCleanup(block_uploader.close)
+        return block_uploader
+
+    def _data(self, size):
+        return ''.join(chr(i % 251) for i in range(size))
+
+    def test_iter_blocks(self):
+        """Splits files and chunk iterables in blocks of the same size."""
+        data = self._data(2500)
+        self.assertEqual([1024, 1024, 452], [len(b) for b in uploader.iter_blocks(StringIO.StringIO(data), 1024)])
+        chunks = [data[i:i + 300] for i in range(0, len(data), 300)]
+        self.assertEqual([data[:1024], data[1024:2048], data[2048:]], list(uploader.iter_blocks(chunks, 1024)))
+
+    def test_uploads_blocks(self):
+        """Uploads large files in blocks and small ones in one request."""
+        blob_service = FakeBlobService()
+        block_uploader = self._uploader(blob_service)
+        block_uploader.upload('container', 'large', StringIO.StringIO(self._data(10000)), 'text/plain')
+        block_uploader.upload('container', 'small', StringIO.StringIO('small'))
+        block_uploader.upload('container', 'empty', iter([]))
+        self.assertEqual(self._data(10000), blob_service.blobs['large'])
+        self.assertEqual('text/plain', blob_service.properties['large']['content-type'])
+        self.assertEqual(10, len([key for key in blob_service.blocks if key[0] == 'large']))
+        self.assertEqual('small', blob_service.blobs['small'])
+        self.assertEqual('', blob_service.blobs['empty'])
+
+    def test_retries_failed_blocks(self):
+        """Retries blocks which failed to upload."""
+        blob_service = FakeBlobService(failures=2)
+        with mock.patch('codalabtools.uploader.RETRY_DELAY', 0):
+            self._uploader(blob_service).upload('container', 'blob', StringIO.StringIO(self._data(5000)))
+        self.assertEqual(self._data(5000), blob_service.blobs['blob'])
+
+    def test_raises_after_retries(self):
+        """Raises the error of a block which kept failing, and does not commit the blob."""
+        blob_service = FakeBlobService(failures=100)
+        block_uploader = self._uploader(blob_service, retries=1)
+        with mock.patch('codalabtools.uploader.RETRY_DELAY', 0):
+            block_uploader.submit('container', 'blob', StringIO.StringIO(self._data(5000)))
+            with self.assertRaises(azure.WindowsAzureError):
+                block_uploader.wait()
+        self.assertNotIn('blob', blob_service.blobs)
+
+    def test_interleaved_writers_keep_their_blocks(self):
+        """Commits the blocks of each writer when two write the same blob at once."""
+        blob_service = FakeBlobService()
+        block_uploader = self._uploader(blob_service)
+        first = block_uploader.writer('container', 'blob')
+        second = block_uploader.writer('container', 'blob')
+        first_data, second_data = self._data(3000), self._data(3000)[::-1]
+        for offset in range(0, 3000, 500):
+            first.write(first_data[offset:offset + 500])
+            second.write(second_data[offset:offset + 500])
+        first.close()
+        self.assertEqual(first_data, blob_service.blobs['blob'])
+        second.close()
+        self.assertEqual(second_data, blob_service.blobs['blob'])
+        self.assertEqual(6, len(blob_service.blocks))
+
+    def test_bounds_blocks_in_memory(self):
+        """Keeps at most the given number of blocks in flight across concurrent uploads."""
+        blob_service = FakeBlobService(delay=0.01)
+        block_uploader = self._uploader(blob_service, threads=4, buffers=3)
+        for i in range(3):
+            block_uploader.submit('container', 'blob%d' % i, StringIO.StringIO(self._data(20000)))
+        block_uploader.wait()
+        for i in range(3):
+            self.assertEqual(self._data(20000), blob_service.blobs['blob%d' % i])
+        self.assertLessEqual(blob_service.max_in_flight, 3)
+        self.assertGreater(blob_service.max_in_flight, 1)
+
+class LiveFileUploaderTests(TestCase):
+    """Tests for LiveFileUploader."""
+
+    def setUp(self):
+        log_file = tempfile.NamedTemporaryFile(delete=False)
+        log_file.close()
+        self.path = log_file.name
+        self.addCleanup(os.remove, self.path)
+
+    def _append(self, data):
+        with open(self.path, 'ab') as f:
+            f.write(data)
+
+    def test_flush_uploads_appended_bytes(self):
+        """Commits the bytes appended since the previous flush as new blocks."""
+        blob_service = FakeBlobService()
+        log_uploader = uploader.LiveFileUploader(blob_service, 'container', 'stdout.txt', self.path, block_size=1024,
+                                                 content_type='text/plain')
+        self._append('first line\n')
+        log_uploader.flush()
+        self.assertEqual('first line\n', blob_service.blobs['stdout.txt'])
+        self._append('x' * 2000)
+        log_uploader.flush()
+        self.assertEqual('first line\n' + 'x' * 2000, blob_service.blobs['stdout.txt'])
+        self.assertEqual(3, len(blob_service.blocks))
+        self._append('last line\n')
+        log_uploader.close()
+        self.assertEqual('first line\n' + 'x' * 2000 + 'last line\n', blob_service.blobs['stdout.txt'])
+        self.assertEqual('text/plain', blob_service.properties['stdout.txt']['content-type'])
+
+    def test_uploads_periodically(self):
+        """Uploads the file in the background while it is written."""
+        blob_service = FakeBlobService()
+        log_uploader = uploader.LiveFileUploader(blob_service, 'container', 'stdout.txt', self.path, interval=0.01)
+        log_uploader.start()
+        self._append('running\n')
+        for _ in range(100):
+            if blob_service.blobs.get('stdout.txt') == 'running\n':
+                break
+            time.sleep(0.01)
+        log_uploader.close()
+        self.assertEqual('running\n', blob_service.blobs['stdout.txt'])
+
+    def test_empty_file(self):
+        """Uploads an empty blob for a file which stayed empty."""
+        blob_service = FakeBlobService()
+        uploader.LiveFileUploader(blob_service, 'container', 'stderr.txt', self.path).close()
+        self.assertEqual('', blob_service.blobs['stderr.txt'])
+
+class LocalBlobServiceTests(TestCase):
+    """Tests for LocalBlobService."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.service = LocalBlobService(self.root, secret='secret')
+
+    def test_upload_and_read_ranges(self):
+        """Commits the blocks sent by a BlockUploader and reads ranges of the blob."""
+        content = os.urandom(10000)
+        block_uploader = uploader.BlockUploader(self.service, block_size=1024, threads=4)
+        block_uploader.upload('bundles', 'runs/1/run.zip', StringIO.StringIO(content), content_type='application/zip')
+        block_uploader.close()
+        self.assertEqual(content, self.service.get_blob('bundles', 'runs/1/run.zip'))
+        self.assertEqual(content[1000:2001], self.service.get_blob('bundles', 'runs/1/run.zip',
+                                                                    x_ms_range='bytes=1000-2000'))
+        properties = self.service.get_blob_properties('bundles', 'runs/1/run.zip')
+        self.assertEqual('10000', properties['content-length'])
+        self.assertEqual('application/zip', properties['content-type'])
+        self.assertEqual(['runs/1/run.zip'], [blob.name for blob in self.service.list_blobs('bundles', 'runs/')])
+        self.assertEqual([], os.listdir(os.path.join(self.root, '.tmp')))
+
+    def test_commit_with_committed_blocks(self):
+        """Builds a blob from its committed blocks and new ones, like LiveFileUploader."""
+        path = os.path.join(self.root, 'stdout.txt')
+        with open(path, 'w') as f:
+            f.write('first line\n')
+        log_uploader = uploader.LiveFileUploader(self.service, 'logs', 'stdout.txt', path, block_size=4)
+        log_uploader.flush()
+        etag = self.service.get_blob_properties('logs', 'stdout.txt')['etag']
+        with open(path, 'a') as f:
+            f.write('last line\n')
+        log_uploader.close()
+        self.assertEqual('first line\nlast line\n', self.service.get_blob('logs', 'stdout.txt'))
+        self.assertNotEqual(etag, self.service.get_blob_properties('logs', 'stdout.txt')['etag'])
+
+    def test_invalid_block_list(self):
+        """Refuses a block list naming a block which was never sent."""
+        self.service.put_block('logs', 'a.txt', 'a', '0')
+        with self.assertRaises(azure.WindowsAzureError):
+            self.service.put_block_list('logs', 'a.txt', ['0', '1'])
+        with self.assertRaises(azure.WindowsAzureMissingResourceError):
+            self.service.get_blob_properties('logs', 'a.txt')
+
+    def test_create_only(self):
+        """Does not replace an existing blob through a create-only service."""
+        self.service.put_blob('public', 'logo.png', 'old', 'BlockBlob')
+        with self.assertRaises(BlobExistsError):
+            self.service.create_only_service().put_blob('public', 'logo.png', 'new', 'BlockBlob')
+        self.assertEqual('old', self.service.get_blob('public', 'logo.png'))
+        self.service.delete_blob('public', 'logo.png')
+        self.service.create_only_service().put_blob('public', 'logo.png', 'new', 'BlockBlob')
+        self.assertEqual('new', self.service.get_blob('public', 'logo.png'))
+
+    def test_names_stay_under_the_root(self):
+        """Refuses names outside of the container."""
+        for container, name in (('bundles', '../other/a'), ('.blocks', 'a'), ('bundles', '')):
+            with self.assertRaises(azure.WindowsAzureError):
+                self.service.put_blob(container, name, 'data', 'BlockBlob')
+
+    def test_signed_urls(self):
+        """Checks the permission, expiry and signature of signed URLs."""
+        def params(url):
+            return dict(pair.split('=') for pair in url.split('?')[1].split('&'))
+
+        url = self.service.make_blob_url('bundles', 'a b.zip', 'w', time.time() + 60)
+        self.assertTrue(url.startswith('/blobs/bundles/a%20b.zip?'))
+        self.assertTrue(self.service.check_blob_url('bundles', 'a b.zip', 'w', params(url)))
+        self.assertFalse(self.service.check_blob_url('bundles', 'a b.zip', 'r', params(url)))
+        self.assertFalse(self.service.check_blob_url('bundles', 'c.zip', 'w', params(url)))
+        expired = self.service.make_blob_url('bundles', 'a b.zip', 'w', time.time() - 1)
+        self.assertFalse(self.service.check_blob_url('bundles', 'a b.zip', 'w', params(expired)))
+        self.assertFalse(self.service.check_blob_url('bundles', 'a b.zip', 'w', {'sp': 'w'}))
+        named = params(self.service.make_blob_url('bundles', 'a b.zip', 'r', time.time() + 60, 'attachment'))
+        self.assertTrue(self.service.check_blob_url('bundles', 'a b.zip', 'r', named))
+        self.assertFalse(self.service.check_blob_url('bundles', 'a b.zip', 'r', dict(named, rscd='inline')))
+
+class FakeQueue(Queue):
+    """Returns the given message bodies, then waits as a queue with no message would."""
+    def __init__(self, bodies):
+        self.bodies = list(bodies)
+
+    def receive_message(self):
+        if self.bodies:
+            return FakeQueueMessage(self.bodies.pop(0))
+        time.sleep(0.1)
+        return None
+
+class FakeQueueMessage(QueueMessage):
+    def __init__(self, body):
+        self.body = body
+
+    def get_body(self):
+        return self.body
+
+class PoolWorkerTests(TestCase):
+    """Tests for PoolWorker."""
+
+    def _message(self, task_id, task_type):
+        return json.dumps({'id': task_id, 'task_type': task_type})
+
+    def _run(self, bodies, vtable, condition, **kwargs):
+        """Runs a worker until condition() holds."""
+        worker = PoolWorker(FakeQueue(bodies), vtable, logging.getLogger('codalabtools'), **kwargs)
+        worker.SUPERVISE_INTERVAL = 0.1
+        thread = threading.Thread(target=worker.start)
+        thread.start()
+        try:
+            for _ in range(100):
+                if condition():
+                    break
+                time.sleep(0.1)
+        finally:
+            worker.stop()
+            thread.join()
+        return worker
+
+    def test_slow_task_does_not_block_others(self):
+        """Runs other tasks while a slow task is in flight."""
+        release = threading.Event()
+        done = []
+        def slow(task_id, task_args):
+            release.wait(10)
+            done.append(task_id)
+        def fast(task_id, task_args):
+            done.append(task_id)
+            if len(done) == 3:
+                release.set()
+        bodies = [self._message(1, 'slow')] + [self._message(i, 'fast') for i in range(2, 5)]
+        self._run(bodies, {'slow': slow, 'fast': fast}, lambda: len(done) == 4, executors=2)
+        self.assertEqual([2, 3, 4, 1], done)
+
+    def test_task_type_limits_are_enforced(self):
+        """Runs at most the limit of tasks of a type at once."""
+        lock = threading.Lock()
+        running = []
+        peaks = []
+        def limited(task_id, task_args):
+            with lock:
+                running.append(task_id)
+                peaks.append(len(running))
+            time.sleep(0.2)
+            with lock:
+                running.remove(task_id)
+        bodies = [self._message(i, 'limited') for i in range(4)]
+        self._run(bodies, {'limited': limited}, lambda: len(peaks) == 4 and not running,
+                  executors=4, limits={'limited': 2})
+        self.assertEqual(4, len(peaks))
+        self.assertEqual(2, max(peaks))
+
+    def test_saturated_task_type_does_not_block_others(self):
+        """Receives and runs tasks of other types while those of a type at its limit wait."""
+        release = threading.Event()
+        done = []
+        def limited(task_id, task_args):
+            release.wait(10)
+            done.append(task_id)
+        def fast(task_id, task_args):
+            done.append(task_id)
+            if len(done) == 2:
+                release.set()
+        bodies = [self._message(i, 'limited') for i in range(4)] + [self._message(i, 'fast') for i in range(4, 6)]
+        self._run(bodies, {'limited': limited, 'fast': fast}, lambda: len(done) == 6,
+                  executors=3, prefetch=2, limits={'limited': 1})
+        self.assertEqual([4, 5], sorted(done[:2]))
+        self.assertEqual([0, 1, 2, 3], done[2:])
+
+    def test_tasks_run_in_executor_processes(self):
+        """Runs tasks in executor processes."""
+        directory = tempfile.mkdtemp()
+        def record(task_id, task_args):
+            open(os.path.join(directory, "%s.%d" % (task_id, os.getpid())), 'w').close()
+        bodies = [self._message(i, 'record') for i in range(3)]
+        self._run(bodies, {'record': record}, lambda: len(os.listdir(directory)) == 3,
+                  executors=2, executor_type=PoolWorker.PROCESS)
+        names = os.listdir(directory)
+        shutil.rmtree(directory)
+        self.assertEqual(['0', '1', '2'], sorted(name.split('.')[0] for name in names))
+        self.assertNotIn(str(os.getpid()), [name.split('.')[1] for name in names])
+
+    def test_dead_executors_are_replaced(self):
+        """Replaces an executor process which died while the others keep running their tasks."""
+        directory = tempfile.mkdtemp()
+        def crash(task_id, task_args):
+            os._exit(1)
+        def record(task_id, task_args):
+            time.sleep(0.5)
+            open(os.path.join(directory, str(task_id)), 'w').close()
+        bodies = [self._message(1, 'record'), self._message(2, 'crash')] + \
+                 [self._message(i, 'record') for i in range(3, 6)]
+        worker = self._run(bodies, {'crash': crash, 'record': record}, lambda: len(os.listdir(directory)) == 4,
+                           executors=2, executor_type=PoolWorker.PROCESS)
+        names = os.listdir(directory)
+        shutil.rmtree(directory)
+        self.assertEqual(['1', '3', '4', '5'], sorted(names))
+        self.assertEqual({}, worker.in_flight)
+
+class SqlQueueTests(TestCase):
+    """Tests for SqlQueue."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.url = 'sqlite:///%s' % os.path.join(directory, 'queue.db')
+
+    def _queue(self, name='tasks', **kwargs):
+        kwargs.setdefault('polling_timeout', 0)
+        return SqlQueue(self.url, name, **kwargs)
+
+    def test_receive_in_batches(self):
+        """Receives messages in the order they were sent, several at a time."""
+        queue = self._queue()
+        queue.send_messages(['a', 'b', 'c'])
+        queue.send_message('d')
+        self.assertEqual(['a', 'b', 'c'], [msg.get_body() for msg in queue.receive_messages(3)])
+        self.assertEqual('d', queue.receive_message().get_body())
+        self.assertIsNone(queue.receive_message())
+
+    def test_queues_are_separate(self):
+        """Delivers messages only to receivers of their queue."""
+        self._queue('other').send_message('a')
+        self.assertIsNone(self._queue().receive_message())
+        self.assertEqual('a', self._queue('other').receive_message().get_body())
+
+    def test_unacknowledged_messages_are_delivered_again(self):
+        """Delivers a message again once its visibility timeout expired, unless it was acknowledged."""
+        queue = self._queue(visibility_timeout=0.2)
+        queue.send_messages(['a', 'b'])
+        first, second = queue.receive_messages(2)
+        first.ack()
+        self.assertIsNone(queue.receive_message())
+        time.sleep(0.3)
+        msg = queue.receive_message()
+        self.assertEqual('b', msg.get_body())
+        self.assertEqual(2, msg.deliveries)
+        # The first receiver can no longer delete the message it lost.
+        second.ack()
+        msg.ack()
+        time.sleep(0.3)
+        self.assertIsNone(queue.receive_message())
+
+    def test_poison_messages_are_dead_lettered(self):
+        """Moves a message delivered too many times to the dead-letter queue."""
+        queue = self._queue(visibility_timeout=0, max_deliveries=2)
+        queue.send_message('a')
+        self.assertIsNotNone(queue.receive_message())
+        self.assertIsNotNone(queue.receive_message())
+        self.assertIsNone(queue.receive_message())
+        self.assertEqual('a', self._queue('tasks.dead').receive_message().get_body())
+
+    def test_receivers_claim_distinct_messages(self):
+        """Never delivers a message to two concurrent receivers."""
+        self._queue().send_messages([str(i) for i in range(100)])
+        received = []
+        def receive():
+            queue = self._queue()
+            while True:
+                msgs = queue.receive_messages(5)
+                if len(msgs) == 0:
+                    break
+                received.extend(msg.get_body() for msg in msgs)
+        threads = [threading.Thread(target=receive) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(str(i) for i in range(100)), sorted(received))
+
+    def test_backend_registry(self):
+        """Creates queues of the registered backends."""
+        queue = create_queue('sql', 'tasks', url=self.url, polling_timeout=0)
+        self.assertIsInstance(queue, SqlQueue)
+        register_queue_backend('fake', lambda name, **options: FakeQueue([name]))
+        self.assertEqual('tasks', create_queue('fake', 'tasks').receive_message().get_body())
+        with self.assertRaises(ValueError):
+            create_queue('unknown', 'tasks')
+
+class FakeResponse(object):
+    """Stands for an httplib.HTTPResponse."""
+
+    def __init__(self, status, body, will_close=False):
+        self.status = status
+        self.reason = 'OK' if status < 300 else 'Error'
+        self.body = body
+        self.will_close = will_close
+
+    def getheaders(self):
+        return [('content-length', str(len(self.body)))]
+
+    def read(self):
+        return self.body
+
+class FakeConnection(object):
+    """Stands for an httplib.HTTPConnection which answers each request with the next response."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.closed = False
+
+    def putrequest(self, method, path):
+        self.requests.append((method, path))
+
+    def putheader(self, name, value):
+        pass
+
+    def endheaders(self):
+        pass
+
+    def send(self, data):
+        pass
+
+    def getresponse(self):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        self.closed = True
+
+class PooledHTTPClientTests(TestCase):
+    """Tests for PooledHTTPClient and ConnectionPool."""
+
+    def _client(self, connections, max_idle=2):
+        client = _HTTPClient(None)
+        client.get_connection = mock.Mock(side_effect=connections)
+        return PooledHTTPClient(client, ConnectionPool(max_idle))
+
+    def _request(self, path='/a'):
+        request = HTTPRequest()
+        request.host = 'example.blob.core.windows.net'
+        request.method = 'GET'
+        request.path = path
+        return request
+
+    def test_connections_are_reused(self):
+        """Sends consecutive requests to a host on the same connection."""
+        connection = FakeConnection([FakeResponse(200, 'a'), FakeResponse(200, 'b')])
+        client = self._client([connection])
+        self.assertEqual('a', client.perform_request(self._request('/a')).body)
+        self.assertEqual('b', client.perform_request(self._request('/b')).body)
+        self.assertEqual([('GET', '/a'), ('GET', '/b')], connection.requests)
+        stats = client.pool.stats()
+        self.assertEqual((1, 1, 2, 0, 1), (stats['hits'], stats['misses'], stats['requests'], stats['errors'],
+                                           stats['idle']))
+
+    def test_stale_connections_are_replaced(self):
+        """Retries a request on a new connection when an idle connection was closed by the server."""
+        stale = FakeConnection([FakeResponse(200, 'a'), httplib.BadStatusLine('')])
+        fresh = FakeConnection([FakeResponse(200, 'b')])
+        client = self._client([stale, fresh])
+        client.perform_request(self._request())
+        self.assertEqual('b', client.perform_request(self._request()).body)
+        self.assertTrue(stale.closed)
+        self.assertEqual(1, client.pool.stats()['idle'])
+
+    def test_error_responses_keep_the_connection(self):
+        """Raises HTTPError for an error status and keeps the connection, whose response was read."""
+        connection = FakeConnection([FakeResponse(404, 'missing'), FakeResponse(200, 'a')])
+        client = self._client([connection])
+        with self.assertRaises(HTTPError) as raised:
+            client.perform_request(self._request())
+        self.assertEqual(404, raised.exception.status)
+        # The response is not kept on the client, which threads share.
+        self.assertIsNone(client.status)
+        self.assertEqual('a', client.perform_request(self._request()).body)
+        self.assertEqual(1, client.pool.stats()['errors'])
+
+    def test_connections_closed_by_the_server_are_not_pooled(self):
+        """Closes connections the server will close and those beyond the pool's size."""
+        closing = FakeConnection([FakeResponse(200, 'a', will_close=True)])
+        client = self._client([closing])
+        client.perform_request(self._request())
+        self.assertTrue(closing.closed)
+        self.assertEqual(0, client.pool.stats()['idle'])
+
+        pool = ConnectionPool(max_idle=1)
+        first, second = FakeConnection([]), FakeConnection([])
+        pool.release('host', first)
+        pool.release('host', second)
+        self.assertTrue(second.closed)
+        self.assertEqual(1, pool.stats()['discarded'])
+        self.assertIs(first, pool.acquire('host'))
+
+    def test_service_bus_requests_are_pooled(self):
+        """Routes the requests of a ServiceBusService through the pooled client."""
+        service = pool_connections(ServiceBusService(service_namespace='ns', account_key='key', issuer='owner'))
+        self.assertIsInstance(service._httpclient, PooledHTTPClient)
+        self.assertEqual(service._httpclient.perform_request, service._filter)
+        self.assertIs(service, pool_connections(service))
+
+    def test_backoff_delay(self):
+        """Grows the retry delay exponentially, with jitter, up to a cap."""
+        for attempt in range(4):
+            delay = backoff_delay(attempt, 1.0)
+            self.assertTrue(2 ** attempt / 2.0 <= delay <= 2 ** attempt)
+        self.assertTrue(backoff_delay(20, 1.0, cap=10) <= 10)
@@ -0,0 +1,405 @@
+"""
+Defines an uploader which writes Block Blobs in parallel blocks.
+
+Files are read one block at a time, or written through a BlockWriter, and each block is sent
+with put_block on a pool of threads, then the blob is committed with put_block_list. The
+number of blocks held in memory is bounded by a pool of buffers shared by all the uploads, so
+memory use does not depend on the size of the files. Each block is sent with its MD5, which
+the storage service verifies, and is retried on failure. Several blobs can be uploaded
+concurrently.
+"""
+import azure
+import base64
+import hashlib
+import httplib
+import logging
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from multiprocessing.pool import ThreadPool
+
+from codalabtools import backoff_delay
+
+logger = logging.getLogger('codalabtools')
+
+BLOCK_SIZE = 4 * 1024 * 1024
+UPLOAD_THREADS = 4
+UPLOAD_RETRIES = 3
+
+# Seconds between two uploads of a file which is still being written.
+FLUSH_INTERVAL = 10
+
+# Maximum number of blocks of a Block Blob.
+MAX_BLOCKS = 50000
+
+# Delay in seconds before the first retry of a request; it doubles with each retry, with jitter.
+RETRY_DELAY = 1
+
+_RETRIED_ERRORS = (azure.WindowsAzureError, socket.error, httplib.HTTPException)
+
+
+def _md5(data):
+    return base64.b64encode(hashlib.md5(data).digest())
+
+
+def _block_id_prefix():
+    """
+    Returns a random prefix for the IDs of the blocks of one upload. Uploads to the same Blob
+    never share block IDs, so they cannot overwrite each other's uncommitted blocks; all the
+    IDs of a Blob keep the same length, as the storage service requires.
+    """
+    return uuid.uuid4().hex[:16]
+
+
+def _retry(retries, description, func, *args, **kwargs):
+    """Calls func, retrying it up to retries times with a jittered exponential backoff if it fails."""
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except _RETRIED_ERRORS:
+            if attempt >= retries:
+                raise
+            logger.warning("Retrying %s after failure (attempt %d of %d).", description, attempt + 1,
+                           retries, exc_info=True)
+            time.sleep(backoff_delay(attempt, RETRY_DELAY))
+            attempt += 1
+
+
+def iter_blocks(source, block_size=BLOCK_SIZE):
+    """
+    Yields the content of source in blocks of block_size bytes; only the last block may be
+    shorter.
+
+    source: Path of a file, file-like object or iterable of byte strings.
+    """
+    if isinstance(source, basestring):
+        with open(source, 'rb') as f:
+            for block in iter_blocks(f, block_size):
+                yield block
+    elif hasattr(source, 'read'):
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            yield block
+    else:
+        pending = []
+        pending_size = 0
+        for chunk in source:
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= block_size:
+                data = ''.join(pending)
+                offset = 0
+                while len(data) - offset >= block_size:
+                    yield data[offset:offset + block_size]
+                    offset += block_size
+                pending = [data[offset:]]
+                pending_size = len(pending[0])
+        if pending_size > 0:
+            yield ''.join(pending)
+
+
+class BlockUploader(object):
+    """
+    Uploads Block Blobs in parallel blocks.
+
+    Uploads are started with `upload`, which returns once the blob is committed, or with
+    `submit`, which returns immediately; `wait` then waits for the submitted uploads. `close`
+    must be called once the uploader is no longer needed.
+    """
+    def __init__(self, blob_service, block_size=BLOCK_SIZE, threads=UPLOAD_THREADS, buffers=None,
+                 retries=UPLOAD_RETRIES):
+        """
+        blob_service: A BlobService object.
+        block_size: Size of the blocks.
+        threads: Number of blocks sent concurrently, which is also the number of blobs
+            uploaded concurrently by `submit`.
+        buffers: Maximum number of blocks held in memory. Defaults to twice the number of
+            threads, so blocks are read while others are sent.
+        retries: Number of times a failed request is retried.
+        """
+        self.blob_service = blob_service
+        self.block_size = block_size
+        self.retries = retries
+        self._buffers = threading.BoundedSemaphore(buffers or 2 * threads)
+        self._block_pool = ThreadPool(threads)
+        self._blob_pool = ThreadPool(threads)
+        self._submitted = []
+
+    def _retry(self, description, func, *args, **kwargs):
+        return _retry(self.retries, description, func, *args, **kwargs)
+
+    def _put_block(self, container, blob_id, block, block_id, failed):
+        try:
+            self._retry("block %s of %s" % (block_id, blob_id), self.blob_service.put_block,
+                        container, blob_id, block, block_id, content_md5=_md5(block))
+        except:
+            failed.set()
+            raise
+        finally:
+            self._buffers.release()
+
+    def writer(self, container, blob_id, content_type=None, commit_service=None):
+        """
+        Returns a BlockWriter which uploads a Block Blob from successive writes.
+
+        container: Name of the container to upload the Blob to.
+        blob_id: Name of the Blob relative to the container.
+        content_type: Optional content type of the Blob.
+        commit_service: Optional BlobService sending the request which commits the Blob, such
+            as one which only creates Blobs. Defaults to the uploader's.
+        """
+        return BlockWriter(self, container, blob_id, content_type, commit_service)
+
+    def upload(self, container, blob_id, source, content_type=None, commit_service=None):
+        """
+        Uploads a Block Blob.
+
+        container: Name of the container to upload the Blob to.
+        blob_id: Name of the Blob relative to the container.
+        source: Path of a file, file-like object or iterable of byte strings to upload.
+        content_type: Optional content type of the Blob.
+        commit_service: Optional BlobService sending the request which commits the Blob.
+        """
+        writer = self.writer(container, blob_id, content_type, commit_service)
+        try:
+            for block in iter_blocks(source, self.block_size):
+                writer.write(block)
+        except:
+            # Wait for the blocks already sent, so no buffer outlives the upload.
+            writer.abort()
+            raise
+        writer.close()
+
+    def submit(self, container, blob_id, source, content_type=None):
+        """
+        Starts uploading a Block Blob in the background. See `upload` for the arguments.
+        """
+        self._submitted.append((blob_id, self._blob_pool.apply_async(self.upload,
+                                                                     (container, blob_id, source, content_type))))
+
+    def wait(self):
+        """
+        Waits for the submitted uploads to complete. Raises the error of the first upload
+        which failed, once all of them are done.
+        """
+        submitted, self._submitted = self._submitted, []
+        error = None
+        for blob_id, result in submitted:
+            try:
+                result.get()
+            except Exception:
+                logger.exception("Failed to upload %s.", blob_id)
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def close(self):
+        """
+        Waits for the uploads in progress and stops the uploader's threads.
+        """
+        self._blob_pool.close()
+        self._blob_pool.join()
+        self._block_pool.close()
+        self._block_pool.join()
+
+
+class BlockWriter(object):
+    """
+    Uploads a Block Blob from successive writes of any size.
+
+    Written bytes are gathered into blocks of the uploader's block size, which the uploader's
+    threads send while the next ones are written. `close` sends the rest and commits the blob;
+    a blob smaller than one block is sent in one request. `abort` gives up the upload.
+    """
+    def __init__(self, uploader, container, blob_id, content_type=None, commit_service=None):
+        """
+        uploader: The BlockUploader sending the blocks.
+        container: Name of the container to upload the Blob to.
+        blob_id: Name of the Blob relative to the container.
+        content_type: Optional content type of the Blob.
+        commit_service: Optional BlobService sending the request which commits the Blob.
+            Defaults to the uploader's.
+        """
+        self.uploader = uploader
+        self.commit_service = commit_service or uploader.blob_service
+        self.container = container
+        self.blob_id = blob_id
+        self.content_type = content_type
+        self._chunks = []
+        self._size = 0
+        self._block_id_prefix = _block_id_prefix()
+        self._block_ids = []
+        self._results = []
+        self._md5 = hashlib.md5()
+        self._failed = threading.Event()
+
+    def write(self, data):
+        """
+        Writes bytes to the blob. Raises the error of a block which failed to upload.
+        """
+        if self._failed.is_set():
+            self._wait()
+        self._chunks.append(data)
+        self._size += len(data)
+        block_size = self.uploader.block_size
+        if self._size >= block_size:
+            pending = ''.join(self._chunks)
+            offset = 0
+            while len(pending) - offset >= block_size:
+                self._send(pending[offset:offset + block_size])
+                offset += block_size
+            self._chunks = [pending[offset:]]
+            self._size = len(pending) - offset
+        return len(data)
+
+    def _send(self, block):
+        # Waits for a free buffer, which bounds the number of blocks held in memory.
+        self.uploader._buffers.acquire()
+        block_id = "%s%08d" % (self._block_id_prefix, len(self._block_ids))
+        self._block_ids.append(block_id)
+        self._md5.update(block)
+        self._results.append(self.uploader._block_pool.apply_async(self.uploader._put_block,
+                                                                   (self.container, self.blob_id, block, block_id,
+                                                                    self._failed)))
+
+    def _wait(self):
+        """Waits for the blocks sent so far and raises the error of the first which failed."""
+        for result in self._results:
+            result.wait()
+        for result in self._results:
+            result.get()
+
+    def close(self):
+        """
+        Sends the rest of the blob, waits for its blocks and commits it.
+        """
+        rest = ''.join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        if len(self._block_ids) == 0:
+            # The whole blob fits in one block: send it in one request.
+            self.uploader._retry("blob %s" % self.blob_id, self.commit_service.put_blob,
+                                 self.container, self.blob_id, rest, 'BlockBlob',
+                                 content_md5=_md5(rest), x_ms_blob_content_type=self.content_type)
+            return
+        try:
+            if len(rest) > 0:
+                self._send(rest)
+        finally:
+            self._wait()
+        self.uploader._retry("block list of %s" % self.blob_id, self.commit_service.put_block_list,
+                             self.container, self.blob_id, self._block_ids,
+                             x_ms_blob_content_type=self.content_type,
+                             x_ms_blob_content_md5=base64.b64encode(self._md5.digest()))
+
+    def abort(self):
+        """
+        Waits for the blocks already sent and gives up the upload; the blob is not committed.
+        """
+        self._chunks = []
+        self._size = 0
+        for result in self._results:
+            result.wait()
+
+class LiveFileUploader(object):
+    """
+    Uploads a file while it is being written, such as the log of a running program.
+
+    Every `interval` seconds, the bytes appended to the file since the previous upload are
+    sent as new blocks and the blob is committed with all the blocks sent so far, so the blob
+    holds the file as it was at most `interval` seconds ago. `close` uploads the rest of the
+    file once it is complete.
+    """
+    def __init__(self, blob_service, container, blob_id, path, interval=FLUSH_INTERVAL, block_size=BLOCK_SIZE,
+                 retries=UPLOAD_RETRIES, content_type=None):
+        """
+        blob_service: A BlobService object.
+        container: Name of the container to upload the Blob to.
+        blob_id: Name of the Blob relative to the container.
+        path: Path of the file to upload.
+        interval: Seconds between two uploads.
+        block_size: Maximum size of the blocks.
+        retries: Number of times a failed request is retried.
+        content_type: Optional content type of the Blob.
+        """
+        self.blob_service = blob_service
+        self.container = container
+        self.blob_id = blob_id
+        self.path = path
+        self.interval = interval
+        self.block_size = block_size
+        self.retries = retries
+        self.content_type = content_type
+        self._offset = 0
+        self._block_id_prefix = _block_id_prefix()
+        self._block_ids = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def flush(self):
+        """
+        Uploads the bytes appended to the file since the previous upload.
+        """
+        with self._lock:
+            new_blocks = False
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                while True:
+                    if len(self._block_ids) >= MAX_BLOCKS:
+                        logger.warning("%s has reached the maximum number of blocks; the rest is not uploaded.",
+                                       self.blob_id)
+                        break
+                    block = f.read(self.block_size)
+                    if not block:
+                        break
+                    block_id = "%s%08d" % (self._block_id_prefix, len(self._block_ids))
+                    _retry(self.retries, "block %s of %s" % (block_id, self.blob_id), self.blob_service.put_block,
+                           self.container, self.blob_id, block, block_id, content_md5=_md5(block))
+                    self._block_ids.append(block_id)
+                    self._offset += len(block)
+                    new_blocks = True
+            if new_blocks:
+                _retry(self.retries, "block list of %s" % self.blob_id, self.blob_service.put_block_list,
+                       self.container, self.blob_id, self._block_ids, x_ms_blob_content_type=self.content_type)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to upload %s while it is written.", self.blob_id)
+
+    def start(self):
+        """
+        Starts uploading the file periodically in the background.
+        """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops uploading the file periodically.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """
+        Stops uploading the file periodically and uploads the rest of the file.
+        """
+        self.stop()
+        self.flush()
+        if len(self._block_ids) == 0:
+            _retry(self.retries, "blob %s" % self.blob_id, self.blob_service.put_blob, self.container, self.blob_id,
+                   '', 'BlockBlob', x_ms_blob_content_type=self.content_type)
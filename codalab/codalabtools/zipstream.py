@@ -0,0 +1,295 @@
+"""
+Defines a zip archive writer which produces the archive as a stream of bytes.
+
+Members are read one chunk at a time and the zip bytes are emitted as soon as they are
+produced, so the memory used while building an archive does not depend on its size. Member
+sizes and CRCs are written in data descriptors after the member data, and Zip64 records are
+used when the archive outgrows the limits of the classic zip format. Members whose size is not
+known in advance may outgrow them: their local and central directory headers carry a Zip64
+extra field and their data descriptors hold 64-bit sizes. Archives which share members can be written together with
+`write_archives`, which reads and compresses each shared member once.
+"""
+import struct
+import time
+import zipfile
+import zlib
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_MAX_ENTRIES = 0xFFFF
+
+_LOCAL_FILE_HEADER = struct.Struct("<4s2B4HL2L2H")
+_DATA_DESCRIPTOR = struct.Struct("<4sLLL")
+_DATA_DESCRIPTOR64 = struct.Struct("<4sLQQ")
+_ZIP64_EXTRA = struct.Struct("<2H2Q")
+_CENTRAL_DIRECTORY_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+_END_OF_CENTRAL_DIRECTORY = struct.Struct("<4s4H2LH")
+_END_OF_CENTRAL_DIRECTORY64 = struct.Struct("<4sQ2H2L4Q")
+_END_OF_CENTRAL_DIRECTORY64_LOCATOR = struct.Struct("<4sLQL")
+
+# General purpose flags: sizes and CRC follow the data (bit 3), names are UTF-8 (bit 11).
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+
+_VERSION_DEFAULT = 20
+_VERSION_ZIP64 = 45
+_CREATE_SYSTEM_UNIX = 3
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Yields the content of a file-like object one chunk at a time and closes it.
+    """
+    try:
+        while True:
+            data = fileobj.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        fileobj.close()
+
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time[:6]
+    dos_date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | (second // 2)
+    return dos_date, dos_time
+
+
+def _may_exceed_zip32(size):
+    """Tells whether a member of the given size, or of unknown size if None, may need Zip64 sizes."""
+    # Deflated data may be slightly larger than its input: allow the same margin as zipfile.
+    return size is None or size * 1.05 > ZIP32_LIMIT
+
+
+class _Member(object):
+    """Describes a member of the archive and, once written, its sizes, CRC and offset."""
+    def __init__(self, arcname, source, date_time, compress_type, size):
+        if isinstance(arcname, unicode):
+            self.name = arcname.encode('utf-8')
+            self.flags = _FLAG_DATA_DESCRIPTOR | _FLAG_UTF8
+        else:
+            self.name = arcname
+            self.flags = _FLAG_DATA_DESCRIPTOR
+        self.source = source
+        self.date_time = date_time
+        self.compress_type = compress_type
+        self.size = size
+        self.zip64 = False
+        self.crc = 0
+        self.compressed_size = 0
+        self.file_size = 0
+        self.header_offset = 0
+
+
+class ZipStream(object):
+    """
+    Builds a zip archive as an iterable of byte strings.
+
+    Members are added with `add`; their content is only read when the stream is iterated. A
+    ZipStream can be passed directly to a StreamingHttpResponse or written to any sink.
+    """
+    def __init__(self, compression=zipfile.ZIP_DEFLATED, compresslevel=6):
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self._members = []
+
+    def add(self, arcname, source, date_time=None, compress_type=None, size=None):
+        """
+        Adds a member to the archive.
+
+        arcname: Name of the member in the archive.
+        source: A byte string, an iterable of byte strings, or a callable returning either.
+            Callables are only invoked when the member is written, which lets many members
+            backed by remote files be added without opening them all at once.
+        date_time: Modification time as a tuple (year, month, day, hour, minute, second).
+            Defaults to the current local time.
+        compress_type: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED. Defaults to the archive's
+            compression.
+        size: Size of the content, if known; byte strings give their own. Members of unknown
+            size are written with Zip64 headers, as they may exceed 4GB.
+        """
+        if date_time is None:
+            date_time = time.localtime(time.time())[:6]
+        if compress_type is None:
+            compress_type = self.compression
+        if isinstance(source, str):
+            size = len(source)
+        self._members.append(_Member(arcname, source, date_time, compress_type, size))
+
+    def __iter__(self):
+        offset = 0
+        for member in self._members:
+            for data in self._write_member(member, offset):
+                offset += len(data)
+                yield data
+        for data in self._write_central_directory(offset):
+            yield data
+
+    def _write_member(self, member, offset):
+        member.header_offset = offset
+        yield self._local_header(member)
+        for chunk in self._compressed_chunks(member):
+            yield chunk
+        yield self._data_descriptor(member)
+
+    def _local_header(self, member):
+        member.zip64 = _may_exceed_zip32(member.size)
+        dos_date, dos_time = _dos_date_time(member.date_time)
+        if member.zip64:
+            # The sizes follow the data, in a 64-bit data descriptor.
+            extra = _ZIP64_EXTRA.pack(0x0001, 16, 0, 0)
+            return _LOCAL_FILE_HEADER.pack("PK\003\004", _VERSION_ZIP64, 0, member.flags, member.compress_type,
+                                           dos_time, dos_date, 0, ZIP32_LIMIT, ZIP32_LIMIT, len(member.name),
+                                           len(extra)) + member.name + extra
+        return _LOCAL_FILE_HEADER.pack("PK\003\004", _VERSION_DEFAULT, 0, member.flags, member.compress_type,
+                                       dos_time, dos_date, 0, 0, 0, len(member.name), 0) + member.name
+
+    def _compressed_chunks(self, member):
+        """Yields the compressed data of a member, then records its sizes and CRC."""
+        source = member.source() if callable(member.source) else member.source
+        if isinstance(source, str):
+            source = [source]
+        if member.compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+        else:
+            compressor = None
+        crc, file_size, compressed_size = 0, 0, 0
+        for chunk in source:
+            if not chunk:
+                continue
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            compressed_size += len(chunk)
+            yield chunk
+        if compressor is not None:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            yield chunk
+
+        member.crc = crc & 0xFFFFFFFF
+        member.file_size = file_size
+        member.compressed_size = compressed_size
+
+    def _data_descriptor(self, member):
+        if member.zip64:
+            return _DATA_DESCRIPTOR64.pack("PK\007\010", member.crc, member.compressed_size, member.file_size)
+        if member.file_size >= ZIP32_LIMIT or member.compressed_size >= ZIP32_LIMIT:
+            raise zipfile.LargeZipFile("%s is larger than its given size." % member.name)
+        return _DATA_DESCRIPTOR.pack("PK\007\010", member.crc, member.compressed_size, member.file_size)
+
+    def _write_central_directory(self, offset):
+        start = offset
+        for member in self._members:
+            extra = []
+            file_size, compressed_size, header_offset = member.file_size, member.compressed_size, member.header_offset
+            # The sizes of a member whose local header used Zip64 are in Zip64 fields here too.
+            if member.zip64 or file_size >= ZIP32_LIMIT:
+                extra.append(file_size)
+                file_size = ZIP32_LIMIT
+            if member.zip64 or compressed_size >= ZIP32_LIMIT:
+                extra.append(compressed_size)
+                compressed_size = ZIP32_LIMIT
+            if header_offset >= ZIP32_LIMIT:
+                extra.append(header_offset)
+                header_offset = ZIP32_LIMIT
+            if extra:
+                extra_data = struct.pack("<2H%dQ" % len(extra), 0x0001, 8 * len(extra), *extra)
+            else:
+                extra_data = ""
+            version = _VERSION_ZIP64 if extra or member.zip64 else _VERSION_DEFAULT
+            dos_date, dos_time = _dos_date_time(member.date_time)
+            header = _CENTRAL_DIRECTORY_HEADER.pack("PK\001\002", version, _CREATE_SYSTEM_UNIX, version, 0,
+                                                    member.flags, member.compress_type, dos_time, dos_date,
+                                                    member.crc, compressed_size, file_size,
+                                                    len(member.name), len(extra_data), 0, 0, 0,
+                                                    0o600 << 16, header_offset)
+            data = header + member.name + extra_data
+            offset += len(data)
+            yield data
+
+        count = len(self._members)
+        size = offset - start
+        if count > ZIP32_MAX_ENTRIES or size >= ZIP32_LIMIT or start >= ZIP32_LIMIT:
+            yield _END_OF_CENTRAL_DIRECTORY64.pack("PK\006\006", _END_OF_CENTRAL_DIRECTORY64.size - 12,
+                                                   _VERSION_ZIP64, _VERSION_ZIP64, 0, 0,
+                                                   count, count, size, start)
+            yield _END_OF_CENTRAL_DIRECTORY64_LOCATOR.pack("PK\006\007", 0, offset, 1)
+            yield _END_OF_CENTRAL_DIRECTORY.pack("PK\005\006", 0, 0,
+                                                 min(count, ZIP32_MAX_ENTRIES), min(count, ZIP32_MAX_ENTRIES),
+                                                 min(size, ZIP32_LIMIT), min(start, ZIP32_LIMIT), 0)
+        else:
+            yield _END_OF_CENTRAL_DIRECTORY.pack("PK\005\006", 0, 0, count, count, size, start, 0)
+
+
+def _shares_data(archive, member, other_archive, other_member):
+    """Tells whether two members are written from the same compressed data."""
+    return (member.source is other_member.source and member.compress_type == other_member.compress_type and
+            archive.compresslevel == other_archive.compresslevel)
+
+
+def write_archives(archives, sinks):
+    """
+    Writes ZipStreams which share members to file-like sinks, reading and compressing each
+    shared member once.
+
+    A member is shared by the archives it was added to with the same source object and the
+    same compression. A shared member is written to all its archives at once, once it is the
+    next member of each of them, so shared members must be added in the same order to all the
+    archives; members added out of order are simply compressed for each archive.
+
+    archives: The ZipStreams to write.
+    sinks: The objects, one for each archive, whose `write` method receives its bytes.
+    """
+    positions = [0] * len(archives)
+    offsets = [0] * len(archives)
+    # The number of members left to write from each source, for each archive.
+    remaining = []
+    for archive in archives:
+        counts = {}
+        for member in archive._members:
+            counts[id(member.source)] = counts.get(id(member.source), 0) + 1
+        remaining.append(counts)
+    while True:
+        current = [i for i, archive in enumerate(archives) if positions[i] < len(archive._members)]
+        if not current:
+            break
+        # Write the first next member which no other archive holds further on, if any.
+        for first in current:
+            member = archives[first]._members[positions[first]]
+            holders = [i for i in current
+                       if _shares_data(archives[first], member, archives[i], archives[i]._members[positions[i]])]
+            if all(i in holders or remaining[i].get(id(member.source), 0) == 0 for i in current):
+                break
+        else:
+            first = current[0]
+            member = archives[first]._members[positions[first]]
+            holders = [first]
+        members = [archives[i]._members[positions[i]] for i in holders]
+        for i, holder_member in zip(holders, members):
+            holder_member.header_offset = offsets[i]
+            data = archives[i]._local_header(holder_member)
+            offsets[i] += len(data)
+            sinks[i].write(data)
+        for chunk in archives[first]._compressed_chunks(member):
+            for i in holders:
+                offsets[i] += len(chunk)
+                sinks[i].write(chunk)
+        for i, holder_member in zip(holders, members):
+            holder_member.crc = member.crc
+            holder_member.file_size = member.file_size
+            holder_member.compressed_size = member.compressed_size
+            data = archives[i]._data_descriptor(holder_member)
+            offsets[i] += len(data)
+            sinks[i].write(data)
+            remaining[i][id(holder_member.source)] -= 1
+            positions[i] += 1
+    for i, archive in enumerate(archives):
+        for data in archive._write_central_directory(offsets[i]):
+            sinks[i].write(data)